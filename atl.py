@@ -1,24 +1,35 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import os
 import time
 import json
+import queue
+import signal
+import threading
 from datetime import datetime
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin
 import requests
+from bs4 import BeautifulSoup
 import jwt
 import sqlite3
 import pytz
 import re
-from data_extraction import extract_data_from_html, extract_nf_key, check_delivery_receipt, extract_tracking_info
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from data_extraction import extract_data_from_html, fetch_nf_html, parse_nf_key, fetch_occurrences_html, parse_occurrences, page_fingerprint, empty_tracking_data, is_ctrc_page, peek_seq_ctrc
 from copy import deepcopy
-
-# Configura as opções para o modo headless
-options = webdriver.ChromeOptions()
-options.add_argument("--disable-gpu")
-options.add_argument("--window-size=1920x1080")
+from fetch_engine import FetchEngine
+from concurrency import AIMDController
+from rate_limit import RateLimiter, RetryBudget, backoff_delay
+from ssw_standin import FixtureStore, FixtureRecorder
+from token_manager import TokenManager
+from backfill import GapBackfiller
+from negative_cache import NegativeCache
+from scheduler import RefreshScheduler
+from html_archive import HtmlArchive
+from parse_pipeline import ParsePipeline
+from ssw_formats import parse_timestamp, parse_timestamp_column
+from shard_leases import ShardLeases
+from job_queue import JobQueue
+from discovery import find_head, ensure_state_table, load_watermark, save_watermark
+import perf_stats
+import ssw_http
 
 # URL base do sistema
 base_url = "https://sistema.ssw.inf.br"
@@ -30,8 +41,108 @@ config_file = "config.json"
 # Intervalo de atualização em segundos (20 minutos * 60 segundos/minuto)
 update_interval = 20 * 60
 
-def get_token_and_save():
-    print(f"\nIniciando busca do token em {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+# Credenciais de login do SSW: variáveis de ambiente ou, na falta delas, a
+# seção "login" do config.json (mesmas chaves)
+LOGIN_ENV = {'dominio': 'SSW_DOMINIO', 'cpf': 'SSW_CPF', 'usuario': 'SSW_USUARIO', 'senha': 'SSW_SENHA'}
+
+# Formulário de login do ssw0422: id do formulário e ids dos campos de
+# domínio, CPF, usuário e senha (os mesmos preenchidos pelo Selenium)
+LOGIN_FORM_ID = 'frm'
+LOGIN_FIELD_IDS = {'dominio': '1', 'cpf': '2', 'usuario': '3', 'senha': '4'}
+
+def load_login_credentials():
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            login_config = json.load(f).get('login', {})
+    except (FileNotFoundError, json.JSONDecodeError):
+        login_config = {}
+    credenciais = {key: os.environ.get(env_var) or login_config.get(key) for key, env_var in LOGIN_ENV.items()}
+    missing = [LOGIN_ENV[key] for key, value in credenciais.items() if not value]
+    if missing:
+        raise RuntimeError(f"Credenciais de login do SSW ausentes: defina {', '.join(missing)} ou a seção login do {config_file}.")
+    return credenciais
+
+# Salva os cookies obtidos no config.json. Com merge=True, os cookies novos
+# são somados aos já salvos (o login via HTTP não recebe os cookies que o
+# navegador cria por JavaScript, como ssw_dom e sigla_emp).
+def save_cookies_to_config(current_cookies, merge=False):
+    token = current_cookies.get('token')
+
+    # Carrega o arquivo de configuração existente ou cria um novo
+    try:
+        with open(config_file, "r") as f:
+            config_data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        config_data = {}
+        print("Aviso: Arquivo config.json não encontrado ou corrompido. Criando um novo.")
+
+    # Atualiza a seção de cookies e adiciona a data/hora da obtenção
+    if merge:
+        config_data['cookies'] = {**config_data.get('cookies', {}), **current_cookies}
+    else:
+        config_data['cookies'] = current_cookies
+    config_data['last_token_retrieval'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    if token:
+        config_data['token_info'] = {
+            'value': token,
+            'retrieved_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+    # Salva as informações no arquivo config.json
+    with open(config_file, "w") as f:
+        json.dump(config_data, f, indent=4)
+    print(f"\nArquivo {config_file} atualizado com os novos cookies e data de obtenção.")
+
+    return token is not None
+
+# Login direto por HTTP: o formulário LOGIN_FORM_ID do ssw0422, com os campos
+# LOGIN_FIELD_IDS preenchidos (e os ocultos como vieram), enviado por POST
+# ao próprio ssw0422. Retorna os cookies ('token' e 'chave' obrigatórios).
+# Levanta RuntimeError se a página não tem esse formulário, se ele mudou de
+# destino ou se o login não devolve os cookies.
+def get_token_via_http(timeout=15):
+    credenciais = load_login_credentials()
+    session = requests.Session()
+    login_headers = {'User-Agent': headers.get('User-Agent', '')}
+    response = session.get(login_url, headers=login_headers, timeout=timeout)
+    response.raise_for_status()
+
+    soup = BeautifulSoup(response.text, 'html.parser')
+    form = soup.find('form', id=LOGIN_FORM_ID)
+    if not form:
+        raise RuntimeError(f"Página de login do SSW sem o formulário '{LOGIN_FORM_ID}': o login mudou.")
+    action = urljoin(login_url, form.get('action') or login_url)
+    if urlparse(action).path != urlparse(login_url).path:
+        raise RuntimeError(f"Formulário de login do SSW enviado para {action}, não para o ssw0422: o login mudou.")
+
+    fields = {field.get('name'): field.get('value', '') for field in form.find_all('input') if field.get('name')}
+    for key, element_id in LOGIN_FIELD_IDS.items():
+        field = form.find(id=element_id)
+        if not field or not field.get('name'):
+            raise RuntimeError(f"Formulário de login do SSW sem o campo {element_id} ({key}): o login mudou.")
+        fields[field['name']] = credenciais[key]
+
+    login_headers.update({'Origin': base_url, 'Referer': login_url, 'Content-type': 'application/x-www-form-urlencoded'})
+    session.post(action, data=fields, headers=login_headers, timeout=timeout).raise_for_status()
+
+    current_cookies = session.cookies.get_dict()
+    if not (current_cookies.get('token') and current_cookies.get('chave')):
+        raise RuntimeError("Login via HTTP no SSW sem os cookies 'token' e 'chave' (credenciais recusadas ou login mudou).")
+    return current_cookies
+
+def get_token_via_selenium():
+    credenciais = load_login_credentials()
+    # Selenium só é carregado quando o login via HTTP falha
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
+    # Configura as opções para o modo headless
+    options = webdriver.ChromeOptions()
+    options.add_argument("--disable-gpu")
+    options.add_argument("--window-size=1920x1080")
 
     # Inicializa o driver do navegador (será fechado ao final da função)
     driver = webdriver.Chrome(options=options)
@@ -47,17 +158,10 @@ def get_token_and_save():
         print("Página de login carregada.")
 
         # Localiza e preenche os campos de login
-        dominio_input = wait.until(EC.presence_of_element_located((By.ID, "1")))
-        cpf_input = wait.until(EC.presence_of_element_located((By.ID, "2")))
-        usuario_input = wait.until(EC.presence_of_element_located((By.ID, "3")))
-        senha_input = wait.until(EC.presence_of_element_located((By.ID, "4")))
+        for key, element_id in LOGIN_FIELD_IDS.items():
+            wait.until(EC.presence_of_element_located((By.ID, element_id))).send_keys(credenciais[key])
         botao_login = wait.until(EC.element_to_be_clickable((By.ID, "5")))
 
-        dominio_input.send_keys("rdm")
-        cpf_input.send_keys("85842671581")
-        usuario_input.send_keys("ricardos")
-        senha_input.send_keys("RSS842")
-
         # Clica no botão de login
         botao_login.click()
         print("Login realizado.")
@@ -71,16 +175,31 @@ def get_token_and_save():
         for cookie in cookies:
             print(f"{cookie['name']}={cookie['value']}")
 
+        return {cookie['name']: cookie['value'] for cookie in cookies}
+    finally:
+        # Fecha o navegador
+        driver.quit()
+        print("Navegador fechado.")
+
+def get_token_and_save():
+    print(f"\nIniciando busca do token em {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    try:
+        current_cookies = get_token_via_http()
+        merge = True
+    except Exception as e:
+        print(f"ERRO no login via HTTP: {e}")
+        current_cookies = None
+
+    try:
+        if not current_cookies:
+            print("Login via HTTP falhou; usando Selenium.")
+            current_cookies = get_token_via_selenium()
+            merge = False
+
         # Procura a chave e o token nos cookies
-        chave = None
-        token = None
-        current_cookies = {}
-        for cookie in cookies:
-            current_cookies[cookie['name']] = cookie['value']
-            if cookie['name'] == 'chave':
-                chave = cookie['value']
-            if cookie['name'] == 'token':
-                token = cookie['value']
+        chave = current_cookies.get('chave')
+        token = current_cookies.get('token')
 
         print("\nInformações encontradas nos cookies:")
         if chave:
@@ -93,41 +212,14 @@ def get_token_and_save():
         else:
             print("Token não encontrado nos cookies.")
 
-        # Carrega o arquivo de configuração existente ou cria um novo
-        try:
-            with open(config_file, "r") as f:
-                config_data = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            config_data = {}
-            print("Aviso: Arquivo config.json não encontrado ou corrompido. Criando um novo.")
-
-        # Atualiza a seção de cookies e adiciona a data/hora da obtenção
-        config_data['cookies'] = current_cookies
-        config_data['last_token_retrieval'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        if token:
-            config_data['token_info'] = {
-                'value': token,
-                'retrieved_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
-
-        # Salva as informações no arquivo config.json
-        with open(config_file, "w") as f:
-            json.dump(config_data, f, indent=4)
-        print(f"\nArquivo {config_file} atualizado com os novos cookies e data de obtenção.")
-
-        return token is not None
+        return save_cookies_to_config(current_cookies, merge=merge)
 
     except Exception as e:
         print(f"Ocorreu um erro durante a obtenção do token: {e}")
         return False
-    finally:
-        # Fecha o navegador
-        driver.quit()
-        print("Navegador fechado.")
 
 def refresh_token():
-    print("Renovando token usando Selenium...")
+    print("Renovando token...")
     success = get_token_and_save()
     if success:
         print("Token renovado com sucesso.")
@@ -150,6 +242,57 @@ def load_config():
 
 cookies, headers = load_config()
 
+# Configurações da ingestão (seção opcional "ingestao" do config.json)
+DEFAULT_INGESTAO_CONFIG = {
+    'concorrencia_por_filial': 10,
+    'concorrencia_min': 1,
+    'concorrencia_max': 50,
+    'latencia_alvo': 3.0,
+    'taxa_max_erros': 0.1,
+    'taxa_max_vazias': 0.8,
+    'limite_global_rps': 20,
+    'limite_por_endpoint_rps': {},
+    'retentativas_por_ctrc': 4,
+    'ssw_base_url': base_url,
+    'gravar_fixtures': '',
+    'token_antecedencia': 600,
+    'token_intervalo_verificacao': 60,
+    'descoberta_janela': 3,
+    'descoberta_max_por_ciclo': 500,
+    'descoberta_intervalo': 60,
+    'cache_negativo_ttl_perto': 600,
+    'cache_negativo_ttl_longe': 604800,
+    'cache_negativo_distancia_perto': 50,
+    'cache_negativo_distancia_longe': 5000,
+    'lacunas_bloco': 200,
+    'atualizacao_lote': 500,
+    'arquivo_html': '',
+    'arquivo_retencao_dias': 90,
+    'arquivo_manter_ultimas': 1,
+    'lacunas_intervalo': 3600,
+    'processos_parse': 0,
+    'fila_paginas': 200,
+    'shards_ativo': False,
+    'shards_worker_id': '',
+    'shards_max_por_worker': 0,
+    'shards_lease_ttl': 60,
+    'shards_heartbeat': 15,
+    'fila_visibilidade': 300,
+    'fila_lote': 200,
+    'fila_max_tentativas': 3,
+    'fila_atraso_retentativa': 60,
+    'fila_retencao_dias': 7,
+}
+
+def load_ingestao_config():
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    ingestao_config = dict(DEFAULT_INGESTAO_CONFIG)
+    ingestao_config.update(config.get('ingestao', {}))
+    return ingestao_config
+
+ingestao_config = load_ingestao_config()
+
 # Configurações de colunas necessárias
 required_columns = [
     'Unidade Emissor', 'N° CTRC', 'CTRC_Identificador', 'Emissão Data/Hora', 'Tipo Operação', 'Sequência CTRC',
@@ -173,7 +316,7 @@ column_mapping = {col: col.replace('°', '_').replace(' ', '_').replace('(', '')
 
 column_types = {
     'Unidade_Emissor': 'TEXT',
-    'N_CTRC': 'TEXT',
+    'N__CTRC': 'TEXT',
     'CTRC_Identificador': 'TEXT UNIQUE',
     'Emissão_Data_Hora': 'TEXT',
     'Tipo_Operação': 'TEXT',
@@ -189,8 +332,8 @@ column_types = {
     'Número_Nota_Fiscal': 'TEXT',
     'Quantidade_Volumes': 'INTEGER',
     'Peso_Cálculo_Kg': 'REAL',
-    'Valor_Nota_Fiscal_RS': 'REAL',
-    'Valor_Frete_RS': 'REAL',
+    'Valor_Nota_Fiscal_RRS': 'REAL',
+    'Valor_Frete_RRS': 'REAL',
     'Tipo_Cobrança': 'TEXT',
     'Situação_Liquidação': 'TEXT',
     'Remetente_Nome': 'TEXT',
@@ -267,35 +410,71 @@ update_intervals = {
     "CANHOTO": 1440
 }
 
+# Prioridade de negócio das reconsultas: entre registros vencidos, os de
+# maior peso são atualizados primeiro (situações fora da lista valem 3)
+update_priorities = {
+    "EM ROTA DE ENTREGA": 10,
+    "DISPONÍVEL PARA ENTREGA": 8,
+    "SETOR DE PENDÊNCIA": 6,
+    "EM TRANSFERENCIA": 5,
+    "AGATD. TRANSF, DA UN VNA PARA UNIDADE DE BHZI": 5,
+    "Unidade de Muriae": 5,
+    "Unidade de Belo Horizonte": 5,
+    "Unidade de São Pedro da Aldeia": 5,
+    "Unidade de Viana": 5,
+    "AGUARDANDO TRATAMENTO": 4,
+    "AGUARDANDO DEFINIÇÃO": 4,
+    "OUTRO": 3,
+    "CANHOTO RETIDO": 1,
+    "CANHOTO": 1
+}
+
+# Colunas calculadas localmente, fora da comparação com a página do SSW
+DERIVED_COLUMNS = {'CTRC_Identificador', 'LEADTIME', 'situação_prazo', 'tentativas_dados', 'situacao_resumida', 'ultima_verificacao', 'rota'}
+
+refresh_scheduler = RefreshScheduler(update_intervals, update_priorities, tz=pytz.timezone('America/Sao_Paulo'))
+
 # Funções auxiliares
 def calculate_leadtime_and_situacao(row):
     required_keys = ['ocorrencia_data_Data_de_Emissão_CTRC', 'ocorrencia_data_Entregue', 'Previsão_Entrega']
     if all(key in row and row[key] for key in required_keys):
-        try:
-            data_entregue = datetime.strptime(row['ocorrencia_data_Entregue'], '%Y-%m-%d %H:%M:%S')
-            data_emissao = datetime.strptime(row['ocorrencia_data_Data_de_Emissão_CTRC'], '%Y-%m-%d %H:%M:%S')
-            data_previsao = datetime.strptime(row['Previsão_Entrega'], '%Y-%m-%d %H:%M:%S')
+        data_entregue = parse_timestamp(row['ocorrencia_data_Entregue'])
+        data_emissao = parse_timestamp(row['ocorrencia_data_Data_de_Emissão_CTRC'])
+        data_previsao = parse_timestamp(row['Previsão_Entrega'])
+        if data_entregue is None or data_emissao is None or data_previsao is None:
+            return None, None
 
-            leadtime = (data_entregue - data_emissao).total_seconds() / 86400
-            situacao_prazo = 'ENTREGUE NO PRAZO' if data_entregue <= data_previsao else 'ENTREGUE FORA DO PRAZO'
+        leadtime = (data_entregue - data_emissao).total_seconds() / 86400
+        situacao_prazo = 'ENTREGUE NO PRAZO' if data_entregue <= data_previsao else 'ENTREGUE FORA DO PRAZO'
 
-            return int(leadtime), situacao_prazo
-        except ValueError:
-            return None, None
+        return int(leadtime), situacao_prazo
     return None, None
 
 def calcular_leadtime_e_situacao_prazo(data_emissao, ocorrencia_data_entregue):
     result = {'LEADTIME': None, 'situação_prazo': None}
     if data_emissao and ocorrencia_data_entregue:
-        try:
-            data_emissao_dt = datetime.strptime(data_emissao, '%Y-%m-%d %H:%M:%S')
-            ocorrencia_data_entregue_dt = datetime.strptime(ocorrencia_data_entregue, '%Y-%m-%d %H:%M:%S')
+        data_emissao_dt = parse_timestamp(data_emissao)
+        ocorrencia_data_entregue_dt = parse_timestamp(ocorrencia_data_entregue)
+        if data_emissao_dt is not None and ocorrencia_data_entregue_dt is not None:
             result['LEADTIME'] = (ocorrencia_data_entregue_dt - data_emissao_dt).days
             result['situação_prazo'] = 'ENTREGUE NO PRAZO'
-        except ValueError:
-            pass
     return result
 
+# Versão em lote (reprocessamento): leadtime e situação do prazo de vários
+# CTRCs a partir das colunas de status, emissão e entrega, convertendo cada
+# data distinta uma vez só. Retorna [(LEADTIME, situação_prazo)].
+def calcular_leadtime_e_situacao_prazo_lote(statuses, datas_emissao, datas_entregue):
+    resultados = []
+    for status, data_emissao_dt, ocorrencia_data_entregue_dt in zip(
+            statuses, parse_timestamp_column(datas_emissao), parse_timestamp_column(datas_entregue)):
+        if status == "CANCELADO":
+            resultados.append((0, "CANCELADO"))
+        elif data_emissao_dt is not None and ocorrencia_data_entregue_dt is not None:
+            resultados.append(((ocorrencia_data_entregue_dt - data_emissao_dt).days, 'ENTREGUE NO PRAZO'))
+        else:
+            resultados.append((None, None))
+    return resultados
+
 def extrair_inicio_descricao(descricao):
     if not descricao:
         return "SEM DADOS"
@@ -320,21 +499,34 @@ def create_table(table_name):
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
+        columns_sql = ', '.join([f'"{column_mapping[col]}" {column_types[column_mapping[col]]}' for col in required_columns])
+        create_table_sql = f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            {columns_sql}
+        )
+        """
+        cursor.execute(create_table_sql)
         cursor.execute(f"PRAGMA table_info({table_name})")
         columns = [info[1] for info in cursor.fetchall()]
         if 'ultima_verificacao' not in columns:
             cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN ultima_verificacao TEXT')
         if 'rota' not in columns:
             cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN rota TEXT')
-        columns_sql = ', '.join([f'"{column_mapping[col]}" {column_types[col]}"' for col in required_columns])
-        create_table_sql = f"""
-        CREATE TABLE IF NOT EXISTS {table_name} (
-            {columns_sql}
+        if 'conteudo_hash' not in columns:
+            cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN conteudo_hash TEXT')
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table_name}_ocorrencias (
+            "CTRC_Identificador" TEXT NOT NULL,
+            "ordem" INTEGER NOT NULL,
+            "data_hora" TEXT,
+            "ocorrencia" TEXT,
+            "campos" TEXT,
+            PRIMARY KEY ("CTRC_Identificador", "ordem")
         )
-        """
-        cursor.execute(create_table_sql)
+        ''')
         conn.commit()
         conn.close()
+        refresh_scheduler.ensure_schema(db_path, table_name)
     except Exception as e:
         print(f"Erro ao criar tabela {table_name}: {e}")
 
@@ -362,6 +554,16 @@ def load_routes_data():
         routes_data = json.load(f)
     return routes_data
 
+# Mapeamentos de rota, montados uma vez por processo (antes o JSON de rotas
+# era relido a cada CTRC)
+_route_mappings = None
+
+def get_route_mappings():
+    global _route_mappings
+    if _route_mappings is None:
+        _route_mappings = create_route_mappings(load_routes_data())
+    return _route_mappings
+
 # Define cities to exclude from city-only fallback (customize as needed)
 CITIES_EXCLUDED_FROM_CITY_ONLY_FALLBACK = set()
 
@@ -433,8 +635,8 @@ def insert_data(extracted_data, table_name):
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        columns = ', '.join([f'"{column_mapping[col]}"' for col in required_columns])
-        placeholders = ', '.join(['?' for _ in required_columns])
+        columns = ', '.join([f'"{column_mapping[col]}"' for col in required_columns] + ['"next_due_at"', '"conteudo_hash"'])
+        placeholders = ', '.join(['?' for _ in required_columns] + ['?', '?'])
         insert_sql = f'INSERT OR IGNORE INTO {table_name} ({columns}) VALUES ({placeholders})'
         tz = pytz.timezone('America/Sao_Paulo')
         current_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
@@ -446,18 +648,61 @@ def insert_data(extracted_data, table_name):
             elif extracted_data[col] is None and col not in ['LEADTIME', 'situação_prazo', 'situacao_resumida', 'ultima_verificacao']:
                 extracted_data[col] = '' if 'Tentativas de Entrega' not in col else 0 if col == 'ocorrencia_data_Tentativas de Entrega' else None
         values = [extracted_data.get(col, '' if 'Tentativas de Entrega' not in col else 0 if col == 'ocorrencia_data_Tentativas de Entrega' else None) for col in required_columns]
-        cursor.execute(insert_sql, values)
-        conn.commit()
-        inserted_count = cursor.rowcount
+        values.append(refresh_scheduler.next_due_at(extracted_data.get('situacao_resumida'), current_time))
+        values.append(extracted_data.get('conteudo_hash'))
+        with perf_stats.timed('banco'):
+            cursor.execute(insert_sql, values)
+            inserted_count = cursor.rowcount
+            if inserted_count:
+                save_occurrences(cursor, table_name, extracted_data)
+            conn.commit()
         conn.close()
         return inserted_count
     except Exception as e:
         print(f"Erro ao inserir dados na tabela {table_name}: {e}")
         return 0
 
-def process_ctrc(filial, ctrc_number, cookies, headers):
-    local_cookies = deepcopy(cookies)
-    data = {
+# Eventos de rastreamento do CTRC (extracted_data['ocorrencias']) na tabela
+# {tabela}_ocorrencias, na ordem da página; substituem os gravados antes.
+# Sem a página de ocorrências (sem a chave), os eventos gravados ficam.
+def save_occurrences(cursor, table_name, extracted_data):
+    events = extracted_data.get('ocorrencias')
+    if events is None:
+        return
+    ctrc_identificador = extracted_data['CTRC_Identificador']
+    cursor.execute(f'DELETE FROM {table_name}_ocorrencias WHERE "CTRC_Identificador" = ?', (ctrc_identificador,))
+    cursor.executemany(f'''
+    INSERT INTO {table_name}_ocorrencias ("CTRC_Identificador", "ordem", "data_hora", "ocorrencia", "campos")
+    VALUES (?, ?, ?, ?, ?)
+    ''', [(ctrc_identificador, order, event.get('data_hora', ''), event.get('f10', ''), json.dumps(event, ensure_ascii=False))
+          for order, event in enumerate(events)])
+
+# Insere vários CTRCs numa única transação
+def insert_data_batch(batch):
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        with perf_stats.timed('banco'):
+            for extracted_data, table_name in batch:
+                columns = ', '.join([f'"{column_mapping[col]}"' for col in required_columns] + ['"next_due_at"', '"conteudo_hash"'])
+                placeholders = ', '.join(['?' for _ in required_columns] + ['?', '?'])
+                insert_sql = f'INSERT OR IGNORE INTO {table_name} ({columns}) VALUES ({placeholders})'
+                values = [extracted_data.get(col, '' if 'Tentativas de Entrega' not in col else 0 if col == 'ocorrencia_data_Tentativas de Entrega' else None) for col in required_columns]
+                values.append(refresh_scheduler.next_due_at(extracted_data.get('situacao_resumida'), extracted_data.get('ultima_verificacao')))
+                values.append(extracted_data.get('conteudo_hash'))
+                cursor.execute(insert_sql, values)
+                if cursor.rowcount:
+                    save_occurrences(cursor, table_name, extracted_data)
+            conn.commit()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Erro ao inserir dados em lote: {e}")
+        return False
+
+# Formulário da consulta de um CTRC (act=P1) no ssw0053
+def build_p1_payload(filial, ctrc_number):
+    return {
         'act': 'P1',
         't_ser_ctrc': filial['serie'],
         't_nro_ctrc': str(ctrc_number),
@@ -470,101 +715,236 @@ def process_ctrc(filial, ctrc_number, cookies, headers):
         'FAMILIA': '',
         'dummy': str(int(time.time() * 1000)),
     }
+
+# Cache de CTRCs inexistentes; criado em main()
+negative_cache = None
+
+# Arquivo das respostas brutas do SSW; criado em setup_ingestao() se configurado
+html_archive = None
+
+# Controle adaptativo da concorrência por filial; criado em setup_ingestao()
+concurrency_controller = None
+
+# Leases das filiais entre os workers; criado em main() se shards_ativo
+shard_leases = None
+
+# Fila de trabalho persistente (descoberta, busca, lacunas); criada em main()
+job_queue = None
+
+# Sondagem leve: só a consulta act=P1, para saber se o CTRC existe
+def probe_ctrc(filial, ctrc_number, cookies, headers):
+    if negative_cache is not None and negative_cache.contains(filial['serie'], ctrc_number):
+        return False
+    with ssw_http.request_context(serie=filial['serie'], ctrc=ctrc_number):
+        response = ssw_http.post(ssw_http.ssw_url('ssw0053'), coalesce=True, cookies=cookies, headers=headers, data=build_p1_payload(filial, ctrc_number))
+    response.raise_for_status()
+    exists = not ("CTRC não encontrado" in response.text or not response.text.strip())
+    if not exists and negative_cache is not None:
+        negative_cache.add(filial['serie'], ctrc_number)
+    return exists
+
+def process_ctrc(filial, ctrc_number, cookies, headers):
+    status, extracted_data = fetch_ctrc(filial, ctrc_number, cookies, headers)
+    return extracted_data, filial
+
+# Como process_ctrc, mas distingue CTRC inexistente de falha na consulta.
+# Retorna (status, dados) com status 'ok', 'ausente', 'erro' ou, quando
+# known_fingerprint/known_seq_ctrc são informados e as páginas não mudaram,
+# 'inalterado' (dados só com o conteudo_hash; nada é parseado).
+# Busca e parse na mesma thread; na ingestão o parse roda no pool de
+# processos (fetch_ctrc_pages + parse_ctrc_pages pelo ParsePipeline).
+def fetch_ctrc(filial, ctrc_number, cookies, headers, known_fingerprint=None, known_seq_ctrc=None):
+    status, pages = fetch_ctrc_pages(filial, ctrc_number, cookies, headers, known_fingerprint, known_seq_ctrc)
+    if status != 'paginas':
+        return status, pages
+    status, extracted_data = parse_ctrc_pages(pages)
+    if status == 'refazer':
+        # A leitura rápida errou a Sequência CTRC: baixa de novo com a do parse
+        status, pages = fetch_ctrc_pages(filial, ctrc_number, cookies, headers, seq_ctrc=extracted_data)
+        if status != 'paginas':
+            return status, pages
+        status, extracted_data = parse_ctrc_pages(pages)
+    if status == 'refazer':
+        return 'erro', None
+    return status, extracted_data
+
+# Etapa de rede da consulta de um CTRC: baixa as páginas act=P1, A e O sem
+# parsear. Retorna (status, dados) com status 'paginas' (dados = dicionário
+# para parse_ctrc_pages), 'ausente', 'erro' ou 'inalterado' (como fetch_ctrc).
+# seq_ctrc força a Sequência CTRC; sem ela, vem da leitura rápida da P1.
+def fetch_ctrc_pages(filial, ctrc_number, cookies, headers, known_fingerprint=None, known_seq_ctrc=None, seq_ctrc=None):
+    if negative_cache is not None and negative_cache.contains(filial['serie'], ctrc_number):
+        return 'ausente', None
+    # As requisições feitas daqui em diante ficam associadas à filial/CTRC
+    budget = RetryBudget(ingestao_config['retentativas_por_ctrc'])
+    with ssw_http.request_context(serie=filial['serie'], ctrc=ctrc_number, retry_budget=budget):
+        status, pages = _fetch_ctrc_pages(filial, ctrc_number, cookies, headers, budget, known_fingerprint, known_seq_ctrc, seq_ctrc)
+    if status == 'ausente' and negative_cache is not None:
+        negative_cache.add(filial['serie'], ctrc_number)
+    return status, pages
+
+def _fetch_ctrc_pages(filial, ctrc_number, cookies, headers, budget, known_fingerprint=None, known_seq_ctrc=None, seq_ctrc=None):
+    local_cookies = deepcopy(cookies)
+    data = build_p1_payload(filial, ctrc_number)
     attempt = 0
     max_attempts = 3
-    extracted_data = None
     while attempt < max_attempts:
+        # Falhas de rede já foram repetidas pelo ssw_http; aqui só se repete a
+        # leitura da página, com espera e dentro do orçamento do CTRC
+        if attempt > 0:
+            if not budget.consume():
+                break
+            time.sleep(backoff_delay(attempt - 1))
         try:
-            response = requests.post('https://sistema.ssw.inf.br/bin/ssw0053', cookies=local_cookies, headers=headers, data=data)
+            response = ssw_http.post(ssw_http.ssw_url('ssw0053'), coalesce=True, cookies=local_cookies, headers=headers, data=data)
             response.raise_for_status()
         except requests.exceptions.RequestException:
             attempt += 1
             continue
         if "CTRC não encontrado" in response.text or not response.text.strip():
-            return None, filial
-        try:
-            extracted_data = extract_data_from_html(response.text)
-            if extracted_data is None:
-                attempt += 1
-                continue
-        except Exception:
+            return 'ausente', None
+        # Página incompleta (sem o número do CTRC): lê de novo
+        if not is_ctrc_page(response.text):
             attempt += 1
             continue
-        seq_ctrc = extracted_data.get('Sequência CTRC', '')
-        if seq_ctrc:
+        occurrences_html = None
+        if known_fingerprint and known_seq_ctrc:
             try:
-                chave_nf = extract_nf_key(local_cookies, headers, seq_ctrc)
-                extracted_data['Chave NF'] = chave_nf if chave_nf else ''
+                occurrences_html = fetch_occurrences_html(local_cookies, headers, known_seq_ctrc)
             except Exception:
-                extracted_data['Chave NF'] = ''
+                occurrences_html = None
+            fingerprint = page_fingerprint(response.text, occurrences_html)
+            if fingerprint == known_fingerprint:
+                return 'inalterado', {'conteudo_hash': fingerprint}
+        if seq_ctrc is None:
+            seq_ctrc = peek_seq_ctrc(response.text)
+        pages = {'P1': response.text, 'A': None, 'O': None, 'seq_ctrc': seq_ctrc, 'tentativas': attempt + 1}
         if seq_ctrc:
             try:
-                extracted_data['Comprovante de Entrega'] = check_delivery_receipt(local_cookies, headers, seq_ctrc) or 'NAO'
-            except Exception:
-                extracted_data['Comprovante de Entrega'] = 'NAO'
+                pages['A'] = fetch_nf_html(local_cookies, headers, seq_ctrc)
+            except Exception as e:
+                print(f"Erro ao extrair chave NF: {e}")
+            # Comprovante e rastreamento vêm da mesma página de ocorrências
+            # (já baixada na comparação da impressão digital, se for o caso)
+            try:
+                if occurrences_html is None or seq_ctrc != known_seq_ctrc:
+                    occurrences_html = fetch_occurrences_html(local_cookies, headers, seq_ctrc)
+                pages['O'] = occurrences_html
+            except Exception as e:
+                print(f"Erro ao extrair ocorrências: {e}")
+        return 'paginas', pages
+    return 'erro', None
+
+# Etapa de CPU: monta o registro a partir das páginas de fetch_ctrc_pages.
+# Não faz requisições, então roda também nos processos do ParsePipeline e no
+# reprocessamento (reparse.py). Retorna ('ok', dados), ('erro', None) ou
+# ('refazer', seq_ctrc) quando a Sequência CTRC do parse não é a usada na busca.
+def parse_ctrc_pages(pages):
+    try:
+        with perf_stats.timed('parse'):
+            extracted_data = extract_data_from_html(pages['P1'])
+    except Exception:
+        return 'erro', None
+    if extracted_data is None:
+        return 'erro', None
+    seq_ctrc = extracted_data.get('Sequência CTRC', '')
+    if pages.get('seq_ctrc') is not None and seq_ctrc != pages['seq_ctrc']:
+        return 'refazer', seq_ctrc
+    occurrences_html = pages.get('O') if seq_ctrc else None
+    if seq_ctrc:
+        extracted_data['Chave NF'] = parse_nf_key(pages['A']) if pages.get('A') else ''
         try:
-            tracking_info = extract_tracking_info(local_cookies, headers, seq_ctrc)
-            if tracking_info:
-                extracted_data.update(tracking_info)
-            else:
-                tracking_fields = [
-                    'ocorrencia_data_Data de Emissão CTRC', 'ocorrencia_data_Saída de Unidade',
-                    'ocorrencia_data_Chegada em Unidade de Entrega', 'ocorrencia_data_Saída para Entrega',
-                    'ocorrencia_data_Entregue', 'ocorrencia_data_Tentativas de Entrega', 'Previsão Entrega'
-                ]
-                for field in tracking_fields:
-                    extracted_data[field] = 0 if field == 'ocorrencia_data_Tentativas de Entrega' else ''
-        except Exception:
-            tracking_fields = [
-                'ocorrencia_data_Data de Emissão CTRC', 'ocorrencia_data_Saída de Unidade',
-                'ocorrencia_data_Chegada em Unidade de Entrega', 'ocorrencia_data_Saída para Entrega',
-                'ocorrencia_data_Entregue', 'ocorrencia_data_Tentativas de Entrega', 'Previsão Entrega'
-            ]
-            for field in tracking_fields:
-                extracted_data[field] = 0 if field == 'ocorrencia_data_Tentativas de Entrega' else ''
-        break
-    if extracted_data:
-        if 'Unidade Emissor' in extracted_data and 'N° CTRC' in extracted_data:
-            extracted_data['CTRC_Identificador'] = f"{extracted_data['Unidade Emissor']}{extracted_data['N° CTRC']}"
-        else:
-            return None, filial
-        extracted_data['tentativas_dados'] = attempt + 1
-
-        # Carregar os dados de rotas e criar os mapeamentos
-        routes_data = load_routes_data()
-        cep_to_route_map, uf_cidade_bairro_to_route_map, uf_cidade_to_route_map = create_route_mappings(routes_data)
-
-        # Buscar a rota com base nos dados do registro
-        entrega_cep_db = extracted_data.get('Entrega_CEP', '')
-        destino_uf_db = extracted_data.get('Destino_UF', '')
-        destino_cidade_db = extracted_data.get('Destino_Cidade', '')
-        entrega_bairro_db = extracted_data.get('Entrega_Bairro', '')
-
-        found_route = find_route(entrega_cep_db, destino_uf_db, destino_cidade_db, entrega_bairro_db, cep_to_route_map, uf_cidade_bairro_to_route_map, uf_cidade_to_route_map)
-
-        if found_route:
-            extracted_data['rota'] = found_route
+            comprovante, tracking_info = parse_occurrences(occurrences_html) if occurrences_html else ('NAO', None)
+        except Exception as e:
+            print(f"Erro ao extrair ocorrências: {e}")
+            occurrences_html = None
+            comprovante, tracking_info = 'NAO', None
+        extracted_data['Comprovante de Entrega'] = comprovante or 'NAO'
+    else:
+        tracking_info = empty_tracking_data()
+    extracted_data['conteudo_hash'] = page_fingerprint(pages['P1'], occurrences_html)
+    apply_tracking(extracted_data, tracking_info)
+    if not finish_record(extracted_data):
+        return 'erro', None
+    if 'tentativas' in pages:
+        extracted_data['tentativas_dados'] = pages['tentativas']
+    return 'ok', extracted_data
+
+TRACKING_FIELDS = [
+    'ocorrencia_data_Data de Emissão CTRC', 'ocorrencia_data_Saída de Unidade',
+    'ocorrencia_data_Chegada em Unidade de Entrega', 'ocorrencia_data_Saída para Entrega',
+    'ocorrencia_data_Entregue', 'ocorrencia_data_Tentativas de Entrega', 'Previsão Entrega'
+]
 
-    return extracted_data, filial
+# Copia as datas de rastreamento para o registro; sem rastreamento, os
+# campos ficam vazios (tentativas = 0)
+def apply_tracking(extracted_data, tracking_info):
+    if tracking_info:
+        extracted_data.update(tracking_info)
+    else:
+        for field in TRACKING_FIELDS:
+            extracted_data[field] = 0 if field == 'ocorrencia_data_Tentativas de Entrega' else ''
 
-def check_and_fill_gaps(filial, cookies, headers):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    query = f'SELECT "{column_mapping["N° CTRC"]}" FROM {filial["table"]} ORDER BY CAST("{column_mapping["N° CTRC"]}" AS INTEGER)'
-    cursor.execute(query)
-    results = cursor.fetchall()
-    processed_ctrcs = [int(result[0]) for result in results]
-    if processed_ctrcs:
-        processed_ctrcs.sort()
-        gaps = []
-        for i in range(1, len(processed_ctrcs)):
-            if processed_ctrcs[i] - processed_ctrcs[i-1] > 1:
-                gaps.extend(range(processed_ctrcs[i-1] + 1, processed_ctrcs[i]))
-        for ctrc_number in gaps:
-            extracted_data, _ = process_ctrc(filial, ctrc_number, cookies, headers)
-            if extracted_data:
-                insert_data(extracted_data, filial['table'])
-    conn.close()
+# Completa o registro extraído da página com o identificador e a rota.
+# Retorna False se a página não trouxe a unidade e o número do CTRC.
+def finish_record(extracted_data):
+    if 'Unidade Emissor' not in extracted_data or 'N° CTRC' not in extracted_data:
+        return False
+    extracted_data['CTRC_Identificador'] = f"{extracted_data['Unidade Emissor']}{extracted_data['N° CTRC']}"
+
+    # Buscar a rota com base nos dados do registro
+    cep_to_route_map, uf_cidade_bairro_to_route_map, uf_cidade_to_route_map = get_route_mappings()
+    found_route = find_route(
+        extracted_data.get('Entrega CEP', ''), extracted_data.get('Destino UF', ''),
+        extracted_data.get('Destino Cidade', ''), extracted_data.get('Entrega Bairro', ''),
+        cep_to_route_map, uf_cidade_bairro_to_route_map, uf_cidade_to_route_map,
+    )
+    if found_route:
+        extracted_data['rota'] = found_route
+    return True
+
+# Situação resumida de um CTRC
+def derive_situacao_resumida(descricao_situacao, status, destino_codigo):
+    if status == "CANCELADO":
+        return "CANCELADO"
+    inicio_descricao = extrair_inicio_descricao(descricao_situacao)
+    if inicio_descricao == "CT-E AUTORIZADO COM":
+        return "DISPONÍVEL PARA ENTREGA" if destino_codigo == "VNA" else f"AGATD. TRANSF, DA UN VNA PARA UNIDADE DE {destino_codigo}"
+    return situacao_resumida_rules.get(inicio_descricao, "OUTRO")
+
+# Situação resumida, leadtime e situação do prazo de um CTRC
+def derive_situacao(descricao_situacao, status, destino_codigo, data_emissao, ocorrencia_data_entregue):
+    situacao_resumida = derive_situacao_resumida(descricao_situacao, status, destino_codigo)
+    if status == "CANCELADO":
+        return situacao_resumida, 0, "CANCELADO"
+    resultado = calcular_leadtime_e_situacao_prazo(data_emissao, ocorrencia_data_entregue)
+    return situacao_resumida, resultado['LEADTIME'], resultado['situação_prazo']
+
+def correct_bairro(bairro):
+    return corrections.get(bairro, bairro) if bairro else bairro
+
+# Preenche as lacunas de CTRCs das filiais em segundo plano, pelo motor de
+# coleta (mesmos limites de taxa da ingestão), sem atrasar a busca de novos.
+# filiais pode ser uma função (filiais deste worker a cada passada).
+def check_and_fill_gaps(filiais, cookies, headers, engine):
+    def fetch(filial, ctrc_number):
+        return fetch_ctrc(filial, ctrc_number, cookies, headers)
+
+    def insert(filial, rows):
+        current_time = datetime.now(pytz.timezone('America/Sao_Paulo')).strftime('%Y-%m-%d %H:%M:%S')
+        for extracted_data in rows:
+            extracted_data['ultima_verificacao'] = current_time
+        insert_data_batch([(extracted_data, filial['table']) for extracted_data in rows])
+        # Registros novos já vencem para a reconsulta
+        loop_wakeup.set()
+
+    backfiller = GapBackfiller(
+        db_path, engine, fetch, insert, column_mapping['N° CTRC'],
+        negative_cache=negative_cache,
+        chunk_size=ingestao_config['lacunas_bloco'],
+    )
+    backfiller.start(filiais, interval=ingestao_config['lacunas_intervalo'], job_queue=job_queue)
+    return backfiller
 
 # Função auxiliar para depuração de datas
 def debug_datetime_comparison(filial):
@@ -609,69 +989,41 @@ def clean_invalid_ultima_verificacao(filial):
         print(f"Erro ao corrigir ultima_verificacao para {filial['serie']}: {e}")
 
 class ExistingDataHandler:
-    def __init__(self, filiais, cookies, headers):
+    def __init__(self, filiais, cookies, headers, engine, pipeline):
         self.filiais = filiais
         self.cookies = cookies
         self.headers = headers
+        self.engine = engine
+        self.pipeline = pipeline
 
-    def update_existing_records(self):
+    def update_existing_records(self, filiais=None):
         updated_total = 0
         tz = pytz.timezone('America/Sao_Paulo')
 
-        for filial in self.filiais:
+        for filial in (self.filiais if filiais is None else filiais):
             try:
-                clean_invalid_ultima_verificacao(filial)
-                debug_datetime_comparison(filial)
-
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                query = f'''
-                SELECT "N__CTRC", "Unidade_Emissor", "CTRC_Identificador", "situacao_resumida",
-                    {', '.join([f'"{column_mapping[col]}"' for col in required_columns])}
-                FROM {filial['table']}
-                WHERE (
-                    "situacao_resumida" IN (
-                        SELECT key FROM (SELECT json_object(
-                            {', '.join([f'"{k}", {v}' for k, v in update_intervals.items() if v != 0])}
-                        ) AS dict) AS temp,
-                        json_each(dict, '$') AS entry
-                    )
-                    OR "situacao_resumida" IS NULL
-                    OR "situacao_resumida" = ''
-                    OR "situacao_resumida" NOT IN (
-                        SELECT key FROM (SELECT json_object(
-                            {', '.join([f'"{k}", {v}' for k, v in update_intervals.items()])}
-                        ) AS dict) AS temp,
-                        json_each(dict, '$') AS entry
-                    )
-                )
-                AND (
-                    "ultima_verificacao" IS NULL
-                    OR datetime("ultima_verificacao") < datetime('now', 'localtime', '-' || (
-                        SELECT COALESCE((
-                            SELECT value FROM (SELECT json_object(
-                                {', '.join([f'"{k}", {v}' for k, v in update_intervals.items()])}
-                            ) AS dict) AS temp,
-                            json_each(dict, '$') AS entry
-                            WHERE key = "situacao_resumida"
-                        ), 30)  -- Intervalo padrão de 30 minutos para situações não listadas
-                    ) || ' minutes')
-                    OR "situacao_resumida" IS NULL
-                    OR "situacao_resumida" = ''
-                )
-                '''
-                cursor.execute(query)
-                records = cursor.fetchall()
-                conn.close()
+                # Só os registros vencidos, do mais urgente para o menos urgente
+                columns = ['"N__CTRC"', '"Unidade_Emissor"', '"CTRC_Identificador"', '"situacao_resumida"', '"conteudo_hash"'] + [f'"{column_mapping[col]}"' for col in required_columns]
+                records = refresh_scheduler.due_records(db_path, filial['table'], columns, ingestao_config['atualizacao_lote'])
                 print(f"Filial {filial['serie']}: Encontrados {len(records)} registros para atualização.")
 
-                updated_count = 0
-                with ThreadPoolExecutor(max_workers=10) as executor:
-                    tasks = {executor.submit(self.process_record, filial, record, tz): record for record in records}
-                    for future in as_completed(tasks):
-                        result = future.result()
-                        if result:
-                            updated_count += 1
+                # Rede no motor de coleta, parse no pool de processos e a
+                # comparação com o banco numa única thread de gravação
+                tasks = []
+                records_by_args = {}
+                for record in records:
+                    args = self.fetch_args(filial, record)
+                    records_by_args[id(args)] = record
+                    tasks.append((filial, fetch_ctrc_pages, args))
+                updated = []
+
+                def write(batch):
+                    for (_, _, args), status, extracted_data in batch:
+                        if self.apply_refresh(filial, records_by_args[id(args)], tz, status, extracted_data):
+                            updated.append(args[1])
+
+                self.pipeline.run(tasks, write_fn=write)
+                updated_count = len(updated)
                 print(f"Filial {filial['serie']}: {updated_count} registros atualizados.")
                 updated_total += updated_count
             except Exception as e:
@@ -683,20 +1035,41 @@ class ExistingDataHandler:
                         pass
         return updated_total
 
-    def process_record(self, filial, record, tz):
+    # Argumentos de fetch_ctrc_pages para reconsultar um registro. Com a
+    # impressão digital da última consulta, páginas iguais voltam como
+    # 'inalterado' sem parse
+    def fetch_args(self, filial, record):
+        ctrc_number, unidade_emissor, ctrc_identificador, situacao_resumida, conteudo_hash = record[:5]
+        existing_data = dict(zip([column_mapping[col] for col in required_columns], record[5:]))
+        return (filial, ctrc_number, self.cookies, self.headers,
+                conteudo_hash if situacao_resumida else None, existing_data.get('Sequência_CTRC'))
+
+    # Compara o resultado da reconsulta com o registro e grava as mudanças
+    def apply_refresh(self, filial, record, tz, status, extracted_data):
         try:
-            ctrc_number, unidade_emissor, ctrc_identificador, situacao_resumida = record[:4]
-            existing_data = dict(zip([column_mapping[col] for col in required_columns], record[4:]))
+            ctrc_number, unidade_emissor, ctrc_identificador, situacao_resumida, conteudo_hash = record[:5]
+            existing_data = dict(zip([column_mapping[col] for col in required_columns], record[5:]))
 
-            extracted_data, _ = process_ctrc(filial, ctrc_number, self.cookies, self.headers)
+            if status == 'inalterado':
+                self.mark_checked(filial, ctrc_identificador, situacao_resumida, datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S'))
+                return False
             if extracted_data:
                 current_time = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
                 extracted_data['ultima_verificacao'] = current_time
                 extracted_data['CTRC_Identificador'] = ctrc_identificador
+                if 'ocorrencias' in extracted_data:
+                    conn = sqlite3.connect(db_path)
+                    with perf_stats.timed('banco'):
+                        save_occurrences(conn.cursor(), filial['table'], extracted_data)
+                        conn.commit()
+                    conn.close()
 
                 needs_update = False
                 for key in required_columns:
-                    if key != 'ultima_verificacao' and extracted_data.get(key) != existing_data.get(key):
+                    if key in DERIVED_COLUMNS:
+                        continue
+                    new_value, old_value = extracted_data.get(key), existing_data.get(column_mapping[key])
+                    if ('' if new_value is None else str(new_value)) != ('' if old_value is None else str(old_value)):
                         needs_update = True
                         break
 
@@ -704,16 +1077,18 @@ class ExistingDataHandler:
                 if not situacao_resumida or needs_update:
                     conn = sqlite3.connect(db_path)
                     cursor = conn.cursor()
-                    columns = ', '.join([f'"{column_mapping[col]}" = ?' for col in required_columns if col != 'CTRC_Identificador'])
+                    columns = ', '.join([f'"{column_mapping[col]}" = ?' for col in required_columns if col != 'CTRC_Identificador'] + ['"conteudo_hash" = ?'])
                     update_sql = f'''
                     UPDATE {filial['table']}
                     SET {columns}
                     WHERE "CTRC_Identificador" = ?
                     '''
                     values = [extracted_data.get(col, '' if 'Tentativas de Entrega' not in col else 0 if col == 'ocorrencia_data_Tentativas de Entrega' else None) for col in required_columns if col != 'CTRC_Identificador']
+                    values.append(extracted_data.get('conteudo_hash'))
                     values.append(ctrc_identificador)
-                    cursor.execute(update_sql, values)
-                    conn.commit()
+                    with perf_stats.timed('banco'):
+                        cursor.execute(update_sql, values)
+                        conn.commit()
 
                     cursor.execute(f'''
                     SELECT "Descrição_Situação", "Previsão_Entrega", "ocorrencia_data_Entregue",
@@ -726,23 +1101,13 @@ class ExistingDataHandler:
                     updated_record = cursor.fetchone()
                     if updated_record:
                         descricao_situacao, previsao_entrega, ocorrencia_data_entregue, remetente_bairro, destinatario_bairro, entrega_bairro, data_emissao, situacao_resumida_atual, status, destino_codigo = updated_record
-                        remetente_bairro = corrections.get(remetente_bairro, remetente_bairro) if remetente_bairro else remetente_bairro
-                        destinatario_bairro = corrections.get(destinatario_bairro, destinatario_bairro) if destinatario_bairro else destinatario_bairro
-                        entrega_bairro = corrections.get(entrega_bairro, entrega_bairro) if entrega_bairro else entrega_bairro
-
-                        if status == "CANCELADO":
-                            situacao_resumida = "CANCELADO"
-                            leadtime = 0
-                            situacao_prazo = "CANCELADO"
-                        else:
-                            inicio_descricao = extrair_inicio_descricao(descricao_situacao)
-                            if inicio_descricao == "CT-E AUTORIZADO COM":
-                                situacao_resumida = "DISPONÍVEL PARA ENTREGA" if destino_codigo == "VNA" else f"AGATD. TRANSF, DA UN VNA PARA UNIDADE DE {destino_codigo}"
-                            else:
-                                situacao_resumida = situacao_resumida_rules.get(inicio_descricao, "OUTRO")
-                            resultado = calcular_leadtime_e_situacao_prazo(data_emissao, ocorrencia_data_entregue)
-                            leadtime = resultado['LEADTIME']
-                            situacao_prazo = resultado['situação_prazo']
+                        remetente_bairro = correct_bairro(remetente_bairro)
+                        destinatario_bairro = correct_bairro(destinatario_bairro)
+                        entrega_bairro = correct_bairro(entrega_bairro)
+
+                        situacao_resumida, leadtime, situacao_prazo = derive_situacao(
+                            descricao_situacao, status, destino_codigo, data_emissao, ocorrencia_data_entregue
+                        )
 
                         changes = {}
                         if leadtime != existing_data['LEADTIME']:
@@ -758,18 +1123,20 @@ class ExistingDataHandler:
                         if entrega_bairro != existing_data['Entrega_Bairro']:
                             changes['Entrega_Bairro'] = {'antes': existing_data['Entrega_Bairro'], 'depois': entrega_bairro}
 
-                        cursor.execute(f'''
-                        UPDATE {filial['table']}
-                        SET "LEADTIME" = ?, "situação_prazo" = ?, "situacao_resumida" = ?,
-                            "Remetente_Bairro" = ?, "Destinatário_Bairro" = ?, "Entrega_Bairro" = ?,
-                            "ultima_verificacao" = ?
-                        WHERE "CTRC_Identificador" = ?
-                        ''', (
-                            leadtime, situacao_prazo, situacao_resumida,
-                            remetente_bairro, destinatario_bairro, entrega_bairro,
-                            current_time, ctrc_identificador
-                        ))
-                        conn.commit()
+                        with perf_stats.timed('banco'):
+                            cursor.execute(f'''
+                            UPDATE {filial['table']}
+                            SET "LEADTIME" = ?, "situação_prazo" = ?, "situacao_resumida" = ?,
+                                "Remetente_Bairro" = ?, "Destinatário_Bairro" = ?, "Entrega_Bairro" = ?,
+                                "ultima_verificacao" = ?, "next_due_at" = ?
+                            WHERE "CTRC_Identificador" = ?
+                            ''', (
+                                leadtime, situacao_prazo, situacao_resumida,
+                                remetente_bairro, destinatario_bairro, entrega_bairro,
+                                current_time, refresh_scheduler.next_due_at(situacao_resumida, current_time),
+                                ctrc_identificador
+                            ))
+                            conn.commit()
 
                         if changes:
                             print(f"Filial {filial['serie']}: CTRC {unidade_emissor} {ctrc_number} atualizado com alterações: {changes}")
@@ -778,6 +1145,16 @@ class ExistingDataHandler:
                         conn.close()
                         return True
                     conn.close()
+            if extracted_data:
+                # Páginas mudaram, mas não os campos: guarda a impressão digital nova
+                self.mark_checked(filial, ctrc_identificador, situacao_resumida, extracted_data['ultima_verificacao'], extracted_data.get('conteudo_hash'))
+            else:
+                # Sem resposta do SSW: só agenda a próxima tentativa
+                conn = sqlite3.connect(db_path)
+                with perf_stats.timed('banco'):
+                    refresh_scheduler.reschedule(conn.cursor(), filial['table'], ctrc_identificador, situacao_resumida)
+                    conn.commit()
+                conn.close()
             return False
         except Exception as e:
             print(f"Erro ao processar CTRC {unidade_emissor} {ctrc_number}: {e}")
@@ -788,65 +1165,130 @@ class ExistingDataHandler:
                     pass
             return False
 
+    # Registro consultado sem alterações: só atualiza os dados de verificação
+    def mark_checked(self, filial, ctrc_identificador, situacao_resumida, checked_at, conteudo_hash=None):
+        conn = sqlite3.connect(db_path)
+        with perf_stats.timed('banco'):
+            conn.execute(f'''
+            UPDATE {filial['table']}
+            SET "ultima_verificacao" = ?, "next_due_at" = ?, "conteudo_hash" = COALESCE(?, "conteudo_hash")
+            WHERE "CTRC_Identificador" = ?
+            ''', (checked_at, refresh_scheduler.next_due_at(situacao_resumida, checked_at), conteudo_hash, ctrc_identificador))
+            conn.commit()
+        conn.close()
+
 class NewDataHandler:
-    def __init__(self, filiais, cookies, headers):
+    def __init__(self, filiais, cookies, headers, engine, pipeline, job_queue):
         self.filiais = filiais
         self.cookies = cookies
         self.headers = headers
-
-    def process_new_data(self):
+        self.engine = engine
+        self.pipeline = pipeline
+        self.job_queue = job_queue
+
+    # Maior CTRC existente da filial, por galope + busca binária a partir da
+    # marca d'água (filial['current_number'])
+    def discover_head(self, filial):
+        def probe(ctrc_number):
+            return probe_ctrc(filial, ctrc_number, self.cookies, self.headers)
+        return find_head(probe, filial['current_number'], window=ingestao_config['descoberta_janela'])
+
+    def process_new_data(self, filiais=None):
+        current_time = time.time()
+        filiais = [filial for filial in (self.filiais if filiais is None else filiais) if filial['active'] and current_time >= filial['pause_until']]
+
+        # Descobre o último CTRC de cada filial (filiais sondadas em paralelo)
+        heads = {}
+        for (filial, _, _), head in self.engine.run([(filial, self.discover_head, (filial,)) for filial in filiais]):
+            if head is not None:
+                if negative_cache is not None:
+                    negative_cache.set_head(filial['serie'], head)
+                heads[filial['serie']] = min(head, filial['current_number'] + ingestao_config['descoberta_max_por_ciclo'])
+
+        # A faixa entre a posição da filial e o último CTRC vai para a fila
+        # persistente, um job 'busca' por CTRC; a marca d'água só avança
+        # depois das buscas (run_fetch_jobs)
+        for filial in filiais:
+            filial['last_attempt_time'] = current_time
+            head = heads.get(filial['serie'])
+            if head is None or head <= filial['current_number']:
+                print(f"Nenhum dado novo encontrado para a filial {filial['serie']} após o CTRC {filial['current_number']}")
+                filial['consecutive_empty'] += 1
+                if filial['consecutive_empty'] >= MAX_NO_DATA_ATTEMPTS:
+                    filial['pause_until'] = current_time + PAUSE_DURATION
+                    print(f"Filial {filial['serie']} pausada até {datetime.fromtimestamp(filial['pause_until']).strftime('%Y-%m-%d %H:%M:%S')}.")
+                continue
+            print(f"Filial {filial['serie']}: buscando CTRCs {filial['current_number'] + 1} a {head}.")
+            self.job_queue.enqueue_many('busca', [(f"{filial['serie']}:{ctrc_number}", filial['serie'], {'numero': ctrc_number})
+                                                  for ctrc_number in range(filial['current_number'] + 1, head + 1)])
+            filial['current_number'] = head
+            filial['consecutive_empty'] = 0
+            filial['pause_until'] = 0
+
+        return self.run_fetch_jobs(filiais)
+
+    # Busca os CTRCs da fila das filiais (faixas descobertas, retentativas e
+    # o que ficou de uma execução interrompida), em lotes: páginas baixadas
+    # pelo motor de coleta, parse no pool de processos e gravação numa única
+    # thread. O job só é concluído depois de gravado o CTRC; os com erro
+    # voltam para a fila e, esgotadas as tentativas, ficam como 'falhou':
+    # o preenchimento de lacunas tenta esses números de novo a cada passada.
+    def run_fetch_jobs(self, filiais):
+        by_serie = {filial['serie']: filial for filial in filiais}
         new_data_found = False
-        batch_size = 10  # Aumentar o tamanho do lote
-        batch = []
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            tasks = {}
-            for filial in self.filiais:
-                # Processar múltiplos CTRCs de uma vez
-                for i in range(batch_size):  # Processar 10 CTRCs de uma vez
-                    tasks[executor.submit(process_ctrc, filial, filial['current_number'] + i, self.cookies, self.headers)] = filial
-
-            for future in as_completed(tasks):
-                result, filial = future.result()
-                current_time = time.time()
-                filial['last_attempt_time'] = current_time
-                if result is not None:
-                    new_data_found = True
-                    tz = pytz.timezone('America/Sao_Paulo')
-                    current_time_str = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
-                    result['ultima_verificacao'] = current_time_str
-                    batch.append((result, filial['table']))
-                    filial['consecutive_empty'] = 0
-                    filial['pause_until'] = 0
-                    print(f"Filial: {filial['serie']}, CTRC: {result.get('N° CTRC', 'N/A')}, Remetente: {result.get('Remetente Nome', 'N/A')}, NF: {result.get('Número Nota Fiscal', 'N/A')}")
-                    filial['current_number'] += 1
-                else:
-                    print(f"Nenhum dado novo encontrado para a filial {filial['serie']} no CTRC {filial['current_number']}")
-                    filial['consecutive_empty'] += 1
-                    if filial['consecutive_empty'] >= MAX_NO_DATA_ATTEMPTS:
-                        filial['pause_until'] = current_time + PAUSE_DURATION
-                        print(f"Filial {filial['serie']} pausada até {datetime.fromtimestamp(filial['pause_until']).strftime('%Y-%m-%d %H:%M:%S')}.")
-
-        # Inserir dados em lote
-        if batch:
-            self.insert_data_batch(batch)
-
-        return new_data_found
+        while True:
+            jobs = self.job_queue.dequeue('busca', groups=list(by_serie), limit=ingestao_config['fila_lote'])
+            if not jobs:
+                self.advance_watermarks(filiais)
+                return new_data_found
+            tasks = []
+            jobs_by_args = {}
+            for job in jobs:
+                filial = by_serie[job['grupo']]
+                args = (filial, job['payload']['numero'], self.cookies, self.headers)
+                jobs_by_args[id(args)] = job
+                tasks.append((filial, fetch_ctrc_pages, args))
+
+            def write(batch):
+                rows = []
+                done = []
+                failed = []
+                tz = pytz.timezone('America/Sao_Paulo')
+                for (filial, _, args), status, result in batch:
+                    job_id = jobs_by_args[id(args)]['id']
+                    if concurrency_controller is not None:
+                        concurrency_controller.observe_result(filial['serie'], status)
+                    if status == 'ok' and result:
+                        result['ultima_verificacao'] = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
+                        rows.append((result, filial['table']))
+                        done.append(job_id)
+                        print(f"Filial: {filial['serie']}, CTRC: {result.get('N° CTRC', 'N/A')}, Remetente: {result.get('Remetente Nome', 'N/A')}, NF: {result.get('Número Nota Fiscal', 'N/A')}")
+                    elif status == 'ausente':
+                        done.append(job_id)
+                    else:
+                        failed.append(job_id)
+                if rows and not self.insert_data_batch(rows):
+                    failed.extend(done)
+                    done = []
+                self.job_queue.complete(done)
+                self.job_queue.fail(failed, error='erro na consulta', retry_delay=ingestao_config['fila_atraso_retentativa'],
+                                    max_attempts=ingestao_config['fila_max_tentativas'])
+
+            results = self.pipeline.run(tasks, write_fn=write)
+            new_data_found = new_data_found or any(status == 'ok' and result for _, status, result in results)
+
+    # Marca d'água contínua: o maior número até o qual todos os CTRCs foram
+    # gravados, confirmados ausentes ou deixados para o preenchimento de
+    # lacunas ('falhou'), isto é, logo abaixo do menor job 'busca' da filial
+    # ainda na fila (retentativas)
+    def advance_watermarks(self, filiais):
+        for filial in filiais:
+            pending = self.job_queue.lowest_unfinished_number('busca', filial['serie'])
+            watermark = filial['current_number'] if pending is None else min(filial['current_number'], pending - 1)
+            save_watermark(db_path, filial['serie'], watermark)
 
     def insert_data_batch(self, batch):
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            for extracted_data, table_name in batch:
-                columns = ', '.join([f'"{column_mapping[col]}"' for col in required_columns])
-                placeholders = ', '.join(['?' for _ in required_columns])
-                insert_sql = f'INSERT OR IGNORE INTO {table_name} ({columns}) VALUES ({placeholders})'
-                values = [extracted_data.get(col, '' if 'Tentativas de Entrega' not in col else 0 if col == 'ocorrencia_data_Tentativas de Entrega' else None) for col in required_columns]
-                cursor.execute(insert_sql, values)
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"Erro ao inserir dados em lote: {e}")
+        return insert_data_batch(batch)
 
 # Ciclo contínuo
 filiais = [
@@ -859,58 +1301,276 @@ filiais = [
 db_path = 'ctrc_database.db'
 JSON_FILE = 'unique_routes_with_ceps.json'
 
-for filial in filiais:
-    create_table(filial['table'])
-
-for filial in filiais:
+PAUSE_DURATION = 600
+MAX_NO_DATA_ATTEMPTS = 3
+REFRESH_RETRY_DELAY = 60
+
+# Acorda o ciclo principal antes do prazo (sinal de parada, registros novos)
+loop_wakeup = threading.Event()
+
+# Configura o cliente HTTP do SSW e cria o motor de coleta para as filiais
+def setup_ingestao(filiais, ingestao_config):
+    global html_archive, concurrency_controller
+    max_workers = ingestao_config['concorrencia_max'] * len(filiais)
+    ssw_http.configure_pool(max_workers)
+    fetch_engine = FetchEngine(
+        concurrency_per_filial=ingestao_config['concorrencia_por_filial'],
+        max_threads=max_workers,
+    )
+    concurrency_controller = AIMDController(
+        fetch_engine,
+        initial_limit=ingestao_config['concorrencia_por_filial'],
+        min_limit=ingestao_config['concorrencia_min'],
+        max_limit=ingestao_config['concorrencia_max'],
+        target_latency=ingestao_config['latencia_alvo'],
+        max_error_rate=ingestao_config['taxa_max_erros'],
+        max_empty_rate=ingestao_config['taxa_max_vazias'],
+    )
+    ssw_http.add_observer(concurrency_controller.observe)
+    ssw_http.configure_rate_limiter(RateLimiter(
+        global_rate=ingestao_config['limite_global_rps'],
+        endpoint_rates=ingestao_config['limite_por_endpoint_rps'],
+    ))
+    ssw_http.configure_base_url(ingestao_config['ssw_base_url'])
+    # Grava as respostas reais no corpus de fixtures do servidor local, se configurado
+    if ingestao_config['gravar_fixtures']:
+        ssw_http.add_observer(FixtureRecorder(FixtureStore(ingestao_config['gravar_fixtures'])).observe)
+    # Arquiva todas as respostas brutas do ssw0053 para reprocessamento local
+    if ingestao_config['arquivo_html']:
+        html_archive = HtmlArchive(
+            ingestao_config['arquivo_html'],
+            retention_days=ingestao_config['arquivo_retencao_dias'],
+            keep_latest=ingestao_config['arquivo_manter_ultimas'],
+            tz=refresh_scheduler.tz,
+        )
+        ssw_http.add_observer(html_archive.observe)
+        html_archive.start()
+    return fetch_engine
+
+# Posição da filial: a marca d'água, ou o último CTRC gravado (ou o número
+# inicial) se ainda não há marca d'água. Acima da marca d'água, os jobs
+# 'busca' que ficaram na fila são retomados e a descoberta não duplica os
+# já enfileirados.
+def load_filial_position(filial):
+    watermark = load_watermark(db_path, filial['serie'])
+    if watermark is not None:
+        filial['current_number'] = watermark
+        return
     last_serie, last_number = get_last_ctrc(filial['table'], filial)
     filial['current_number'] = int(last_number) if last_number else int(filial['start_number'])
-    check_and_fill_gaps(filial, cookies, headers)
 
-existing_data_handler = ExistingDataHandler(filiais, cookies, headers)
-new_data_handler = NewDataHandler(filiais, cookies, headers)
+# Pausa e buscas vazias seguidas da filial, guardadas no job 'descoberta'
+def load_discovery_state(filial):
+    job = job_queue.get('descoberta', filial['serie']) if job_queue is not None else None
+    state = (job or {}).get('payload') or {}
+    filial['consecutive_empty'] = state.get('consecutive_empty', 0)
+    filial['pause_until'] = state.get('pause_until', 0)
+
+def discovery_state(filial):
+    return {'consecutive_empty': filial['consecutive_empty'], 'pause_until': filial['pause_until']}
+
+# Filiais deste worker: todas, ou só as dos leases no modo com shards
+def owned_filiais():
+    if shard_leases is None:
+        return filiais
+    owned = shard_leases.owned()
+    return [filial for filial in filiais if filial['serie'] in owned]
+
+# Mudanças de shards recebidas na thread de heartbeat (ShardLeases); só o
+# ciclo principal as aplica, entre uma etapa e outra, para não reescrever o
+# estado de uma filial que ainda está em uso
+shard_changes = queue.Queue()
+
+def on_shards_changed(acquired, lost):
+    shard_changes.put((acquired, lost))
+    loop_wakeup.set()
+
+# Filial assumida de outro worker: recarrega a posição (o outro pode ter
+# avançado), a pausa e os contadores
+def apply_shard_changes():
+    while True:
+        try:
+            acquired, lost = shard_changes.get_nowait()
+        except queue.Empty:
+            return
+        for filial in filiais:
+            if filial['serie'] in acquired:
+                load_filial_position(filial)
+                load_discovery_state(filial)
+                if negative_cache is not None:
+                    negative_cache.set_head(filial['serie'], filial['current_number'])
+        if acquired:
+            print(f"Worker {shard_leases.worker_id}: filiais assumidas: {', '.join(sorted(acquired))}")
+        if lost:
+            print(f"Worker {shard_leases.worker_id}: filiais liberadas: {', '.join(sorted(lost))}")
+
+def main():
+    global negative_cache, shard_leases, job_queue
+    for filial in filiais:
+        create_table(filial['table'])
+        clean_invalid_ultima_verificacao(filial)
+        debug_datetime_comparison(filial)
+    ensure_state_table(db_path)
 
-last_token_refresh_time = time.time()
-PAUSE_DURATION = 600
-MAX_NO_DATA_ATTEMPTS = 3
-all_paused_message_printed = False
-
-# Dicionário para controlar os intervalos de busca de novos dados
-new_data_intervals = {
-    'VNA': 60,  # 1 hora
-    'BHZ': 60,  # 1 hora
-    'SPA': 60,  # 1 hora
-    'MRE': 60,  # 1 hora
-}
+    for filial in filiais:
+        load_filial_position(filial)
+
+    negative_cache = NegativeCache(
+        db_path,
+        near_ttl=ingestao_config['cache_negativo_ttl_perto'],
+        far_ttl=ingestao_config['cache_negativo_ttl_longe'],
+        near_distance=ingestao_config['cache_negativo_distancia_perto'],
+        far_distance=ingestao_config['cache_negativo_distancia_longe'],
+    )
+    for filial in filiais:
+        negative_cache.set_head(filial['serie'], filial['current_number'])
+
+    # Fila persistente: retoma a descoberta, as buscas pendentes e a agenda
+    # das lacunas de onde a execução anterior parou
+    job_queue = JobQueue(db_path, worker_id=ingestao_config['shards_worker_id'] or None,
+                         visibility_timeout=ingestao_config['fila_visibilidade'])
+    # Worker único: o que ficou em execução numa queda volta logo para a fila
+    # (com shards, volta quando vence o prazo de visibilidade)
+    if not ingestao_config['shards_ativo']:
+        requeued = job_queue.requeue_running()
+        if requeued:
+            print(f"Fila: {requeued} jobs da execução anterior retomados.")
+    job_queue.purge(ingestao_config['fila_retencao_dias'] * 86400)
+    job_queue.enqueue_many('descoberta', [(filial['serie'], filial['serie'], None) for filial in filiais])
+    for filial in filiais:
+        load_discovery_state(filial)
+
+    # Modo com shards: vários processos dividem as filiais por leases no banco
+    if ingestao_config['shards_ativo']:
+        shard_leases = ShardLeases(
+            db_path, [filial['serie'] for filial in filiais],
+            worker_id=job_queue.worker_id,
+            ttl=ingestao_config['shards_lease_ttl'],
+            heartbeat_interval=ingestao_config['shards_heartbeat'],
+            max_shards=ingestao_config['shards_max_por_worker'],
+            on_change=on_shards_changed,
+        )
+        shard_leases.start()
+
+    fetch_engine = setup_ingestao(filiais, ingestao_config)
+    backfiller = check_and_fill_gaps(owned_filiais, cookies, headers, fetch_engine)
+    # Parse fora das threads de rede, num pool de processos (0 = um por núcleo)
+    parse_pipeline = ParsePipeline(
+        fetch_engine, parse_ctrc_pages, fallback_fn=fetch_ctrc,
+        processes=ingestao_config['processos_parse'] or None,
+        queue_size=ingestao_config['fila_paginas'],
+    )
+    existing_data_handler = ExistingDataHandler(filiais, cookies, headers, fetch_engine, parse_pipeline)
+    new_data_handler = NewDataHandler(filiais, cookies, headers, fetch_engine, parse_pipeline, job_queue)
+
+    # O token é renovado em segundo plano antes de expirar; os workers passam
+    # a usar os cookies novos assim que a renovação termina
+    token_manager = TokenManager(
+        refresh_fn=refresh_token,
+        load_cookies_fn=lambda: load_config()[0],
+        is_expiring_fn=is_token_expiring,
+        refresh_ahead=ingestao_config['token_antecedencia'],
+        check_interval=ingestao_config['token_intervalo_verificacao'],
+    )
+    ssw_http.configure_credentials(token_manager)
+    token_manager.start()
+
+    stop_requested = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Sinal {signum} recebido. Encerrando após a etapa atual...")
+        stop_requested.set()
+        loop_wakeup.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
 
-last_new_data_check = {filial['serie']: 0 for filial in filiais}
+    try:
+        run_main_loop(new_data_handler, existing_data_handler, stop_requested)
+    finally:
+        if shard_leases is not None:
+            shard_leases.stop()
+        backfiller.stop()
+        token_manager.stop()
+        fetch_engine.stop()
+        parse_pipeline.stop()
+        if html_archive is not None:
+            html_archive.close()
+        print("Ingestão encerrada.")
+
+# Ciclo principal: dorme até o próximo evento (job 'descoberta' de uma
+# filial, retentativa de busca, próxima reconsulta vencida) em vez de girar
+# em falso. Os horários ficam na fila persistente, então um reinício segue a
+# mesma agenda. A renovação do token tem sua própria thread (TokenManager).
+def run_main_loop(new_data_handler, existing_data_handler, stop_requested):
+    all_paused_message_printed = False
+    last_purge = time.time()
+
+    while not stop_requested.is_set():
+        # Depois de owned_filiais: uma filial que aparece como deste worker já
+        # teve a mudança enfileirada, e é recarregada antes de ser usada
+        owned = owned_filiais()
+        apply_shard_changes()
+        active = [filial for filial in owned if filial['active']]
+        by_serie = {filial['serie']: filial for filial in active}
+
+        # Primeiro, buscar novos dados nas filiais com a descoberta vencida
+        new_data_found = False
+        discovery_jobs = job_queue.dequeue('descoberta', groups=list(by_serie), limit=len(by_serie))
+        due_filiais = [by_serie[job['grupo']] for job in discovery_jobs]
+        if due_filiais:
+            previous_numbers = {filial['serie']: filial['current_number'] for filial in due_filiais}
+            new_data_found = new_data_handler.process_new_data(due_filiais)
+            checked_at = time.time()
+            for job, filial in zip(discovery_jobs, due_filiais):
+                # Filial que avançou pode ter mais CTRCs: volta logo; senão
+                # sonda de novo após descoberta_intervalo segundos
+                if filial['current_number'] > previous_numbers[filial['serie']]:
+                    next_check = checked_at
+                else:
+                    next_check = checked_at + ingestao_config['descoberta_intervalo']
+                job_queue.reschedule([job['id']], max(next_check, filial['pause_until']), discovery_state(filial))
+        elif job_queue.seconds_until_available('busca', list(by_serie)) == 0:
+            # Retentativas de buscas que falharam
+            new_data_found = new_data_handler.run_fetch_jobs(active)
+
+        # Só atualizar os dados existentes se não houver novos dados encontrados
+        refresh_wait = refresh_scheduler.seconds_until_due(db_path, [filial['table'] for filial in owned])
+        if not new_data_found and refresh_wait == 0 and not stop_requested.is_set():
+            updated = existing_data_handler.update_existing_records(owned)
+            refresh_wait = refresh_scheduler.seconds_until_due(db_path, [filial['table'] for filial in owned])
+            # Registros que continuam vencidos sem nenhuma atualização (erros
+            # seguidos) não devem ser reconsultados em sequência
+            if refresh_wait == 0 and not updated:
+                refresh_wait = REFRESH_RETRY_DELAY
+
+        if time.time() - last_purge >= 86400:
+            job_queue.purge(ingestao_config['fila_retencao_dias'] * 86400)
+            last_purge = time.time()
+
+        current_time = time.time()
+        waits = [wait for wait in (
+            job_queue.seconds_until_available('descoberta', list(by_serie)),
+            job_queue.seconds_until_available('busca', list(by_serie)),
+            refresh_wait,
+        ) if wait is not None]
+        if new_data_found:
+            timeout = 0
+        elif waits:
+            timeout = min(waits)
+        else:
+            timeout = None
 
-while True:
-    current_time = time.time()
-    active_filiais = False
-    if current_time - last_token_refresh_time >= 20 * 60:
-        print("Renovando token...")
-        if refresh_token():
-            print("Token renovado com sucesso.")
+        if active and all(current_time < filial['pause_until'] for filial in active):
+            if not all_paused_message_printed:
+                print("Todas as filiais estão pausadas. Aguardando retomada...")
+                all_paused_message_printed = True
         else:
-            print("Falha ao renovar token.")
-        last_token_refresh_time = current_time
-    filiais_to_process = []
-    for filial in filiais:
-        if filial['active'] and current_time >= filial['pause_until']:
-            filiais_to_process.append(filial)
-            active_filiais = True
-    if not active_filiais:
-        if not all_paused_message_printed:
-            print("Todas as filiais estão pausadas. Aguardando retomada...")
-            all_paused_message_printed = True
-        continue
-    else:
-        all_paused_message_printed = False
+            all_paused_message_printed = False
 
-    # Primeiro, buscar novos dados
-    new_data_found = new_data_handler.process_new_data()
+        if timeout is None or timeout > 0:
+            loop_wakeup.wait(timeout)
+        loop_wakeup.clear()
 
-    # Só atualizar os dados existentes se não houver novos dados encontrados
-    if not new_data_found:
-        existing_data_handler.update_existing_records()
+if __name__ == '__main__':
+    main()
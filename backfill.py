@@ -0,0 +1,221 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from discovery import ensure_state_table, load_watermark
+
+# Preenchimento de lacunas (CTRCs que faltam entre os já gravados e até a
+# marca d'água gravada), em paralelo pelo motor de coleta e retomável:
+#   - acima da marca d'água ficam os números ainda na fila de busca, que
+#     não são consultados de novo aqui;
+#   - as lacunas são calculadas no SQLite (LAG sobre o número do CTRC);
+#   - o progresso de cada passada fica em backfill_checkpoint, então um
+#     reinício continua de onde parou;
+#   - números no cache negativo (negative_cache.py) não são consultados;
+#   - com uma fila persistente (job_queue.py), o horário da próxima passada
+#     de cada filial fica num job 'lacunas', e um reinício não refaz a
+#     passada antes da hora.
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def ensure_backfill_tables(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+            serie TEXT PRIMARY KEY,
+            ultimo_numero INTEGER NOT NULL,
+            atualizado_em TEXT
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+# Faixas [inicio, fim] de números ausentes na tabela da filial, incluindo a
+# faixa entre o maior CTRC gravado e a marca d'água e a faixa entre o número
+# inicial da filial (start) e o menor CTRC gravado. Com a tabela vazia, a
+# faixa é de start até a marca d'água.
+def find_gaps(db_path, table_name, ctrc_column, watermark=None, start=None):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(f'''
+        SELECT anterior + 1, numero - 1 FROM (
+            SELECT CAST("{ctrc_column}" AS INTEGER) AS numero,
+                   LAG(CAST("{ctrc_column}" AS INTEGER)) OVER (ORDER BY CAST("{ctrc_column}" AS INTEGER)) AS anterior
+            FROM {table_name}
+        )
+        WHERE numero - anterior > 1
+        ORDER BY numero
+    ''').fetchall()
+    first, last = conn.execute(f'SELECT MIN(CAST("{ctrc_column}" AS INTEGER)), MAX(CAST("{ctrc_column}" AS INTEGER)) FROM {table_name}').fetchone()
+    conn.close()
+    gaps = [(gap_start, gap_end) for gap_start, gap_end in rows]
+    if last is None:
+        if start is not None and watermark is not None and watermark >= start:
+            gaps.append((start, watermark))
+        return gaps
+    if start is not None and first > start:
+        gaps.insert(0, (start, first - 1))
+    if watermark is not None and watermark > last:
+        gaps.append((last + 1, watermark))
+    return gaps
+
+
+def load_checkpoint(db_path, serie):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute('SELECT ultimo_numero FROM backfill_checkpoint WHERE serie = ?', (serie,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def save_checkpoint(db_path, serie, number):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        INSERT INTO backfill_checkpoint (serie, ultimo_numero, atualizado_em) VALUES (?, ?, ?)
+        ON CONFLICT(serie) DO UPDATE SET ultimo_numero = excluded.ultimo_numero, atualizado_em = excluded.atualizado_em
+    ''', (serie, number, _now()))
+    conn.commit()
+    conn.close()
+
+
+def clear_checkpoint(db_path, serie):
+    conn = sqlite3.connect(db_path)
+    conn.execute('DELETE FROM backfill_checkpoint WHERE serie = ?', (serie,))
+    conn.commit()
+    conn.close()
+
+
+# fetch_fn(filial, numero) -> (status, dados), status em 'ok', 'ausente', 'erro'
+# insert_fn(filial, lista_de_dados) grava os CTRCs encontrados. O fetch_fn é
+# quem registra os inexistentes no cache negativo.
+class GapBackfiller:
+    def __init__(self, db_path, engine, fetch_fn, insert_fn, ctrc_column,
+                 negative_cache=None, chunk_size=200):
+        self.db_path = db_path
+        self.engine = engine
+        self.fetch_fn = fetch_fn
+        self.insert_fn = insert_fn
+        self.ctrc_column = ctrc_column
+        self.negative_cache = negative_cache
+        self.chunk_size = chunk_size
+        self._thread = None
+        self._stop = threading.Event()
+        ensure_backfill_tables(db_path)
+        ensure_state_table(db_path)
+
+    # Números a buscar na passada atual, em ordem crescente
+    def pending_numbers(self, filial, watermark=None):
+        absent = self.negative_cache.absent_numbers(filial['serie']) if self.negative_cache else set()
+        checkpoint = load_checkpoint(self.db_path, filial['serie'])
+        first_number = int(filial['start_number']) if filial.get('start_number') else None
+        for start, end in find_gaps(self.db_path, filial['table'], self.ctrc_column, watermark, first_number):
+            if checkpoint is not None:
+                start = max(start, checkpoint + 1)
+            for number in range(start, end + 1):
+                if number not in absent:
+                    yield number
+
+    def _chunks(self, numbers):
+        chunk = []
+        for number in numbers:
+            chunk.append(number)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # Uma passada completa para as filiais. on_chunk() é chamado a cada bloco.
+    # Retorna {serie: (encontrados, ausentes, erros)}
+    def run(self, filiais, on_chunk=None):
+        totals = {filial['serie']: [0, 0, 0] for filial in filiais}
+        # Filiais intercaladas em cada bloco, para repartir a cota do motor
+        iterators = {filial['serie']: self._chunks(self.pending_numbers(filial, load_watermark(self.db_path, filial['serie'])))
+                     for filial in filiais}
+        by_serie = {filial['serie']: filial for filial in filiais}
+        while iterators and not self._stop.is_set():
+            tasks = []
+            last_number = {}
+            for serie in list(iterators):
+                chunk = next(iterators[serie], None)
+                if chunk is None:
+                    del iterators[serie]
+                    clear_checkpoint(self.db_path, serie)
+                    continue
+                last_number[serie] = chunk[-1]
+                tasks.extend((by_serie[serie], self.fetch_fn, (by_serie[serie], number)) for number in chunk)
+            if not tasks:
+                break
+
+            found = {serie: [] for serie in last_number}
+            absent = {serie: [] for serie in last_number}
+            for (filial, _, (_, number)), outcome in self.engine.run(tasks):
+                status, data = outcome if outcome else ('erro', None)
+                if status == 'ok' and data:
+                    found[filial['serie']].append(data)
+                elif status == 'ausente':
+                    absent[filial['serie']].append(number)
+                else:
+                    totals[filial['serie']][2] += 1
+
+            for serie, number in last_number.items():
+                if found[serie]:
+                    self.insert_fn(by_serie[serie], found[serie])
+                save_checkpoint(self.db_path, serie, number)
+                totals[serie][0] += len(found[serie])
+                totals[serie][1] += len(absent[serie])
+            if on_chunk is not None:
+                on_chunk()
+
+        for serie, (found_count, absent_count, error_count) in totals.items():
+            print(f"Lacunas da filial {serie}: {found_count} CTRCs recuperados, {absent_count} inexistentes, {error_count} com erro.")
+        return {serie: tuple(values) for serie, values in totals.items()}
+
+    # Passadas em segundo plano: a primeira logo ao iniciar, depois a cada
+    # `interval` segundos, sem atrasar a busca de dados novos. filiais pode
+    # ser uma função, chamada a cada passada (filiais deste worker). Com
+    # job_queue, a agenda de cada filial fica na fila.
+    def start(self, filiais, interval=3600, job_queue=None):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                wait = interval
+                try:
+                    current = filiais() if callable(filiais) else filiais
+                    if job_queue is None:
+                        self.run(current)
+                    else:
+                        wait = self.run_scheduled(current, job_queue, interval)
+                except Exception as e:
+                    print(f"Erro no preenchimento de lacunas: {e}")
+                self._stop.wait(wait)
+
+        self._thread = threading.Thread(target=loop, name='backfill', daemon=True)
+        self._thread.start()
+
+    # Passada só das filiais com o job 'lacunas' vencido; a seguinte fica
+    # agendada para daqui a `interval` segundos. Uma passada interrompida
+    # (parada ou queda) fica disponível de imediato e continua do checkpoint.
+    # Retorna quantos segundos esperar até a próxima verificação.
+    def run_scheduled(self, filiais, job_queue, interval, poll_interval=60):
+        by_serie = {filial['serie']: filial for filial in filiais}
+        job_queue.enqueue_many('lacunas', [(serie, serie, None) for serie in by_serie])
+        jobs = job_queue.dequeue('lacunas', groups=list(by_serie), limit=len(by_serie))
+        if jobs:
+            job_ids = [job['id'] for job in jobs]
+            self.run([by_serie[job['grupo']] for job in jobs], on_chunk=lambda: job_queue.extend(job_ids))
+            job_queue.reschedule(job_ids, None if self._stop.is_set() else time.time() + interval)
+        # As filiais deste worker podem mudar (shards): não dorme mais que poll_interval
+        wait = job_queue.seconds_until_available('lacunas', list(by_serie))
+        return min(poll_interval, interval) if wait is None else min(wait, poll_interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
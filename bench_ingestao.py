@@ -0,0 +1,288 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+import atl
+import perf_stats
+import ssw_http
+from data_extraction import field_report
+from fetch_engine import FetchEngine
+from job_queue import JobQueue
+from parse_pipeline import ParsePipeline
+from ssw_standin import fixture_key, make_server
+
+# Benchmark de ponta a ponta da ingestão (atl.py): roda o NewDataHandler e o
+# ExistingDataHandler contra o servidor SSW local (ssw_standin) com páginas
+# sintéticas e um SQLite temporário, e mede CTRCs/s, latência por CTRC
+# (p50/p95/p99) e a divisão do tempo entre rede, parse e banco.
+#
+# Exemplo: python bench_ingestao.py --registros 10000 --concorrencia 10 50 100
+
+SERIES = ['VNA', 'BHZ', 'SPA', 'MRE']
+
+
+# Páginas sintéticas do ssw0053 para os CTRCs [inicio, inicio + quantidade)
+# de cada série; o seq_ctrc é a própria chave do CTRC
+class SyntheticStore:
+    def __init__(self, series, start, count):
+        self.series = set(series)
+        self.start = start
+        self.count = count
+
+    def _parse_key(self, key):
+        serie, numero = key[:3], key[3:]
+        if serie not in self.series or not numero.isdigit():
+            return None
+        numero = int(numero)
+        if not self.start <= numero < self.start + self.count:
+            return None
+        return serie, numero
+
+    def key_for_request(self, form):
+        if form.get('act') == 'P1':
+            key = fixture_key(form.get('t_ser_ctrc', ''), form.get('t_nro_ctrc', '0') or '0')
+        else:
+            key = form.get('seq_ctrc', '')
+        return key if self._parse_key(key) else None
+
+    def get(self, key, act):
+        serie, numero = self._parse_key(key)
+        if act == 'P1':
+            return synthetic_p1_page(serie, numero, key)
+        if act == 'A':
+            return f"<html><body><a onclick=\"portal_nfe('{numero:044d}')\">NF-e</a></body></html>"
+        if act == 'O':
+            return synthetic_occurrences_page(numero)
+        return None
+
+
+def _div(style, text):
+    return f'<div style="{style}">{text}</div>'
+
+
+def synthetic_p1_page(serie, numero, seq_ctrc):
+    dia = numero % 28 + 1
+    divs = [
+        _div("text-align:left;left:160px;top:80px;", f"{serie}{numero}-{numero % 10}"),
+        _div("text-align:left;left:648px;top:64px;color:#777;", seq_ctrc),
+        _div("text-align:left;left:504px;top:96px;color:red;", "AUTORIZADO"),
+        _div("text-align:left;left:64px;top:672px;", f"RDM VNA {dia:02d}/05/25 10:15 {numero % 90:02d}"),
+        _div("text-align:left;left:776px;top:64px;", "RDM"),
+        _div("text-align:left;left:896px;top:64px;", "RODOMAIS"),
+        _div("text-align:left;left:160px;top:112px;", f"{dia:02d}/05/25 09:00"),
+        _div("text-align:left;left:256px;top:112px;", "usuario"),
+        _div("left:400px;top:96px;width:96px;color:red;", f"{dia:02d}/05/25 09:30"),
+        _div("text-align:left;left:776px;top:112px;", f"{dia:02d}/06/25"),
+        _div("text-align:left;left:776px;top:144px;", f"{dia:02d}/06/25"),
+        _div("text-align:left;left:776px;top:96px;color:darkred;", "VIANA  ES"),
+        _div("text-align:left;left:160px;top:128px;", f"1/{numero:09d}"),
+        _div("text-align:left;left:160px;top:144px;", "3/3"),
+        _div("text-align:left;left:160px;top:160px;", "01-CAIXAS"),
+        _div("text-align:left;left:160px;top:176px;", "1.234,56"),
+        _div("text-align:left;left:504px;top:176px;", "1.100,00"),
+        _div("text-align:left;left:776px;top:176px;", "2,500"),
+        _div("text-align:left;left:160px;top:192px;", "15.000,00"),
+        _div("text-align:left;left:160px;top:208px;color:darkred;", "350,75"),
+        _div("text-align:left;left:160px;top:224px;", "42,09"),
+        _div("text-align:left;left:504px;top:224px;", "CIF"),
+        _div("text-align:left;left:504px;top:208px;color:darkred;", "PENDENTE"),
+        _div("text-align:left;left:160px;top:256px;", "REMETENTE LTDA (..)"),
+        _div("text-align:left;left:160px;top:288px;", "29136176 VIANA/ES"),
+        _div("text-align:left;left:160px;top:304px;", "(27) 3333-4444"),
+        _div("text-align:left;left:160px;top:368px;", "RUA NOVE, 384"),
+        _div("text-align:left;left:160px;top:400px;", "ARLINDO ANGELO VILLASCHI"),
+        _div("text-align:left;left:504px;top:256px;", "DESTINATARIO SA"),
+        _div("text-align:left;left:504px;top:288px;", "29100000 VILA VELHA/ES"),
+        _div("text-align:left;left:504px;top:368px;", "AV CENTRAL, 100"),
+        _div("text-align:left;left:504px;top:400px;", "CENTRO"),
+        _div("text-align:left;left:504px;top:336px;", "DESTINATARIO SA"),
+        _div("text-align:left;left:504px;top:416px;", "29100000 VILA VELHA/ES"),
+        _div("text-align:left;left:160px;top:464px;", "PAGADOR LTDA (..)"),
+        _div("text-align:left;left:160px;top:512px;", "VNA / ES - VIANA"),
+        _div("text-align:left;left:160px;top:528px;", "VNA / ES - VILA VELHA"),
+        _div("text-align:left;left:160px;top:544px;", "5353"),
+        _div("text-align:left;left:568px;top:464px;", f"{numero % 1000}/ABC1D23"),
+    ]
+    links = (
+        '<a id="link_cte_rps">001 000123456</a>'
+        '<a id="link_cli_rem">12.345.678/0001-90</a>'
+        '<a id="link_cli_dest">98.765.432/0001-10</a>'
+        '<a id="link_cli_ent">98.765.432/0001-10</a>'
+        '<a id="link_cli_pag">12.345.678/0001-90</a>'
+        '<div id="descricao">CHEGADA NA UNIDADE VIANA</div>'
+    )
+    return f"<html><body>{''.join(divs)}{links}</body></html>"
+
+
+def synthetic_occurrences_page(numero):
+    dia = numero % 28 + 1
+    records = [
+        ('80 - DOCUMENTO DE TRANSPORTE EMITIDO', f"{dia:02d}/05/25 09:30"),
+        ('82 - SAIDA DE UNIDADE', f"{dia:02d}/05/25 18:00"),
+        ('84 - CHEGADA EM UNIDADE DE ENTREGA', f"{dia:02d}/05/25 22:00"),
+        ('85 - SAIDA PARA ENTREGA', f"{dia:02d}/06/25 07:30"),
+    ]
+    xml = ''.join(f"<r><f3>{data}</f3><f9>Registro</f9><f10>{status}</f10></r>" for status, data in records)
+    return f'<html><body><xml id="xmlsr">{xml}</xml></body></html>'
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(phase, concurrency, count, elapsed, latencies, stage_snapshot, field_snapshot=None):
+    latencies = sorted(latencies)
+    print(f"\n[{phase}] concorrência={concurrency} CTRCs={count} tempo={elapsed:.2f}s "
+          f"-> {count / elapsed if elapsed else 0:.1f} CTRCs/s")
+    print(f"  latência por CTRC: p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms")
+    total_ctrc_time = sum(latencies)
+    staged = 0.0
+    for stage in ('rede', 'parse', 'banco'):
+        total, calls = stage_snapshot.get(stage, (0.0, 0))
+        staged += total
+        share = total / total_ctrc_time * 100 if total_ctrc_time else 0
+        print(f"  {stage:<6} {total:9.2f}s em {calls:7d} chamadas ({share:5.1f}% do tempo dos CTRCs)")
+    other = max(0.0, total_ctrc_time - staged)
+    print(f"  outro  {other:9.2f}s")
+    if field_snapshot:
+        print("  campos da página P1:")
+        for line in field_report(field_snapshot):
+            print(line)
+
+
+def run_level(args, server_url, concurrency):
+    db_file = os.path.join(args.diretorio, f"bench_{concurrency}.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    atl.db_path = db_file
+
+    filiais = [
+        {'serie': serie, 'table': f"ctrc_data_{serie.lower()}", 'start_number': str(args.inicio),
+         'current_number': args.inicio - 1, 'last_attempt_time': 0, 'active': True, 'pause_until': 0,
+         'consecutive_empty': 0}
+        for serie in SERIES[:args.filiais]
+    ]
+    for filial in filiais:
+        atl.create_table(filial['table'])
+    atl.ensure_state_table(db_file)
+
+    ssw_http.configure_base_url(server_url)
+    ssw_http.configure_pool(concurrency * len(filiais))
+    ssw_http.configure_rate_limiter(None)
+    engine = FetchEngine(concurrency_per_filial=concurrency, max_threads=concurrency * len(filiais))
+    pipeline = ParsePipeline(engine, atl.parse_ctrc_pages, fallback_fn=atl.fetch_ctrc,
+                             processes=args.processos, queue_size=args.fila)
+
+    latencies = []
+    # A busca de novos e a reconsulta passam ambas por fetch_ctrc_pages (só a
+    # etapa de rede; o parse roda no pool de processos)
+    original_fetch_ctrc_pages = atl.fetch_ctrc_pages
+
+    def timed_fetch_ctrc_pages(*call_args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original_fetch_ctrc_pages(*call_args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    atl.fetch_ctrc_pages = timed_fetch_ctrc_pages
+    try:
+        with open(os.devnull, 'w') as devnull:
+            if args.modo in ('novos', 'ambos'):
+                handler = atl.NewDataHandler(filiais, atl.cookies, atl.headers, engine, pipeline, JobQueue(db_file))
+                perf_stats.stats.reset()
+                perf_stats.fields.reset()
+                target = args.registros * len(filiais)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(devnull):
+                    while sum(f['current_number'] - args.inicio + 1 for f in filiais) < target:
+                        if not handler.process_new_data():
+                            break
+                elapsed = time.perf_counter() - start
+                report('novos', concurrency, len(latencies), elapsed, latencies, perf_stats.stats.snapshot(), perf_stats.fields.snapshot())
+
+            if args.modo in ('existentes', 'ambos'):
+                if args.modo == 'existentes':
+                    seed_existing(filiais, args, engine)
+                conn = sqlite3.connect(db_file)
+                for filial in filiais:
+                    conn.execute(f'UPDATE {filial["table"]} SET "ultima_verificacao" = NULL, "next_due_at" = ?',
+                                 (atl.refresh_scheduler.now(),))
+                conn.commit()
+                conn.close()
+                latencies.clear()
+                handler = atl.ExistingDataHandler(filiais, atl.cookies, atl.headers, engine, pipeline)
+                perf_stats.stats.reset()
+                perf_stats.fields.reset()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(devnull):
+                    handler.update_existing_records()
+                elapsed = time.perf_counter() - start
+                report('existentes', concurrency, len(latencies), elapsed, latencies, perf_stats.stats.snapshot(), perf_stats.fields.snapshot())
+    finally:
+        atl.fetch_ctrc_pages = original_fetch_ctrc_pages
+        engine.stop()
+        pipeline.stop()
+
+
+# Popula o banco direto pelo process_ctrc, sem medir, para o modo 'existentes'
+def seed_existing(filiais, args, engine):
+    tasks = [(filial, atl.process_ctrc, (filial, numero, atl.cookies, atl.headers))
+             for filial in filiais for numero in range(args.inicio, args.inicio + args.registros)]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = engine.run(tasks)
+        atl.insert_data_batch(
+            [(outcome[0], filial['table']) for (filial, _, _), outcome in results if outcome and outcome[0]]
+        )
+
+
+# O servidor roda em outro processo para não disputar o GIL com a ingestão
+def serve_synthetic(store, latency, error_rate, port_queue):
+    server = make_server(store, port=0, latency=latency, error_rate=error_rate)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de ingestão (atl.py) contra o servidor SSW local.')
+    parser.add_argument('--registros', type=int, default=10000, help='CTRCs por filial (ex.: 10000, 100000)')
+    parser.add_argument('--concorrencia', type=int, nargs='+', default=[10], help='Um ou mais níveis de concorrência por filial')
+    parser.add_argument('--filiais', type=int, default=1, choices=range(1, len(SERIES) + 1))
+    parser.add_argument('--modo', choices=['novos', 'existentes', 'ambos'], default='ambos')
+    parser.add_argument('--latencia', type=float, default=0.05, help='Latência média injetada pelo servidor local, em segundos')
+    parser.add_argument('--taxa-erro', type=float, default=0.0)
+    parser.add_argument('--processos', type=int, default=None, help='Processos de parse (padrão: um por núcleo)')
+    parser.add_argument('--fila', type=int, default=200, help='Páginas aguardando parse')
+    parser.add_argument('--inicio', type=int, default=100000, help='Primeiro número de CTRC sintético')
+    parser.add_argument('--diretorio', default=None, help='Diretório dos bancos temporários')
+    args = parser.parse_args()
+    args.diretorio = args.diretorio or tempfile.mkdtemp(prefix='bench_ingestao_')
+    os.makedirs(args.diretorio, exist_ok=True)
+
+    store = SyntheticStore(SERIES[:args.filiais], args.inicio, args.registros)
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=serve_synthetic, args=(store, args.latencia, args.taxa_erro, port_queue), daemon=True
+    )
+    server_process.start()
+    server_url = f"http://127.0.0.1:{port_queue.get()}"
+    print(f"Servidor sintético em {server_url}; bancos em {args.diretorio}")
+
+    try:
+        for concurrency in args.concorrencia:
+            run_level(args, server_url, concurrency)
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+
+if __name__ == '__main__':
+    main()
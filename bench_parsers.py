@@ -0,0 +1,233 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from data_extraction import extract_data_from_html, parse_nf_key, parse_occurrences
+from html_archive import HtmlArchive, content_hash
+
+# Benchmark e verificação de equivalência dos parsers do data_extraction
+# sobre um corpus de páginas do SSW salvas: fixtures do ssw_standin
+# (gravar_fixtures), o arquivo HTML da ingestão (arquivo_html) e/ou páginas
+# sintéticas. Mede páginas/s, pico de memória e blocos de memória retidos por
+# parser, e compara campo a campo com as saídas de referência (golden) de uma
+# versão conhecida.
+#
+# Gravar a referência (na versão atual, antes de trocar um parser):
+#   python bench_parsers.py --fixtures fixtures --gravar
+# Verificar (sai com código 1 se algum valor extraído mudou):
+#   python bench_parsers.py --fixtures fixtures
+
+GOLDEN_VERSION = 1
+
+
+# As funções com rede (extract_tracking_info, check_delivery_receipt,
+# extract_nf_key) são medidas pela parte de parse, sobre a página já baixada.
+# parse_occurrences lê a página de ocorrências uma vez só para as duas
+# primeiras: é medido como um parser, e a saída é separada nos dois nomes
+# da referência.
+
+# parser -> (act da página, função, nomes das saídas na referência)
+PARSERS = {
+    'extract_data_from_html': ('P1', extract_data_from_html, None),
+    'parse_occurrences': ('O', parse_occurrences, ('check_delivery_receipt', 'extract_tracking_info')),
+    'extract_nf_key': ('A', parse_nf_key, None),
+}
+
+
+# {nome na referência: saída} de um parser
+def named_outputs(name, result):
+    output_names = PARSERS[name][2]
+    if output_names is None:
+        return {name: result}
+    return dict(zip(output_names, result))
+
+
+# Corpus: {hash: (act, origem, html)}, sem páginas repetidas
+
+def load_fixtures(directory, corpus, limit=None):
+    for act in ('P1', 'A', 'O'):
+        paths = sorted(glob.glob(os.path.join(directory, f"*_{act}.html")))
+        for path in paths[:limit]:
+            with open(path, 'r', encoding='utf-8') as f:
+                html = f.read()
+            corpus.setdefault(content_hash(html), (act, os.path.basename(path), html))
+
+
+def load_archive(path, corpus, limit=None):
+    archive = HtmlArchive(path)
+    counts = {}
+    for serie, ctrc, act, fetched_at, html in archive.iter_latest():
+        if limit is not None and counts.get(act, 0) >= limit:
+            continue
+        counts[act] = counts.get(act, 0) + 1
+        corpus.setdefault(content_hash(html), (act, f"{serie}{ctrc}_{act}@{fetched_at}", html))
+
+
+def load_synthetic(count, corpus):
+    from bench_ingestao import SyntheticStore
+    store = SyntheticStore(['VNA'], 100000, count)
+    for numero in range(100000, 100000 + count):
+        for act in ('P1', 'A', 'O'):
+            html = store.get(f"VNA{numero}", act)
+            corpus.setdefault(content_hash(html), (act, f"sintetica_VNA{numero}_{act}", html))
+
+
+# Saída em forma comparável com o JSON da referência (tuplas viram listas)
+def normalize(value):
+    return json.loads(json.dumps(value, ensure_ascii=False))
+
+
+def run_parsers(corpus, parsers):
+    outputs = {}
+    for digest, (act, origin, html) in corpus.items():
+        for name in parsers:
+            parser_act, fn, _ = PARSERS[name]
+            if parser_act == act:
+                for output_name, value in named_outputs(name, fn(html)).items():
+                    outputs.setdefault(digest, {})[output_name] = normalize(value)
+    return outputs
+
+
+def write_golden(path, corpus, outputs):
+    pages = {digest: {'act': corpus[digest][0], 'origem': corpus[digest][1], 'saidas': parser_outputs}
+             for digest, parser_outputs in outputs.items()}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'versao': GOLDEN_VERSION, 'paginas': pages}, f, ensure_ascii=False, indent=1, sort_keys=True)
+    print(f"Referência gravada em {path}: {len(pages)} páginas.")
+
+
+# Diferenças campo a campo: [(parser, campo, origem, referência, atual)].
+# Campos que a referência não tem (novos) são só contados; páginas do corpus
+# sem referência são ignoradas.
+def compare(golden, corpus, outputs):
+    differences = []
+    new_fields = {}
+    missing = 0
+    for digest, parser_outputs in outputs.items():
+        reference = golden['paginas'].get(digest)
+        if reference is None:
+            missing += 1
+            continue
+        for name, current in parser_outputs.items():
+            if name not in reference['saidas']:
+                continue
+            expected = reference['saidas'][name]
+            if isinstance(expected, dict) and isinstance(current, dict):
+                for field in sorted(set(expected) | set(current)):
+                    if field not in expected:
+                        new_fields[(name, field)] = new_fields.get((name, field), 0) + 1
+                    elif expected[field] != current.get(field):
+                        differences.append((name, field, reference['origem'], expected.get(field), current.get(field)))
+            elif expected != current:
+                differences.append((name, '(valor)', reference['origem'], expected, current))
+    for (name, field), count in sorted(new_fields.items()):
+        print(f"Campo novo {name} / {field} em {count} páginas (não está na referência).")
+    if missing:
+        print(f"{missing} páginas do corpus sem referência (grave de novo com --gravar para incluí-las).")
+    return differences
+
+
+def short(value, width=120):
+    text = repr(value)
+    return text if len(text) <= width else text[:width] + '...'
+
+
+def report_differences(differences, examples=3):
+    by_field = {}
+    for name, field, origin, expected, current in differences:
+        by_field.setdefault((name, field), []).append((origin, expected, current))
+    for (name, field), items in sorted(by_field.items()):
+        print(f"  {name} / {field}: {len(items)} páginas diferentes")
+        for origin, expected, current in items[:examples]:
+            print(f"    {origin}: referência={short(expected)} atual={short(current)}")
+
+
+# Páginas/s, pico de memória e blocos retidos por parser. O tempo é medido
+# sem o tracemalloc; a memória numa passada separada, página a página.
+def benchmark(corpus, parsers, repetitions):
+    print(f"\n{'parser':<24} {'páginas':>8} {'páginas/s':>10} {'ms/página':>10} {'pico KB':>9} {'pico máx KB':>12} {'blocos retidos':>15}")
+    for name in parsers:
+        act, fn, _ = PARSERS[name]
+        pages = [html for page_act, _, html in corpus.values() if page_act == act]
+        if not pages:
+            print(f"{name:<24} {0:>8}  (sem páginas act={act} no corpus)")
+            continue
+
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            for html in pages:
+                fn(html)
+        elapsed = time.perf_counter() - start
+        calls = len(pages) * repetitions
+
+        peaks = []
+        retained = 0
+        tracemalloc.start()
+        for html in pages:
+            tracemalloc.reset_peak()
+            before_blocks = len(tracemalloc.take_snapshot().traces)
+            result = fn(html)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            retained += len(tracemalloc.take_snapshot().traces) - before_blocks
+            del result
+        tracemalloc.stop()
+
+        print(f"{name:<24} {len(pages):>8} {calls / elapsed:>10.0f} {elapsed / calls * 1000:>10.3f} "
+              f"{sum(peaks) / len(peaks) / 1024:>9.1f} {max(peaks) / 1024:>12.1f} {retained / len(pages):>15.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark e verificação de equivalência dos parsers de páginas do SSW.')
+    parser.add_argument('--fixtures', action='append', default=[], help='Diretório de fixtures do ssw_standin (pode repetir)')
+    parser.add_argument('--arquivo', default=None, help='Banco do arquivo HTML da ingestão')
+    parser.add_argument('--sinteticas', type=int, default=0, help='Quantidade de CTRCs sintéticos no corpus')
+    parser.add_argument('--limite', type=int, default=None, help='Máximo de páginas por act e por fonte')
+    parser.add_argument('--golden', default='golden_parsers.json', help='Arquivo das saídas de referência')
+    parser.add_argument('--gravar', action='store_true', help='Grava as saídas atuais como referência')
+    parser.add_argument('--parsers', nargs='+', choices=list(PARSERS), default=list(PARSERS))
+    parser.add_argument('--repeticoes', type=int, default=3, help='Passadas sobre o corpus na medição de tempo')
+    parser.add_argument('--sem-benchmark', action='store_true', help='Só compara com a referência')
+    args = parser.parse_args()
+
+    corpus = {}
+    for directory in args.fixtures:
+        load_fixtures(directory, corpus, args.limite)
+    if args.arquivo:
+        load_archive(args.arquivo, corpus, args.limite)
+    if args.sinteticas:
+        load_synthetic(args.sinteticas, corpus)
+    if not corpus:
+        parser.error('Corpus vazio: informe --fixtures, --arquivo e/ou --sinteticas')
+    counts = {}
+    for act, _, _ in corpus.values():
+        counts[act] = counts.get(act, 0) + 1
+    print(f"Corpus: {len(corpus)} páginas ({', '.join(f'{act}={count}' for act, count in sorted(counts.items()))}).")
+
+    outputs = run_parsers(corpus, args.parsers)
+    failed = False
+    if args.gravar:
+        write_golden(args.golden, corpus, outputs)
+    elif os.path.exists(args.golden):
+        with open(args.golden, 'r', encoding='utf-8') as f:
+            golden = json.load(f)
+        differences = compare(golden, corpus, outputs)
+        if differences:
+            failed = True
+            print(f"FALHA: {len(differences)} valores diferentes da referência:")
+            report_differences(differences)
+        else:
+            print("OK: todos os valores extraídos iguais à referência.")
+    else:
+        print(f"Sem referência em {args.golden}; use --gravar para criá-la.")
+
+    if not args.sem_benchmark:
+        benchmark(corpus, args.parsers, args.repeticoes)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import threading
+
+
+# Controlador adaptativo (AIMD) da concorrência por filial.
+# A cada janela de requisições observadas, aumenta o limite em `increase`
+# quando o SSW está saudável e multiplica por `decrease` quando a latência
+# média passa do alvo ou a taxa de erros / CTRCs vazios fica alta.
+# A latência e os erros vêm de cada resposta (observe, só pelo status HTTP);
+# os vazios, do resultado já calculado de cada CTRC da ingestão
+# (observe_result), então sondagens além do topo e lacunas quase vazias não
+# derrubam o limite da filial.
+class AIMDController:
+    def __init__(self, engine, initial_limit=10, min_limit=1, max_limit=50,
+                 increase=1, decrease=0.5, window=20, target_latency=3.0,
+                 max_error_rate=0.1, max_empty_rate=0.8):
+        self.engine = engine
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.max_empty_rate = max_empty_rate
+        self._limits = {}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _new_window(self):
+        return {'count': 0, 'latency': 0.0, 'errors': 0, 'results': 0, 'empty': 0}
+
+    # Registra uma resposta do SSW na janela da filial, classificada só pelo
+    # status (sem ler o corpo). Assinatura compatível com ssw_http.add_observer.
+    def observe(self, context, url, data, elapsed, response, error):
+        serie = context.get('serie')
+        if not serie:
+            return
+        is_error = error is not None or response.status_code == 429 or response.status_code >= 500
+        self.record(serie, elapsed, is_error)
+
+    # Resultado de um CTRC da ingestão ('ok', 'ausente', ...), para a taxa
+    # de vazios da janela
+    def observe_result(self, serie, status):
+        with self._lock:
+            window = self._windows.setdefault(serie, self._new_window())
+            window['results'] += 1
+            window['empty'] += 1 if status == 'ausente' else 0
+
+    def record(self, serie, latency, is_error=False):
+        with self._lock:
+            window = self._windows.setdefault(serie, self._new_window())
+            window['count'] += 1
+            window['latency'] += latency
+            window['errors'] += 1 if is_error else 0
+            if window['count'] < self.window:
+                return
+            self._windows[serie] = self._new_window()
+            old_limit = self._limits.get(serie, self.initial_limit)
+            new_limit = self._next_limit(old_limit, window)
+            self._limits[serie] = new_limit
+        if new_limit != old_limit:
+            print(f"Filial {serie}: concorrência ajustada de {old_limit} para {new_limit} "
+                  f"(latência média {window['latency'] / window['count']:.2f}s, "
+                  f"erros {window['errors']}/{window['count']}, vazios {window['empty']}/{window['results']})")
+            self.engine.set_limit(serie, new_limit)
+
+    def _next_limit(self, limit, window):
+        count = window['count']
+        degraded = (
+            window['latency'] / count > self.target_latency
+            or window['errors'] / count > self.max_error_rate
+            or (window['results'] and window['empty'] / window['results'] > self.max_empty_rate)
+        )
+        if degraded:
+            return max(self.min_limit, int(limit * self.decrease))
+        return min(self.max_limit, limit + self.increase)
+
+    # Limites atuais por filial
+    def limits(self):
+        with self._lock:
+            return dict(self._limits)
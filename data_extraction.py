@@ -1,11 +1,17 @@
-import requests
+import hashlib
 import re
+from html import unescape
 from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 from datetime import datetime
 
 import time
 import json
 
+import perf_stats
+import ssw_http
+from ssw_formats import format_date_time, format_date, format_decimal
+
 # Funções de formatação
 def format_cnpj(cnpj):
     return re.sub(r'\D', '', cnpj) if cnpj else ''
@@ -18,41 +24,6 @@ def format_phone(phone):
     phone = re.sub(r'\D', '', phone) if phone else ''
     return f"{phone[:2]} {phone[2:]}" if phone else ''
 
-def format_date_time(date_time_str):
-    if not date_time_str or len(date_time_str.split()) < 2:
-        return ''
-    try:
-        date_str, time_str = date_time_str.split()[:2]
-        dt = datetime.strptime(f"{date_str} {time_str}", '%d/%m/%y %H:%M')
-        return dt.strftime('%Y-%m-%d %H:%M:%S')
-    except ValueError:
-        try:
-            dt = datetime.strptime(f"{date_time_str}", '%d/%m/%Y %H:%M')
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            return ''
-
-def format_date(date_str):
-    if not date_str:
-        return ''
-    try:
-        dt = datetime.strptime(date_str, '%d/%m/%y')
-        return dt.strftime('%Y-%m-%d 23:59:59')  # Incluir a hora padrão
-    except ValueError:
-        try:
-            dt = datetime.strptime(date_str, '%d/%m/%Y')
-            return dt.strftime('%Y-%m-%d 23:59:59')  # Incluir a hora padrão
-        except ValueError:
-            return ''
-
-def format_decimal(value):
-    if not value:
-        return 0.0
-    try:
-        return float(value.replace('.', '').replace(',', '.'))
-    except ValueError:
-        return 0.0
-
 def format_cte(cte):
     if not cte:
         return '0', '0'
@@ -107,136 +78,249 @@ def safe_split(text, separator, expected=2, default=''):
         parts.extend([default] * (expected - len(parts)))
     return parts
 
-# Função auxiliar para extrair texto com segurança
-def safe_text(element):
-    return element.text.strip() if element and element.text.strip() else ''
+UTF8_HTML_PARSER = lxml_html.HTMLParser(encoding='utf-8')
+
+# Leitura rápida da página act=P1 por expressão regular, sem montar a árvore
+# do HTML: usada nas threads de rede para decidir o que mais baixar antes do
+# parse completo (que roda no pool de processos)
+CTRC_NUMBER_DIV = re.compile(r'<div[^>]*\sstyle=["\']text-align:left;left:160px;top:80px;["\']', re.I)
+SEQ_CTRC_DIV = re.compile(r'<div[^>]*\sstyle=["\']text-align:left;left:648px;top:64px;color:#777;["\'][^>]*>(.*?)</div>', re.S | re.I)
+
+def is_ctrc_page(html_content):
+    return CTRC_NUMBER_DIV.search(html_content) is not None
+
+def peek_seq_ctrc(html_content):
+    match = SEQ_CTRC_DIV.search(html_content)
+    return unescape(re.sub(r'<[^>]+>', '', match.group(1))).strip() if match else ''
+
+# Índice de um documento HTML montado numa única passada (lxml): elementos
+# por (tag, style) e por (tag, id), na ordem do documento. Cada campo da
+# página act=P1 é então uma consulta direta, em vez de um soup.find que
+# percorre a árvore inteira.
+class HtmlIndex:
+    def __init__(self, html_content):
+        self.by_attribute = {'style': {}, 'id': {}}
+        if not html_content or not html_content.strip():
+            return
+        root = lxml_html.document_fromstring(html_content.encode('utf-8'), parser=UTF8_HTML_PARSER)
+        by_style = self.by_attribute['style']
+        by_id = self.by_attribute['id']
+        for element in root.iter():
+            tag = element.tag
+            if not isinstance(tag, str):
+                continue  # comentários e instruções de processamento
+            style = element.get('style')
+            if style is not None:
+                by_style.setdefault((tag, style), []).append(element)
+            element_id = element.get('id')
+            if element_id is not None:
+                by_id.setdefault((tag, element_id), []).append(element)
+
+    # Elementos com o atributo ('style' ou 'id') igual a value, na ordem do documento
+    def elements(self, tag, attribute, value):
+        return self.by_attribute[attribute].get((tag, value), [])
+
+# Localizadores da tabela de campos: (tag, atributo, valor, qual elemento)
+def div(style):
+    return ('div', 'style', style, 'primeiro')
+
+def last_div(style):
+    return ('div', 'style', style, 'ultimo')
+
+def div_id(element_id):
+    return ('div', 'id', element_id, 'primeiro')
+
+def link(element_id):
+    return ('a', 'id', element_id, 'primeiro')
+
+# Transformações da tabela de campos: recebem o texto de cada localizador
+# ('' se não houver elemento) e retornam o valor, ou uma tupla para vários campos
+def text(value):
+    return value
+
+def or_default(default):
+    return lambda value: value or default
+
+def without_suffix(suffix):
+    return lambda value: value.replace(suffix, '')
+
+def split_ctrc_number(value):
+    if not value:
+        return None  # campos ficam fora do registro
+    match = re.match(r'([A-Za-z]+)(\d+)-(\d)', value)
+    return match.groups() if match else ('', '', '')
+
+def split_cep_cidade(value):
+    cep_cidade = value.split()
+    if not cep_cidade:
+        return '', '', ''
+    if '/' not in cep_cidade[-1]:
+        return cep_cidade[0], '', ''
+    return cep_cidade[0], cep_cidade[-1].split('/')[0], cep_cidade[-1].split('/')[-1]
+
+def split_local(value):
+    codigo, rest = safe_split(value, ' / ', 2, '')
+    uf, cidade = safe_split(rest, ' - ', 2, '')
+    return codigo, uf, cidade
+
+def split_pair(separator):
+    return lambda value: tuple(safe_split(value, separator, 2, ''))
+
+def format_tipo_mercadoria(value):
+    return value.split('-')[-1] if '-' in value else ''
+
+def format_complemento(value):
+    return '[Nenhum]' if value.startswith('CEL') else value
+
+def format_conferente(value):
+    return ' '.join(value.split()[1:]) if value else ''
+
+# Tabela declarativa dos campos da página act=P1: (campo ou campos,
+# localizador ou localizadores, transformação). Compilada uma vez em
+# P1_PLAN; todos os localizadores usam o mesmo índice do documento, então
+# um campo novo não acrescenta nenhuma varredura da árvore.
+P1_FIELDS = [
+    (('Unidade Emissor', 'N° CTRC', 'Dígito Verificador'), div("text-align:left;left:160px;top:80px;"), split_ctrc_number),
+    ('Tipo Operação', div("text-align:left;left:256px;top:64px;color:darkred;"), or_default('NORMAL')),
+    ('Sequência CTRC', div("text-align:left;left:648px;top:64px;color:#777;"), text),
+    (('Série CT-e', 'Número CT-e'), link("link_cte_rps"), format_cte),
+    ('Status', div("text-align:left;left:504px;top:96px;color:red;"), text),
+    (('Domínio/Origem', 'Situação Data/Hora', 'Código Situação'), div("text-align:left;left:64px;top:672px;"), format_situacao_atual),
+    ('Descrição Situação', div_id("descricao"), text),
+    ('Domínio', div("text-align:left;left:776px;top:64px;"), text),
+    ('Empresa', div("text-align:left;left:896px;top:64px;"), text),
+    ('Inclusão Data/Hora', div("text-align:left;left:160px;top:112px;"), format_date_time),
+    ('Usuário Inclusão', div("text-align:left;left:256px;top:112px;"), text),
+    ('Emissão Data/Hora', div("left:400px;top:96px;width:96px;color:red;"), format_date_time),
+    ('Previsão Entrega', div("text-align:left;left:776px;top:112px;"), format_date),
+    ('Prazo Unidade Destinatária', div("text-align:left;left:776px;top:144px;"), format_date),
+    ('Destino', div("text-align:left;left:776px;top:96px;color:darkred;"), lambda value: value.replace('  ', ' ')),
+
+    (('Série Nota Fiscal', 'Número Nota Fiscal'), div("text-align:left;left:160px;top:128px;"), format_nota_fiscal),
+    ('Quantidade Volumes', div("text-align:left;left:160px;top:144px;"), format_volumes),
+    ('Tipo Mercadoria', div("text-align:left;left:160px;top:160px;"), format_tipo_mercadoria),
+    ('Peso Cálculo (Kg)', div("text-align:left;left:160px;top:176px;"), format_decimal),
+    ('Peso Real (Kg)', div("text-align:left;left:504px;top:176px;"), format_decimal),
+    ('Cubagem (m³)', last_div("text-align:left;left:776px;top:176px;"), format_decimal),
+    ('Valor Nota Fiscal (R$)', div("text-align:left;left:160px;top:192px;"), format_decimal),
+    ('Valor Frete (R$)', div("text-align:left;left:160px;top:208px;color:darkred;"), format_decimal),
+    ('ICMS/ISS (R$)', div("text-align:left;left:160px;top:224px;"), format_decimal),
+    ('Tipo Cobrança', div("text-align:left;left:504px;top:224px;"), lambda value: value.split('<')[0]),
+    ('Situação Liquidação', div("text-align:left;left:504px;top:208px;color:darkred;"), text),
+
+    ('Remetente Nome', div("text-align:left;left:160px;top:256px;"), without_suffix(' (..)')),
+    ('Remetente CNPJ', link("link_cli_rem"), format_cnpj),
+    ('Remetente Endereço', div("text-align:left;left:160px;top:368px;"), text),
+    ('Remetente Complemento', div("text-align:left;left:160px;top:384px;"), text),
+    ('Remetente Bairro', div("text-align:left;left:160px;top:400px;"), text),
+    (('Remetente CEP', 'Remetente Cidade', 'Remetente UF'), div("text-align:left;left:160px;top:288px;"), split_cep_cidade),
+    ('Remetente Telefone', div("text-align:left;left:160px;top:304px;"), format_phone),
+
+    ('Destinatário Nome', div("text-align:left;left:504px;top:256px;"), text),
+    ('Destinatário CNPJ', link("link_cli_dest"), format_cnpj),
+    ('Destinatário Endereço', div("text-align:left;left:504px;top:368px;"), text),
+    ('Destinatário Complemento', div("text-align:left;left:504px;top:384px;"), format_complemento),
+    ('Destinatário Bairro', div("text-align:left;left:504px;top:400px;"), text),
+    (('Destinatário CEP', 'Destinatário Cidade', 'Destinatário UF'), div("text-align:left;left:504px;top:288px;"), split_cep_cidade),
+    ('Destinatário Telefone', div("text-align:left;left:504px;top:304px;"), format_phone),
+    ('Destinatário Celular', div("text-align:left;left:696px;top:304px;"), format_phone),
+
+    ('Expedidor Nome', div("text-align:left;left:160px;top:336px;"), text),
+    ('Expedidor CNPJ', link("link_cli_exp"), format_cnpj),
+    ('Expedidor Endereço', div("text-align:left;left:160px;top:368px;"), text),
+    ('Expedidor Complemento', div("text-align:left;left:160px;top:384px;"), text),
+    ('Expedidor Bairro', div("text-align:left;left:160px;top:400px;"), text),
+    (('Expedidor CEP', 'Expedidor Cidade', 'Expedidor UF'), div("text-align:left;left:160px;top:416px;"), split_cep_cidade),
+    ('Expedidor Telefone', div("text-align:left;left:160px;top:432px;"), format_phone),
+
+    ('Entrega Nome', div("text-align:left;left:504px;top:336px;"), text),
+    ('Entrega CNPJ', link("link_cli_ent"), format_cnpj),
+    ('Entrega Endereço', div("text-align:left;left:504px;top:368px;"), text),
+    ('Entrega Complemento', div("text-align:left;left:504px;top:384px;"), format_complemento),
+    ('Entrega Bairro', div("text-align:left;left:504px;top:400px;"), text),
+    (('Entrega CEP', 'Entrega Cidade', 'Entrega UF'), div("text-align:left;left:504px;top:416px;"), split_cep_cidade),
+    ('Entrega Telefone', div("text-align:left;left:504px;top:432px;"), format_phone),
+    ('Entrega Celular', div("text-align:left;left:696px;top:432px;"), format_phone),
+
+    ('Pagador Nome', div("text-align:left;left:160px;top:464px;"), without_suffix(' (..)')),
+    ('Pagador CNPJ', link("link_cli_pag"), format_cnpj),
+
+    (('Origem Código', 'Origem UF', 'Origem Cidade'), div("text-align:left;left:160px;top:512px;"), split_local),
+    (('Destino Código', 'Destino UF', 'Destino Cidade'), div("text-align:left;left:160px;top:528px;"), split_local),
+    ('CFOP', div("text-align:left;left:160px;top:544px;"), text),
+    ('Veículo Coleta', div("text-align:left;left:776px;top:160px;"), text),
+    ('Conferente Coleta', div("text-align:left;left:504px;top:144px;"), format_conferente),
+    (('Romaneio Número', 'Placa Entrega'), div("text-align:left;left:568px;top:464px;"), split_pair('/')),
+    (('Código Remessa', 'Remessa Data/Hora'), (div("text-align:left;left:568px;top:480px;"), div("text-align:left;left:688px;top:480px;")), format_remessa),
+
+    ('Observação', div("text-align:left;left:160px;top:560px;color:darkred;"), or_default('[Nenhuma]')),
+    ('Instrução Entrega', div("text-align:left;left:160px;top:640px;color:darkred;"), or_default('[Nenhuma]')),
+]
+
+# Compila a tabela num plano: (nome, campos, consultas, transformação), com
+# cada localizador já resolvido para a chave do índice
+def compile_fields(spec):
+    plan = []
+    for fields, locators, transform in spec:
+        fields = (fields,) if isinstance(fields, str) else tuple(fields)
+        locators = (locators,) if isinstance(locators[0], str) else tuple(locators)
+        lookups = tuple((attribute, (tag, value), pick == 'ultimo') for tag, attribute, value, pick in locators)
+        plan.append((', '.join(fields), fields, lookups, transform))
+    return plan
+
+P1_PLAN = compile_fields(P1_FIELDS)
+
+# Executa um plano compilado sobre o índice da página, acumulando tempo e
+# falhas por campo em perf_stats.fields
+def run_plan(plan, page, data=None, stats=perf_stats.fields):
+    data = {} if data is None else data
+    clock = time.perf_counter
+    timings = []
+    for name, fields, lookups, transform in plan:
+        start = clock()
+        texts = []
+        missed = 0
+        for attribute, key, last in lookups:
+            elements = page.by_attribute[attribute].get(key)
+            if not elements:
+                missed = 1
+                if last:
+                    raise IndexError(f"Campo {name}: elemento não encontrado")
+                texts.append('')
+            else:
+                texts.append(elements[-1 if last else 0].text_content().strip())
+        value = transform(*texts)
+        if len(fields) == 1:
+            data[fields[0]] = value
+        elif value is not None:
+            data.update(zip(fields, value))
+        timings.append((name, clock() - start, missed))
+    stats.add_many(timings)
+    return data
+
+# Campos mais lentos e localizadores que mais falham, a partir de um
+# snapshot de perf_stats.fields
+def field_report(snapshot, top=5):
+    lines = []
+    by_time = sorted(snapshot.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    for name, (total, calls, misses) in by_time:
+        lines.append(f"  {name:<52} {total * 1000:9.1f}ms {total / calls * 1e6 if calls else 0:7.1f}µs/página")
+    failing = sorted((item for item in snapshot.items() if item[1][2]), key=lambda item: item[1][2], reverse=True)[:top]
+    for name, (total, calls, misses) in failing:
+        lines.append(f"  {name:<52} sem elemento em {misses}/{calls} páginas")
+    return lines
 
 # Função para extrair e formatar dados do HTML
 def extract_data_from_html(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
+    page = HtmlIndex(html_content)
 
-    if not soup.find("div", style="text-align:left;left:160px;top:80px;"):
+    if not page.elements("div", "style", "text-align:left;left:160px;top:80px;"):
         return None
 
-    data = {}
-
-    ctrc_number = safe_text(soup.find("div", style="text-align:left;left:160px;top:80px;"))
-    if ctrc_number:
-        match = re.match(r'([A-Za-z]+)(\d+)-(\d)', ctrc_number)
-        if match:
-            data['Unidade Emissor'] = match.group(1)
-            data['N° CTRC'] = match.group(2)
-            data['Dígito Verificador'] = match.group(3)
-        else:
-            data['Unidade Emissor'] = ''
-            data['N° CTRC'] = ''
-            data['Dígito Verificador'] = ''
-
-    data['Tipo Operação'] = safe_text(soup.find("div", style="text-align:left;left:256px;top:64px;color:darkred;")) or 'NORMAL'
-    data['Sequência CTRC'] = safe_text(soup.find("div", style="text-align:left;left:648px;top:64px;color:#777;"))
-    cte = safe_text(soup.find("a", id="link_cte_rps"))
-    data['Série CT-e'], data['Número CT-e'] = format_cte(cte)
-    data['Status'] = safe_text(soup.find("div", style="text-align:left;left:504px;top:96px;color:red;"))
-    situacao = safe_text(soup.find("div", style="text-align:left;left:64px;top:672px;"))
-    data['Domínio/Origem'], data['Situação Data/Hora'], data['Código Situação'] = format_situacao_atual(situacao)
-    data['Descrição Situação'] = safe_text(soup.find("div", id="descricao"))
-    data['Domínio'] = safe_text(soup.find("div", style="text-align:left;left:776px;top:64px;"))
-    data['Empresa'] = safe_text(soup.find("div", style="text-align:left;left:896px;top:64px;"))
-    inclusao = safe_text(soup.find("div", style="text-align:left;left:160px;top:112px;"))
-    data['Inclusão Data/Hora'] = format_date_time(inclusao)
-    data['Usuário Inclusão'] = safe_text(soup.find("div", style="text-align:left;left:256px;top:112px;"))
-    emissao = safe_text(soup.find("div", style="left:400px;top:96px;width:96px;color:red;"))
-    data['Emissão Data/Hora'] = format_date_time(emissao)
-    data['Previsão Entrega'] = format_date(safe_text(soup.find("div", style="text-align:left;left:776px;top:112px;")))
-    data['Prazo Unidade Destinatária'] = format_date(safe_text(soup.find("div", style="text-align:left;left:776px;top:144px;")))
-    data['Destino'] = safe_text(soup.find("div", style="text-align:left;left:776px;top:96px;color:darkred;")).replace('  ', ' ')
-
-    nota = safe_text(soup.find("div", style="text-align:left;left:160px;top:128px;"))
-    data['Série Nota Fiscal'], data['Número Nota Fiscal'] = format_nota_fiscal(nota)
-    data['Quantidade Volumes'] = format_volumes(safe_text(soup.find("div", style="text-align:left;left:160px;top:144px;")))
-    data['Tipo Mercadoria'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:160px;")).split('-')[-1] if '-' in safe_text(soup.find("div", style="text-align:left;left:160px;top:160px;")) else ''
-    data['Peso Cálculo (Kg)'] = format_decimal(safe_text(soup.find("div", style="text-align:left;left:160px;top:176px;")))
-    data['Peso Real (Kg)'] = format_decimal(safe_text(soup.find("div", style="text-align:left;left:504px;top:176px;")))
-    data['Cubagem (m³)'] = format_decimal(safe_text(soup.find_all("div", style="text-align:left;left:776px;top:176px;")[-1]))
-    data['Valor Nota Fiscal (R$)'] = format_decimal(safe_text(soup.find("div", style="text-align:left;left:160px;top:192px;")))
-    data['Valor Frete (R$)'] = format_decimal(safe_text(soup.find("div", style="text-align:left;left:160px;top:208px;color:darkred;")))
-    data['ICMS/ISS (R$)'] = format_decimal(safe_text(soup.find("div", style="text-align:left;left:160px;top:224px;")))
-    data['Tipo Cobrança'] = safe_text(soup.find("div", style="text-align:left;left:504px;top:224px;")).replace('CIF', 'CIF').split('<')[0]
-    data['Situação Liquidação'] = safe_text(soup.find("div", style="text-align:left;left:504px;top:208px;color:darkred;"))
-
-    data['Remetente Nome'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:256px;")).replace(' (..)', '')
-    data['Remetente CNPJ'] = format_cnpj(safe_text(soup.find("a", id="link_cli_rem")))
-    data['Remetente Endereço'] = safe_text(soup.find('div', style='text-align:left;left:160px;top:368px;'))
-    data['Remetente Complemento'] = safe_text(soup.find('div', style='text-align:left;left:160px;top:384px;'))
-    data['Remetente Bairro'] = safe_text(soup.find('div', style='text-align:left;left:160px;top:400px;'))
-    cep_cidade = safe_text(soup.find("div", style="text-align:left;left:160px;top:288px;")).split()
-    data['Remetente CEP'] = cep_cidade[0] if cep_cidade else ''
-    data['Remetente Cidade'] = cep_cidade[-1].split('/')[0] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Remetente UF'] = cep_cidade[-1].split('/')[-1] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Remetente Telefone'] = format_phone(safe_text(soup.find("div", style="text-align:left;left:160px;top:304px;")))
-
-    data['Destinatário Nome'] = safe_text(soup.find("div", style="text-align:left;left:504px;top:256px;"))
-    data['Destinatário CNPJ'] = format_cnpj(safe_text(soup.find("a", id="link_cli_dest")))
-    data['Destinatário Endereço'] = safe_text(soup.find('div', style='text-align:left;left:504px;top:368px;'))
-    complemento = safe_text(soup.find("div", style="text-align:left;left:504px;top:384px;"))
-    data['Destinatário Complemento'] = '[Nenhum]' if complemento.startswith('CEL') else complemento
-    data['Destinatário Bairro'] = safe_text(soup.find('div', style='text-align:left;left:504px;top:400px;'))
-    cep_cidade = safe_text(soup.find("div", style="text-align:left;left:504px;top:288px;")).split()
-    data['Destinatário CEP'] = cep_cidade[0] if cep_cidade else ''
-    data['Destinatário Cidade'] = cep_cidade[-1].split('/')[0] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Destinatário UF'] = cep_cidade[-1].split('/')[-1] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Destinatário Telefone'] = format_phone(safe_text(soup.find("div", style="text-align:left;left:504px;top:304px;")))
-    data['Destinatário Celular'] = format_phone(safe_text(soup.find("div", style="text-align:left;left:696px;top:304px;")))
-
-    data['Expedidor Nome'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:336px;"))
-    data['Expedidor CNPJ'] = format_cnpj(safe_text(soup.find("a", id="link_cli_exp")))
-    data['Expedidor Endereço'] = safe_text(soup.find('div', style='text-align:left;left:160px;top:368px;'))
-    data['Expedidor Complemento'] = safe_text(soup.find('div', style='text-align:left;left:160px;top:384px;'))
-    data['Expedidor Bairro'] = safe_text(soup.find('div', style='text-align:left;left:160px;top:400px;'))
-    cep_cidade = safe_text(soup.find("div", style="text-align:left;left:160px;top:416px;")).split()
-    data['Expedidor CEP'] = cep_cidade[0] if cep_cidade else ''
-    data['Expedidor Cidade'] = cep_cidade[-1].split('/')[0] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Expedidor UF'] = cep_cidade[-1].split('/')[-1] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Expedidor Telefone'] = format_phone(safe_text(soup.find("div", style="text-align:left;left:160px;top:432px;")))
-
-    data['Entrega Nome'] = safe_text(soup.find("div", style="text-align:left;left:504px;top:336px;"))
-    data['Entrega CNPJ'] = format_cnpj(safe_text(soup.find("a", id="link_cli_ent")))
-    data['Entrega Endereço'] = safe_text(soup.find('div', style='text-align:left;left:504px;top:368px;'))
-    data['Entrega Complemento'] = '[Nenhum]' if complemento.startswith('CEL') else complemento
-    data['Entrega Bairro'] = safe_text(soup.find('div', style='text-align:left;left:504px;top:400px;'))
-    cep_cidade = safe_text(soup.find("div", style="text-align:left;left:504px;top:416px;")).split()
-    data['Entrega CEP'] = cep_cidade[0] if cep_cidade else ''
-    data['Entrega Cidade'] = cep_cidade[-1].split('/')[0] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Entrega UF'] = cep_cidade[-1].split('/')[-1] if cep_cidade and '/' in cep_cidade[-1] else ''
-    data['Entrega Telefone'] = format_phone(safe_text(soup.find("div", style="text-align:left;left:504px;top:432px;")))
-    data['Entrega Celular'] = format_phone(safe_text(soup.find("div", style="text-align:left;left:696px;top:432px;")))
-
-    data['Pagador Nome'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:464px;")).replace(' (..)', '')
-    data['Pagador CNPJ'] = format_cnpj(safe_text(soup.find("a", id="link_cli_pag")))
-
-    origem = safe_text(soup.find("div", style="text-align:left;left:160px;top:512px;"))
-    data['Origem Código'], rest = safe_split(origem, ' / ', 2, '')
-    data['Origem UF'], data['Origem Cidade'] = safe_split(rest, ' - ', 2, '')
-    destino = safe_text(soup.find("div", style="text-align:left;left:160px;top:528px;"))
-    data['Destino Código'], rest = safe_split(destino, ' / ', 2, '')
-    data['Destino UF'], data['Destino Cidade'] = safe_split(rest, ' - ', 2, '')
-    data['CFOP'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:544px;"))
-    data['Veículo Coleta'] = safe_text(soup.find("div", style="text-align:left;left:776px;top:160px;"))
-    conferente = safe_text(soup.find("div", style="text-align:left;left:504px;top:144px;"))
-    data['Conferente Coleta'] = ' '.join(conferente.split()[1:]) if conferente else ''
-    romaneio = safe_text(soup.find("div", style="text-align:left;left:568px;top:464px;"))
-    data['Romaneio Número'], data['Placa Entrega'] = safe_split(romaneio, '/', 2, '')
-    remessa = safe_text(soup.find("div", style="text-align:left;left:568px;top:480px;"))
-    data_hora = safe_text(soup.find("div", style="text-align:left;left:688px;top:480px;"))
-    data['Código Remessa'], data['Remessa Data/Hora'] = format_remessa(remessa, data_hora)
-
-    data['Observação'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:560px;color:darkred;")) or '[Nenhuma]'
-    data['Instrução Entrega'] = safe_text(soup.find("div", style="text-align:left;left:160px;top:640px;color:darkred;")) or '[Nenhuma]'
+    return run_plan(P1_PLAN, page)
 
-    return data
-
-# Função para extrair a chave da NF
-def extract_nf_key(cookies, headers, seq_ctrc):
+# HTML da consulta act='A' (chave da NF)
+def fetch_nf_html(cookies, headers, seq_ctrc):
     data = {
         'act': 'A',
         'aviso_resgate': '#aviso_resgate#',
@@ -257,51 +341,23 @@ def extract_nf_key(cookies, headers, seq_ctrc):
         'FAMILIA': 'RDM',
         'dummy': str(int(time.time() * 1000)),
     }
+    return ssw_http.post(ssw_http.ssw_url('ssw0053'), coalesce=True, cookies=cookies, headers=headers, data=data).text
 
+# Função para extrair a chave da NF
+def extract_nf_key(cookies, headers, seq_ctrc):
     try:
-        response = requests.post('https://sistema.ssw.inf.br/bin/ssw0053', cookies=cookies, headers=headers, data=data)
-        html_content = response.text
-        pattern = r"portal_nfe\('(\d{44})'\)"
-        match = re.search(pattern, html_content)
-        return match.group(1) if match else ''
+        return parse_nf_key(fetch_nf_html(cookies, headers, seq_ctrc))
     except Exception as e:
         print(f"Erro ao extrair chave NF: {e}")
         return ''
 
-# Função para verificar comprovante de entrega
-def check_delivery_receipt(cookies, headers, seq_ctrc):
-    data = {
-        'act': 'O',
-        'aviso_resgate': '#aviso_resgate#',
-        'g_ctrc_ser_ctrc': '',
-        'g_ctrc_nro_ctrc': '0',
-        'gw_nro_nf_ini': '',
-        'g_ctrc_nf_vol_ini': '0',
-        'gw_ctrc_nr_sscc': '',
-        'g_ctrc_nro_ctl_form': '0',
-        'gw_ctrc_parc_nro_ctrc_parc': '0',
-        'g_ctrc_c_chave_fis': '',
-        'gw_gaiola_codigo': '0',
-        'gw_pallet_codigo': '0',
-        'local': 'Q',
-        'data_ini_inf': '9/2/25',
-        'data_fin_inf': datetime.now().strftime('%d/%m/%y'),
-        'seq_ctrc': seq_ctrc,
-        'FAMILIA': 'RDM',
-        'dummy': str(int(time.time() * 1000)),
-    }
+# Chave da NF a partir do HTML da consulta act='A'
+def parse_nf_key(html_content):
+    match = re.search(r"portal_nfe\('(\d{44})'\)", html_content)
+    return match.group(1) if match else ''
 
-    try:
-        response = requests.post('https://sistema.ssw.inf.br/bin/ssw0053', cookies=cookies, headers=headers, data=data)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        image_references = soup.find_all('f9')
-        return "SIM" if any('Imagem' in ref.text for ref in image_references) else "NAO"
-    except Exception as e:
-        print(f"Erro ao verificar comprovante de entrega: {e}")
-        return "NAO"
-
-# Função para extrair informações de rastreamento
-def extract_tracking_info(cookies, headers, seq_ctrc):
+# Consulta a página de ocorrências (act='O') uma única vez por seq_ctrc
+def fetch_occurrences_page(cookies, headers, seq_ctrc):
     data = {
         'act': 'O',
         'aviso_resgate': '#aviso_resgate#',
@@ -322,47 +378,172 @@ def extract_tracking_info(cookies, headers, seq_ctrc):
         'FAMILIA': 'RDM',
         'dummy': str(int(time.time() * 1000)),
     }
+    return ssw_http.post(ssw_http.ssw_url('ssw0053'), coalesce=True, cookies=cookies, headers=headers, data=data)
+
+def empty_tracking_data():
+    return {
+        "ocorrencia_data_Data de Emissão CTRC": "",
+        "ocorrencia_data_Saída de Unidade": "",
+        "ocorrencia_data_Chegada em Unidade de Entrega": "",
+        "ocorrencia_data_Saída para Entrega": "",
+        "ocorrencia_data_Entregue": "",
+        "ocorrencia_data_Tentativas de Entrega": 0
+    }
 
+# Comprovante de entrega a partir da página de ocorrências já parseada
+def parse_delivery_receipt(soup):
+    image_references = soup.find_all('f9')
+    return "SIM" if any('Imagem' in ref.text for ref in image_references) else "NAO"
+
+# Datas de rastreamento a partir da página de ocorrências já parseada
+def parse_tracking_info(soup):
+    records = []
+    xml_data = soup.find('xml', id='xmlsr')
+    if xml_data:
+        for record in xml_data.find_all('r'):
+            fields = {}
+            for child in record.find_all(True):
+                fields.setdefault(child.name, child.text.strip())
+            records.append(fields)
+    return summarize_tracking(records)
+
+# Resumo do rastreamento a partir dos registros <r> ({tag: texto}, na ordem
+# da página): as datas de cada etapa, o número de tentativas de entrega e,
+# em 'ocorrencias', todos os eventos com a data_hora já normalizada
+def summarize_tracking(records):
+    tracking_data = empty_tracking_data()
+    events = []
+    for fields in records:
+        data_hora_registro = fields.get('f3', '')
+        if data_hora_registro:
+            data_hora_registro = format_date_time(data_hora_registro)
+        status_resumido = fields.get('f10', '')
+
+        if status_resumido == "80 - DOCUMENTO DE TRANSPORTE EMITIDO":
+            tracking_data["ocorrencia_data_Data de Emissão CTRC"] = data_hora_registro
+        elif status_resumido == "82 - SAIDA DE UNIDADE":
+            tracking_data["ocorrencia_data_Saída de Unidade"] = data_hora_registro
+        elif status_resumido == "84 - CHEGADA EM UNIDADE DE ENTREGA":
+            tracking_data["ocorrencia_data_Chegada em Unidade de Entrega"] = data_hora_registro
+        elif status_resumido == "85 - SAIDA PARA ENTREGA":
+            tracking_data["ocorrencia_data_Tentativas de Entrega"] += 1
+            if not tracking_data["ocorrencia_data_Saída para Entrega"] or data_hora_registro > tracking_data["ocorrencia_data_Saída para Entrega"]:
+                tracking_data["ocorrencia_data_Saída para Entrega"] = data_hora_registro
+        elif status_resumido == "01 - MERCADORIA ENTREGUE":
+            tracking_data["ocorrencia_data_Entregue"] = data_hora_registro
+
+        events.append(dict(fields, data_hora=data_hora_registro))
+    tracking_data['ocorrencias'] = events
+    return tracking_data
+
+# Leitura da página de ocorrências sem montar a árvore da página inteira: a
+# ilha <xml id="xmlsr"> é localizada por expressão regular e seus registros
+# <r> são lidos por um parser incremental (lxml), descartando cada registro
+# depois de lido
+XML_OPEN_TAG = re.compile(r'<xml\b[^>]*>', re.I)
+XMLSR_ID = re.compile(r'''\b[iI][dD]\s*=\s*(["']?)xmlsr\1(?![\w-])''')
+XML_CLOSE_TAG = re.compile(r'</xml\s*>', re.I)
+F9_TAG = re.compile(r'<f9\b', re.I)
+
+# (início, fim) do conteúdo da ilha xmlsr, ou None se a página não tem;
+# ValueError se a ilha não pode ser delimitada
+def find_tracking_island(html_content):
+    for match in XML_OPEN_TAG.finditer(html_content):
+        if XMLSR_ID.search(match.group(0)):
+            close = XML_CLOSE_TAG.search(html_content, match.end())
+            if close is None:
+                raise ValueError("Ilha xmlsr sem </xml>")
+            return match.end(), close.start()
+    return None
+
+# Gera ('f9', texto) para cada <f9> e ('r', {tag: texto}) para cada registro,
+# na ordem em que terminam no documento
+def iter_tracking_elements(xml_content, chunk_size=64 * 1024):
+    parser = etree.HTMLPullParser(events=('end',), tag=('r', 'f9'))
+    for start in range(0, len(xml_content), chunk_size):
+        parser.feed(xml_content[start:start + chunk_size])
+        yield from _read_tracking_events(parser)
     try:
-        response = requests.post('https://sistema.ssw.inf.br/bin/ssw0053', cookies=cookies, headers=headers, data=data)
-        if response.status_code == 200 and response.text:
-            soup = BeautifulSoup(response.text, 'lxml')
-
-            tracking_data = {
-                "ocorrencia_data_Data de Emissão CTRC": "",
-                "ocorrencia_data_Saída de Unidade": "",
-                "ocorrencia_data_Chegada em Unidade de Entrega": "",
-                "ocorrencia_data_Saída para Entrega": "",
-                "ocorrencia_data_Entregue": "",
-                "ocorrencia_data_Tentativas de Entrega": 0
-            }
-
-            xml_data = soup.find('xml', id='xmlsr')
-
-            if xml_data:
-                records = xml_data.find_all('r')
-
-                for record in records:
-                    data_hora_registro = record.f3.text.strip() if record.f3 else ""
-                    if data_hora_registro:
-                        data_hora_registro = format_date_time(data_hora_registro)
-                    status_resumido = record.f10.text.strip() if record.f10 else ""
-
-                    if status_resumido == "80 - DOCUMENTO DE TRANSPORTE EMITIDO":
-                        tracking_data["ocorrencia_data_Data de Emissão CTRC"] = data_hora_registro
-                    elif status_resumido == "82 - SAIDA DE UNIDADE":
-                        tracking_data["ocorrencia_data_Saída de Unidade"] = data_hora_registro
-                    elif status_resumido == "84 - CHEGADA EM UNIDADE DE ENTREGA":
-                        tracking_data["ocorrencia_data_Chegada em Unidade de Entrega"] = data_hora_registro
-                    elif status_resumido == "85 - SAIDA PARA ENTREGA":
-                        tracking_data["ocorrencia_data_Tentativas de Entrega"] += 1
-                        if not tracking_data["ocorrencia_data_Saída para Entrega"] or data_hora_registro > tracking_data["ocorrencia_data_Saída para Entrega"]:
-                            tracking_data["ocorrencia_data_Saída para Entrega"] = data_hora_registro
-                    elif status_resumido == "01 - MERCADORIA ENTREGUE":
-                        tracking_data["ocorrencia_data_Entregue"] = data_hora_registro
-
-            return tracking_data
-        return None
+        parser.close()
+    except etree.XMLSyntaxError:
+        return  # ilha vazia
+    yield from _read_tracking_events(parser)
+
+def _read_tracking_events(parser):
+    for _, element in parser.read_events():
+        if element.tag == 'f9':
+            yield 'f9', ''.join(element.itertext())
+            continue
+        fields = {}
+        for child in element.iter():
+            if child is not element and isinstance(child.tag, str) and child.tag not in fields:
+                fields[child.tag] = ''.join(child.itertext()).strip()
+        yield 'r', fields
+        # Registro já lido: libera o elemento e os irmãos anteriores
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+# Busca a página de ocorrências uma vez e extrai, do mesmo parse, o
+# comprovante de entrega e as datas de rastreamento.
+# Retorna (comprovante, tracking_data); tracking_data é None se a resposta
+# vier vazia ou com erro.
+def extract_occurrences(cookies, headers, seq_ctrc):
+    try:
+        html_content = fetch_occurrences_html(cookies, headers, seq_ctrc)
+        if html_content:
+            return parse_occurrences(html_content)
+        return "NAO", None
     except Exception as e:
-        print(f"Erro ao extrair informações de rastreamento: {e}")
-        return None
+        print(f"Erro ao extrair ocorrências: {e}")
+        return "NAO", None
+
+# HTML da página de ocorrências, ou None se a resposta vier vazia ou com erro
+def fetch_occurrences_html(cookies, headers, seq_ctrc):
+    response = fetch_occurrences_page(cookies, headers, seq_ctrc)
+    if response.status_code == 200 and response.text:
+        return response.text
+    return None
+
+# Comprovante e rastreamento a partir do HTML da página de ocorrências
+def parse_occurrences(html_content):
+    with perf_stats.timed('parse'):
+        try:
+            island = find_tracking_island(html_content)
+        except ValueError:
+            island = False
+        outside = html_content if not island else html_content[:island[0]] + html_content[island[1]:]
+        if island is False or F9_TAG.search(outside):
+            # Página fora do formato esperado: parse completo
+            soup = BeautifulSoup(html_content, 'lxml')
+            return parse_delivery_receipt(soup), parse_tracking_info(soup)
+
+        comprovante = "NAO"
+        records = []
+        if island is not None:
+            for kind, value in iter_tracking_elements(html_content[island[0]:island[1]]):
+                if kind == 'f9':
+                    if 'Imagem' in value:
+                        comprovante = "SIM"
+                else:
+                    records.append(value)
+        return comprovante, summarize_tracking(records)
+
+# Impressão digital das respostas brutas de um CTRC (act=P1 e act=O): se não
+# mudou desde a última consulta, não há o que parsear nem gravar
+def page_fingerprint(*pages):
+    digest = hashlib.sha1()
+    for page in pages:
+        digest.update((page or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Função para verificar comprovante de entrega
+def check_delivery_receipt(cookies, headers, seq_ctrc):
+    comprovante, _ = extract_occurrences(cookies, headers, seq_ctrc)
+    return comprovante
+
+# Função para extrair informações de rastreamento
+def extract_tracking_info(cookies, headers, seq_ctrc):
+    _, tracking_data = extract_occurrences(cookies, headers, seq_ctrc)
+    return tracking_data
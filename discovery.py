@@ -0,0 +1,81 @@
+import sqlite3
+from datetime import datetime
+
+# Descoberta do último CTRC emitido por filial: sondagens com passo
+# exponencial (galope) a partir da marca d'água até achar um número que não
+# existe, seguidas de busca binária entre o último existente e ele.
+#
+# Como há números pulados/cancelados no meio da sequência, um número conta
+# como "existente" se ele ou algum dos `window - 1` seguintes existir.
+
+
+def _exists(probe, number, window):
+    return any(probe(number + offset) for offset in range(window))
+
+
+# probe(numero) -> True se o CTRC existe. `start` é um número já conhecido
+# (marca d'água). Retorna o maior número existente encontrado (>= start).
+def find_head(probe, start, window=3, max_step=1024):
+    cache = {}
+
+    def cached_probe(number):
+        if number not in cache:
+            cache[number] = probe(number)
+        return cache[number]
+
+    low = start
+    step = 1
+    high = None
+    while high is None:
+        candidate = low + step
+        if _exists(cached_probe, candidate, window):
+            low = candidate
+            step = min(step * 2, max_step)
+        else:
+            high = candidate
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _exists(cached_probe, middle, window):
+            low = middle
+        else:
+            high = middle
+
+    # `low` pode ter sido aceito por um vizinho da janela; devolve o maior
+    # número que de fato existe abaixo de `high`
+    for number in range(min(low + window - 1, high - 1), low, -1):
+        if cached_probe(number):
+            return number
+    return low
+
+
+# Marca d'água persistida: todos os números até ela já foram buscados. Só
+# avança: com shards, um worker que perdeu a filial não a faz voltar.
+def ensure_state_table(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingestao_estado (
+            serie TEXT PRIMARY KEY,
+            watermark INTEGER NOT NULL,
+            atualizado_em TEXT
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def load_watermark(db_path, serie):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute('SELECT watermark FROM ingestao_estado WHERE serie = ?', (serie,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def save_watermark(db_path, serie, watermark):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        INSERT INTO ingestao_estado (serie, watermark, atualizado_em) VALUES (?, ?, ?)
+        ON CONFLICT(serie) DO UPDATE SET watermark = MAX(ingestao_estado.watermark, excluded.watermark), atualizado_em = excluded.atualizado_em
+    ''', (serie, watermark, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    conn.close()
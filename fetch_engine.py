@@ -0,0 +1,133 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Limite ajustável de requisições em andamento para uma filial. O estado é
+# protegido pela condição do FetchEngine.
+class FilialLimiter:
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.in_flight = 0
+
+
+# Motor de coleta: um pool de threads de longa duração, criado uma vez só
+# (em vez de um ThreadPoolExecutor novo a cada ciclo), com limite de
+# concorrência por filial. O SSW é consultado pelo requests, que só tem API
+# bloqueante: cada requisição em andamento ocupa uma thread, então o total
+# em andamento fica limitado pelo tamanho do pool (max_threads).
+#
+# Quem chama despacha as tarefas: uma tarefa só vai para o pool quando a
+# filial tem vaga, alternando entre as filiais, então uma filial lenta não
+# ocupa as threads das outras. Várias chamadas ao mesmo tempo (ingestão,
+# reconsulta, lacunas) dividem os mesmos limites.
+class FetchEngine:
+    def __init__(self, concurrency_per_filial=10, max_threads=None):
+        self.concurrency_per_filial = concurrency_per_filial
+        self.max_threads = max_threads
+        self._executor = None
+        self._limiters = {}
+        self._slots = threading.Condition()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_threads or 32, thread_name_prefix='ssw')
+
+    def stop(self):
+        with self._lock:
+            if self._executor is None:
+                return
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _limiter(self, serie):
+        if serie not in self._limiters:
+            self._limiters[serie] = FilialLimiter(self.concurrency_per_filial)
+        return self._limiters[serie]
+
+    # Altera o limite de uma filial; pode ser chamado de qualquer thread
+    def set_limit(self, serie, limit):
+        with self._slots:
+            self._limiter(serie).limit = max(1, int(limit))
+            self._slots.notify_all()
+
+    def limits(self):
+        with self._slots:
+            return {serie: limiter.limit for serie, limiter in self._limiters.items()}
+
+    def _run_task(self, task, limiter, ready):
+        filial, fn, args = task
+        try:
+            result = fn(*args)
+        except Exception as e:
+            print(f"Erro na tarefa {fn.__name__} da filial {filial['serie']}: {e}")
+            result = None
+        with self._slots:
+            limiter.in_flight -= 1
+            self._slots.notify_all()
+        ready.put((task, result))
+
+    # Envia ao pool até `capacity` tarefas das filiais com vaga, uma por
+    # filial a cada volta. Chamado com self._slots adquirido.
+    def _dispatch(self, waiting, ready, capacity):
+        submitted = 0
+        progress = True
+        while progress and waiting and (capacity is None or submitted < capacity):
+            progress = False
+            for serie in list(waiting):
+                if capacity is not None and submitted >= capacity:
+                    break
+                limiter = self._limiter(serie)
+                if limiter.in_flight >= limiter.limit:
+                    continue
+                task = waiting[serie].popleft()
+                if not waiting[serie]:
+                    del waiting[serie]
+                limiter.in_flight += 1
+                self._executor.submit(self._run_task, task, limiter, ready)
+                submitted += 1
+                progress = True
+        return submitted
+
+    # Executa as tarefas (filial, função, argumentos) respeitando o limite de
+    # cada filial e devolve pares (tarefa, resultado) na ordem de conclusão.
+    # Tarefas que levantam exceção têm resultado None.
+    def run(self, tasks):
+        return list(self.run_iter(tasks, buffer_size=None))
+
+    # Como run, mas entrega os pares (tarefa, resultado) à medida que ficam
+    # prontos. Com buffer_size, no máximo buffer_size tarefas ficam entre o
+    # envio ao pool e a entrega: se o consumidor não acompanha, o motor para
+    # de despachar em vez de acumular respostas na memória.
+    def run_iter(self, tasks, buffer_size=100):
+        waiting = {}
+        for task in tasks:
+            waiting.setdefault(task[0]['serie'], deque()).append(task)
+        remaining = sum(len(filial_tasks) for filial_tasks in waiting.values())
+        if not remaining:
+            return
+        self.start()
+        ready = queue.Queue()
+        outstanding = 0
+        try:
+            while remaining:
+                with self._slots:
+                    while True:
+                        capacity = None if not buffer_size else buffer_size - outstanding
+                        outstanding += self._dispatch(waiting, ready, capacity)
+                        if outstanding:
+                            break
+                        # Nenhuma vaga: espera outra chamada liberar uma
+                        self._slots.wait()
+                item = ready.get()
+                outstanding -= 1
+                remaining -= 1
+                yield item
+        finally:
+            # Consumidor interrompido: espera as tarefas já enviadas
+            while outstanding:
+                ready.get()
+                outstanding -= 1
@@ -0,0 +1,253 @@
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+# zstd é opcional: sem o pacote zstandard as respostas são comprimidas com zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Arquivo local das respostas brutas do ssw0053, para reprocessar o histórico
+# sem voltar ao SSW. Cada HTML é guardado uma única vez (chave = SHA-1 do
+# conteúdo), comprimido, e indexado por (filial, CTRC, act, buscado_em).
+#
+# A gravação é feita por uma thread própria, em lotes, para não atrasar os
+# workers da ingestão. buscado_em usa o fuso tz, o mesmo da
+# ultima_verificacao dos registros (o reparse compara os dois).
+
+ARCHIVED_ACTS = ('P1', 'A', 'O')
+
+
+def _compress(text):
+    payload = text.encode('utf-8')
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(payload)
+    return 'zlib', zlib.compress(payload, 9)
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Resposta arquivada com zstd, mas o pacote zstandard não está instalado")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class HtmlArchive:
+    def __init__(self, path, retention_days=None, keep_latest=1,
+                 retention_interval=24 * 3600, batch_size=200, tz=None):
+        self.path = path
+        self.retention_days = retention_days
+        self.keep_latest = keep_latest
+        self.retention_interval = retention_interval
+        self.batch_size = batch_size
+        self.tz = tz
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stop = threading.Event()
+        self._ensure_tables()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _now(self):
+        return datetime.now(self.tz)
+
+    def _ensure_tables(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS html_conteudo (
+                hash TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                tamanho INTEGER NOT NULL,
+                dados BLOB NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS html_respostas (
+                id INTEGER PRIMARY KEY,
+                serie TEXT NOT NULL,
+                ctrc INTEGER NOT NULL,
+                act TEXT NOT NULL,
+                buscado_em TEXT NOT NULL,
+                hash TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_html_respostas_chave ON html_respostas (serie, ctrc, act, buscado_em)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_html_respostas_hash ON html_respostas (hash)')
+        conn.commit()
+        conn.close()
+
+    # Observador do ssw_http: enfileira as respostas do ssw0053 com a filial
+    # e o CTRC do contexto da requisição
+    def observe(self, context, url, data, elapsed, response, error):
+        if error is not None or response.status_code != 200 or not url.endswith('/ssw0053'):
+            return
+        act = data.get('act')
+        if act not in ARCHIVED_ACTS or not response.text.strip() or "CTRC não encontrado" in response.text:
+            return
+        serie, ctrc = context.get('serie'), context.get('ctrc')
+        if not serie or ctrc is None:
+            return
+        self.put(serie, ctrc, act, response.text)
+
+    def put(self, serie, ctrc, act, html, fetched_at=None):
+        fetched_at = fetched_at or self._now().strftime('%Y-%m-%d %H:%M:%S')
+        self._queue.put((serie, int(ctrc), act, fetched_at, html))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='html-archive', daemon=True)
+            self._thread.start()
+
+    # Para a thread depois de gravar o que ainda está na fila
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        else:
+            while self.flush():
+                pass
+
+    def _run(self):
+        last_retention = 0
+        while not (self._stop.is_set() and self._queue.empty()):
+            self.flush(block_timeout=1)
+            if self.retention_days is not None and time.time() - last_retention >= self.retention_interval:
+                self.apply_retention()
+                last_retention = time.time()
+
+    # Grava as respostas enfileiradas, em lotes de batch_size
+    def flush(self, block_timeout=None):
+        items = []
+        try:
+            items.append(self._queue.get(timeout=block_timeout) if block_timeout else self._queue.get_nowait())
+            while len(items) < self.batch_size:
+                items.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if not items:
+            return 0
+
+        rows = []
+        blobs = {}
+        for serie, ctrc, act, fetched_at, html in items:
+            digest = content_hash(html)
+            if digest not in blobs:
+                blobs[digest] = html
+            rows.append((serie, ctrc, act, fetched_at, digest))
+
+        conn = self._connect()
+        try:
+            known = set()
+            digests = list(blobs)
+            for i in range(0, len(digests), 500):
+                chunk = digests[i:i + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                known.update(row[0] for row in conn.execute(f'SELECT hash FROM html_conteudo WHERE hash IN ({placeholders})', chunk))
+            new_blobs = []
+            for digest, html in blobs.items():
+                if digest not in known:
+                    codec, data = _compress(html)
+                    new_blobs.append((digest, codec, len(html), data))
+            conn.executemany('INSERT OR IGNORE INTO html_conteudo (hash, codec, tamanho, dados) VALUES (?, ?, ?, ?)', new_blobs)
+            conn.executemany('INSERT INTO html_respostas (serie, ctrc, act, buscado_em, hash) VALUES (?, ?, ?, ?, ?)', rows)
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Erro ao gravar respostas no arquivo HTML: {e}")
+        finally:
+            conn.close()
+        return len(items)
+
+    # Remove respostas com mais de retention_days dias, mantendo sempre as
+    # keep_latest mais recentes de cada (filial, CTRC, act), e apaga os
+    # conteúdos que ficaram sem referência
+    def apply_retention(self, retention_days=None, keep_latest=None):
+        retention_days = self.retention_days if retention_days is None else retention_days
+        keep_latest = self.keep_latest if keep_latest is None else keep_latest
+        if retention_days is None:
+            return 0
+        cutoff = (self._now() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+        conn = self._connect()
+        try:
+            cursor = conn.execute('''
+                DELETE FROM html_respostas WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, buscado_em,
+                               ROW_NUMBER() OVER (PARTITION BY serie, ctrc, act ORDER BY buscado_em DESC, id DESC) AS ordem
+                        FROM html_respostas
+                    )
+                    WHERE buscado_em < ? AND ordem > ?
+                )
+            ''', (cutoff, keep_latest))
+            removed = cursor.rowcount
+            conn.execute('DELETE FROM html_conteudo WHERE hash NOT IN (SELECT hash FROM html_respostas)')
+            conn.commit()
+        finally:
+            conn.close()
+        if removed:
+            print(f"Arquivo HTML: {removed} respostas antigas removidas.")
+        return removed
+
+    # Leitura
+
+    def get(self, digest):
+        conn = self._connect()
+        row = conn.execute('SELECT codec, dados FROM html_conteudo WHERE hash = ?', (digest,)).fetchone()
+        conn.close()
+        return _decompress(*row) if row else None
+
+    # [(act, buscado_em, hash)] de um CTRC, da mais antiga para a mais recente
+    def versions(self, serie, ctrc, act=None):
+        query = 'SELECT act, buscado_em, hash FROM html_respostas WHERE serie = ? AND ctrc = ?'
+        params = [serie, int(ctrc)]
+        if act:
+            query += ' AND act = ?'
+            params.append(act)
+        conn = self._connect()
+        rows = conn.execute(query + ' ORDER BY buscado_em, id', params).fetchall()
+        conn.close()
+        return rows
+
+    def latest(self, serie, ctrc, act):
+        rows = self.versions(serie, ctrc, act)
+        return self.get(rows[-1][2]) if rows else None
+
+    # Resposta mais recente de cada (filial, CTRC, act), opcionalmente
+    # filtrada por filial e act: gera (serie, ctrc, act, buscado_em, html)
+    def iter_latest(self, serie=None, act=None):
+        conditions = []
+        params = []
+        if serie:
+            conditions.append('serie = ?')
+            params.append(serie)
+        if act:
+            conditions.append('act = ?')
+            params.append(act)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        conn = self._connect()
+        try:
+            rows = conn.execute(f'''
+                SELECT r.serie, r.ctrc, r.act, r.buscado_em, c.codec, c.dados FROM (
+                    SELECT serie, ctrc, act, buscado_em, hash,
+                           ROW_NUMBER() OVER (PARTITION BY serie, ctrc, act ORDER BY buscado_em DESC, id DESC) AS ordem
+                    FROM html_respostas {where}
+                ) AS r
+                JOIN html_conteudo AS c ON c.hash = r.hash
+                WHERE r.ordem = 1
+                ORDER BY r.serie, r.ctrc, r.act
+            ''', params)
+            for serie_value, ctrc, act_value, fetched_at, codec, data in rows:
+                yield serie_value, ctrc, act_value, fetched_at, _decompress(codec, data)
+        finally:
+            conn.close()
@@ -0,0 +1,242 @@
+import json
+import sqlite3
+import time
+
+from shard_leases import default_worker_id
+
+# Fila de trabalho persistente da ingestão, no SQLite. O que antes ficava só
+# na memória do processo sobrevive a uma queda:
+#   - 'descoberta': um job por filial, disponível no horário da próxima
+#     sondagem, com a pausa e o contador de buscas vazias no payload;
+#   - 'busca': um job por CTRC da faixa descoberta e ainda não gravado;
+#   - 'lacunas': um job por filial, disponível no horário da próxima passada
+#     do preenchimento de lacunas.
+# (A reconsulta dos existentes já é persistente: next_due_at nas tabelas.)
+#
+# dequeue entrega um lote e o esconde dos outros workers por
+# visibility_timeout segundos; um job não concluído nesse prazo (worker
+# morto) volta a ficar disponível. complete é idempotente: concluir de novo,
+# ou concluir um job entregue a dois workers, não tem efeito.
+#
+# Jobs são identificados por (tipo, chave): enfileirar de novo um job que
+# já existe não o duplica. grupo é a filial, para cada worker puxar só os
+# jobs das suas filiais (shard_leases.py). payload['numero'], se houver (o
+# CTRC dos jobs 'busca'), fica também na coluna indexada numero.
+
+PENDING = 'pendente'
+RUNNING = 'em_execucao'
+DONE = 'concluido'
+FAILED = 'falhou'
+
+
+class JobQueue:
+    def __init__(self, db_path, worker_id=None, visibility_timeout=300):
+        self.db_path = db_path
+        self.worker_id = worker_id or default_worker_id()
+        self.visibility_timeout = visibility_timeout
+        self._ensure_table()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def _ensure_table(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingestao_jobs (
+                id INTEGER PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                chave TEXT NOT NULL,
+                grupo TEXT,
+                payload TEXT,
+                numero INTEGER,
+                estado TEXT NOT NULL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                disponivel_em REAL NOT NULL,
+                worker TEXT,
+                erro TEXT,
+                atualizado_em REAL NOT NULL,
+                UNIQUE (tipo, chave)
+            )
+        ''')
+        columns = [info[1] for info in conn.execute('PRAGMA table_info(ingestao_jobs)')]
+        if 'numero' not in columns:
+            conn.execute('ALTER TABLE ingestao_jobs ADD COLUMN numero INTEGER')
+            conn.execute("UPDATE ingestao_jobs SET numero = CAST(json_extract(payload, '$.numero') AS INTEGER) WHERE payload IS NOT NULL")
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ingestao_jobs_fila ON ingestao_jobs (tipo, estado, disponivel_em)')
+        conn.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_ingestao_jobs_numero ON ingestao_jobs (tipo, grupo, numero)
+            WHERE estado IN ('{PENDING}', '{RUNNING}')
+        ''')
+        conn.close()
+
+    @staticmethod
+    def _job(row):
+        job_id, kind, key, group, payload, attempts, available_at = row
+        return {'id': job_id, 'tipo': kind, 'chave': key, 'grupo': group,
+                'payload': json.loads(payload) if payload else None,
+                'tentativas': attempts, 'disponivel_em': available_at}
+
+    # Enfileira [(chave, grupo, payload)] do tipo, disponíveis em available_at
+    # (agora, se None). Jobs já existentes ficam como estão; com reopen=True,
+    # os concluídos ou que falharam voltam para a fila.
+    def enqueue_many(self, kind, jobs, available_at=None, reopen=False):
+        now = time.time()
+        available_at = now if available_at is None else available_at
+        conflict = f'''DO UPDATE SET estado = '{PENDING}', tentativas = 0, erro = NULL, worker = NULL,
+                           payload = excluded.payload, numero = excluded.numero, disponivel_em = excluded.disponivel_em,
+                           atualizado_em = excluded.atualizado_em
+                       WHERE ingestao_jobs.estado IN ('{DONE}', '{FAILED}')''' if reopen else 'DO NOTHING'
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(f'''
+                INSERT INTO ingestao_jobs (tipo, chave, grupo, payload, numero, estado, disponivel_em, atualizado_em)
+                VALUES (?, ?, ?, ?, ?, '{PENDING}', ?, ?)
+                ON CONFLICT(tipo, chave) {conflict}
+            ''', [(kind, key, group, None if payload is None else json.dumps(payload),
+                   payload.get('numero') if isinstance(payload, dict) else None, available_at, now)
+                  for key, group, payload in jobs])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, key, group=None, payload=None, available_at=None, reopen=False):
+        self.enqueue_many(kind, [(key, group, payload)], available_at, reopen)
+
+    # Até limit jobs disponíveis do tipo (dos grupos, se informados), dos mais
+    # antigos para os mais novos, marcados como em execução por este worker.
+    # Inclui os em execução cujo prazo de visibilidade venceu.
+    def dequeue(self, kind, groups=None, limit=100, visibility_timeout=None):
+        if groups is not None and not groups:
+            return []
+        now = time.time()
+        visibility_timeout = self.visibility_timeout if visibility_timeout is None else visibility_timeout
+        group_filter = ''
+        params = [kind, now]
+        if groups is not None:
+            group_filter = f"AND grupo IN ({', '.join('?' for _ in groups)})"
+            params.extend(groups)
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(f'''
+                SELECT id, tipo, chave, grupo, payload, tentativas + 1, disponivel_em FROM ingestao_jobs
+                WHERE tipo = ? AND estado IN ('{PENDING}', '{RUNNING}') AND disponivel_em <= ? {group_filter}
+                ORDER BY disponivel_em, id
+                LIMIT ?
+            ''', params + [limit]).fetchall()
+            conn.executemany(f'''
+                UPDATE ingestao_jobs SET estado = '{RUNNING}', tentativas = tentativas + 1, worker = ?,
+                       disponivel_em = ?, atualizado_em = ?
+                WHERE id = ?
+            ''', [(self.worker_id, now + visibility_timeout, now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return [self._job(row) for row in rows]
+
+    # Marca os jobs como concluídos (idempotente)
+    def complete(self, job_ids):
+        self._update(job_ids, f"estado = '{DONE}', erro = NULL", f"estado != '{DONE}'")
+
+    # Devolve os jobs para a fila daqui a retry_delay segundos; os que já
+    # tiveram max_attempts tentativas ficam como 'falhou', fora da fila, até
+    # alguém reabri-los (enqueue_many com reopen=True). As tentativas só
+    # voltam a zero na reabertura, então max_attempts é o total.
+    def fail(self, job_ids, error=None, retry_delay=60, max_attempts=3):
+        self._update(job_ids, f'''
+            estado = CASE WHEN tentativas >= ? THEN '{FAILED}' ELSE '{PENDING}' END,
+            disponivel_em = ?, erro = ?''', f"estado = '{RUNNING}'", [max_attempts, time.time() + retry_delay, error])
+
+    # Devolve os jobs para a fila em available_at (agora, se None), com um
+    # payload novo, para jobs periódicos (descoberta, lacunas)
+    def reschedule(self, job_ids, available_at=None, payload=None):
+        available_at = time.time() if available_at is None else available_at
+        self._update(job_ids, f"estado = '{PENDING}', tentativas = 0, erro = NULL, disponivel_em = ?, payload = ?",
+                     None, [available_at, None if payload is None else json.dumps(payload)])
+
+    # Adia o prazo de visibilidade de jobs em execução demorados
+    def extend(self, job_ids, visibility_timeout=None):
+        visibility_timeout = self.visibility_timeout if visibility_timeout is None else visibility_timeout
+        self._update(job_ids, 'disponivel_em = ?', f"estado = '{RUNNING}' AND worker = ?",
+                     [time.time() + visibility_timeout], [self.worker_id])
+
+    def _update(self, job_ids, assignments, condition=None, params=(), condition_params=()):
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for i in range(0, len(job_ids), 500):
+                chunk = job_ids[i:i + 500]
+                where = f"id IN ({', '.join('?' for _ in chunk)})" + (f" AND {condition}" if condition else '')
+                conn.execute(f'UPDATE ingestao_jobs SET {assignments}, atualizado_em = ? WHERE {where}',
+                             list(params) + [time.time()] + chunk + list(condition_params))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    # Na partida de um worker único: os jobs que ficaram em execução (queda)
+    # voltam logo para a fila, sem esperar o prazo de visibilidade
+    def requeue_running(self):
+        conn = self._connect()
+        try:
+            cursor = conn.execute(f"UPDATE ingestao_jobs SET estado = '{PENDING}', disponivel_em = ?, worker = NULL WHERE estado = '{RUNNING}'",
+                                  (time.time(),))
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def get(self, kind, key):
+        conn = self._connect()
+        row = conn.execute('SELECT id, tipo, chave, grupo, payload, tentativas, disponivel_em FROM ingestao_jobs WHERE tipo = ? AND chave = ?',
+                           (kind, key)).fetchone()
+        conn.close()
+        return self._job(row) if row else None
+
+    # Segundos até o próximo job do tipo ficar disponível (0 se já há), ou
+    # None se não há nenhum na fila
+    def seconds_until_available(self, kind, groups=None):
+        if groups is not None and not groups:
+            return None
+        params = [kind]
+        group_filter = ''
+        if groups is not None:
+            group_filter = f"AND grupo IN ({', '.join('?' for _ in groups)})"
+            params.extend(groups)
+        conn = self._connect()
+        value = conn.execute(f'''
+            SELECT MIN(disponivel_em) FROM ingestao_jobs
+            WHERE tipo = ? AND estado IN ('{PENDING}', '{RUNNING}') {group_filter}
+        ''', params).fetchone()[0]
+        conn.close()
+        return None if value is None else max(0.0, value - time.time())
+
+    # Menor numero entre os jobs do tipo e grupo ainda na fila (pendentes ou
+    # em execução), ou None se não há nenhum. Os que falharam não contam.
+    def lowest_unfinished_number(self, kind, group):
+        conn = self._connect()
+        value = conn.execute(f'''
+            SELECT MIN(numero) FROM ingestao_jobs
+            WHERE tipo = ? AND grupo = ? AND estado IN ('{PENDING}', '{RUNNING}')
+        ''', (kind, group)).fetchone()[0]
+        conn.close()
+        return value
+
+    # {(tipo, estado): quantidade}, para acompanhamento
+    def counts(self):
+        conn = self._connect()
+        rows = conn.execute('SELECT tipo, estado, COUNT(*) FROM ingestao_jobs GROUP BY tipo, estado').fetchall()
+        conn.close()
+        return {(kind, state): count for kind, state, count in rows}
+
+    # Apaga os jobs concluídos ou que falharam há mais de older_than segundos
+    def purge(self, older_than=7 * 24 * 3600):
+        conn = self._connect()
+        try:
+            cursor = conn.execute(f"DELETE FROM ingestao_jobs WHERE estado IN ('{DONE}', '{FAILED}') AND atualizado_em < ?",
+                                  (time.time() - older_than,))
+            return cursor.rowcount
+        finally:
+            conn.close()
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+# Cache de respostas "CTRC não encontrado" por (filial, número), persistido
+# no SQLite (tabela ctrc_ausentes). A validade depende da distância até o
+# último CTRC conhecido da filial: perto do topo da sequência o número ainda
+# pode ser emitido, então é revalidado logo; muito atrás dele é um número
+# cancelado/pulado e fica no cache por muito mais tempo.
+#
+# Números acima do topo conhecido não entram no cache (ainda não emitidos).
+# As entradas vencidas são removidas (memória e banco) nas gravações, no
+# máximo uma vez a cada prune_interval segundos.
+
+
+def _format(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class NegativeCache:
+    def __init__(self, db_path, near_ttl=600, far_ttl=7 * 24 * 3600,
+                 near_distance=50, far_distance=5000, prune_interval=600):
+        self.db_path = db_path
+        self.near_ttl = near_ttl
+        self.far_ttl = far_ttl
+        self.near_distance = near_distance
+        self.far_distance = far_distance
+        self.prune_interval = prune_interval
+        self._last_prune = datetime.now()
+        self._heads = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._ensure_table()
+        self._load()
+
+    def _ensure_table(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ctrc_ausentes (
+                serie TEXT NOT NULL,
+                numero INTEGER NOT NULL,
+                verificado_em TEXT,
+                expira_em TEXT,
+                PRIMARY KEY (serie, numero)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _load(self):
+        conn = sqlite3.connect(self.db_path)
+        now = _format(datetime.now())
+        conn.execute('DELETE FROM ctrc_ausentes WHERE expira_em <= ?', (now,))
+        conn.commit()
+        for serie, numero, expira_em in conn.execute('SELECT serie, numero, expira_em FROM ctrc_ausentes'):
+            self._entries.setdefault(serie, {})[numero] = expira_em
+        conn.close()
+
+    # Último CTRC conhecido da filial, referência para a validade
+    def set_head(self, serie, head):
+        with self._lock:
+            if head is not None and head > self._heads.get(serie, -1):
+                self._heads[serie] = head
+
+    # Validade em segundos para um número a `distance` do topo: curta até
+    # near_distance, longa a partir de far_distance e linear no meio
+    def ttl_for(self, distance):
+        if distance <= self.near_distance:
+            return self.near_ttl
+        if distance >= self.far_distance:
+            return self.far_ttl
+        fraction = (distance - self.near_distance) / (self.far_distance - self.near_distance)
+        return self.near_ttl + fraction * (self.far_ttl - self.near_ttl)
+
+    def contains(self, serie, numero):
+        with self._lock:
+            expires_at = self._entries.get(serie, {}).get(numero)
+        return expires_at is not None and expires_at > _format(datetime.now())
+
+    # Números da filial com entrada ainda válida
+    def absent_numbers(self, serie):
+        now = _format(datetime.now())
+        with self._lock:
+            return {numero for numero, expires_at in self._entries.get(serie, {}).items() if expires_at > now}
+
+    def add(self, serie, numero):
+        self.add_many(serie, [numero])
+
+    def add_many(self, serie, numbers):
+        checked_at = datetime.now()
+        rows = []
+        prune = False
+        with self._lock:
+            if (checked_at - self._last_prune).total_seconds() >= self.prune_interval:
+                self._prune_entries(_format(checked_at))
+                self._last_prune = checked_at
+                prune = True
+            head = self._heads.get(serie)
+            entries = self._entries.setdefault(serie, {})
+            for numero in numbers:
+                if head is None or numero > head:
+                    continue
+                expires_at = _format(checked_at + timedelta(seconds=self.ttl_for(head - numero)))
+                entries[numero] = expires_at
+                rows.append((serie, numero, _format(checked_at), expires_at))
+        if not rows and not prune:
+            return
+        conn = sqlite3.connect(self.db_path)
+        if prune:
+            conn.execute('DELETE FROM ctrc_ausentes WHERE expira_em <= ?', (_format(checked_at),))
+        conn.executemany('''
+            INSERT INTO ctrc_ausentes (serie, numero, verificado_em, expira_em) VALUES (?, ?, ?, ?)
+            ON CONFLICT(serie, numero) DO UPDATE SET verificado_em = excluded.verificado_em, expira_em = excluded.expira_em
+        ''', rows)
+        conn.commit()
+        conn.close()
+
+    # Remove da memória as entradas vencidas (com o _lock já adquirido)
+    def _prune_entries(self, now):
+        for serie in list(self._entries):
+            entries = self._entries[serie]
+            for numero in [numero for numero, expires_at in entries.items() if expires_at <= now]:
+                del entries[numero]
+            if not entries:
+                del self._entries[serie]
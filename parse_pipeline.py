@@ -0,0 +1,136 @@
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+from functools import partial
+
+import perf_stats
+
+# Coleta em estágios, separando a rede do parse:
+#   - as threads do motor de coleta (fetch_engine.py) só baixam as páginas e
+#     as entregam numa fila limitada;
+#   - um pool de processos, do tamanho do número de núcleos, faz o parse
+#     (CPU, fora do GIL das threads de rede);
+#   - uma única thread grava os registros, em lotes.
+# Se o parse não acompanha a rede, a fila enche e o motor para de despachar
+# consultas; o número de páginas aguardando parse também é limitado.
+
+
+# Executado nos processos do pool: as estatísticas do parse (etapas e campos)
+# voltam com o resultado, para entrar no perf_stats do processo principal
+def _parse_in_worker(parse_fn, pages):
+    result = parse_fn(pages)
+    return result, perf_stats.drain()
+
+
+class ParsePipeline:
+    def __init__(self, engine, parse_fn, fallback_fn=None, processes=None,
+                 queue_size=200, write_batch_size=100):
+        self.engine = engine
+        self.parse_fn = parse_fn
+        self.fallback_fn = fallback_fn
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.write_batch_size = write_batch_size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: os processos de parse não herdam as threads do principal
+                # (motor de coleta, token, arquivo HTML)
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def stop(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+    # Executa as tarefas (filial, fetch_fn, argumentos). fetch_fn retorna
+    # (status, dados); só o status 'paginas' vai para o parse_fn no pool, os
+    # demais seguem direto. Se o parse_fn retorna 'refazer', a tarefa é
+    # repetida inteira pelo fallback_fn (mesmos argumentos) no motor de coleta.
+    # write_fn(lote), se informado, recebe listas de (tarefa, status, dados)
+    # numa única thread de gravação. Retorna todos os (tarefa, status, dados).
+    def run(self, tasks, write_fn=None):
+        tasks = list(tasks)
+        if not tasks:
+            return []
+        results = []
+        results_lock = threading.Lock()
+        retry_tasks = []
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        writer = None
+        if write_fn is not None:
+            writer = threading.Thread(target=self._write_loop, args=(write_queue, write_fn), name='parse-writer', daemon=True)
+            writer.start()
+        parse_slots = threading.BoundedSemaphore(self.queue_size)
+        parsed_count = threading.Semaphore(0)
+
+        def finish(task, status, data):
+            with results_lock:
+                results.append((task, status, data))
+            if writer is not None:
+                write_queue.put((task, status, data))
+
+        def parsed(task, future):
+            try:
+                (status, data), worker_stats = future.result()
+                perf_stats.merge(worker_stats)
+            except Exception as e:
+                print(f"Erro no parse da filial {task[0]['serie']}: {e}")
+                status, data = 'erro', None
+            if status == 'refazer' and self.fallback_fn is not None:
+                with results_lock:
+                    retry_tasks.append(task)
+            else:
+                finish(task, status, data)
+            parse_slots.release()
+            parsed_count.release()
+
+        try:
+            submitted = 0
+            pool = self._get_pool()
+            for task, outcome in self.engine.run_iter(tasks, self.queue_size):
+                status, data = outcome if outcome else ('erro', None)
+                if status != 'paginas':
+                    finish(task, status, data)
+                    continue
+                parse_slots.acquire()
+                pool.submit(_parse_in_worker, self.parse_fn, data).add_done_callback(partial(parsed, task))
+                submitted += 1
+            for _ in range(submitted):
+                parsed_count.acquire()
+
+            # A leitura rápida da P1 não bateu com o parse: consulta completa
+            if retry_tasks:
+                fallback_tasks = [(filial, self.fallback_fn, args) for filial, _, args in retry_tasks]
+                for task, outcome in self.engine.run(fallback_tasks):
+                    status, data = outcome if outcome else ('erro', None)
+                    finish(task, status, data)
+        finally:
+            if writer is not None:
+                write_queue.put(None)
+                writer.join()
+        return results
+
+    def _write_loop(self, write_queue, write_fn):
+        batch = []
+        while True:
+            item = write_queue.get()
+            if item is not None:
+                batch.append(item)
+            # Grava quando o lote enche ou a fila esvazia
+            if batch and (item is None or len(batch) >= self.write_batch_size or write_queue.empty()):
+                try:
+                    write_fn(batch)
+                except Exception as e:
+                    print(f"Erro ao gravar lote de {len(batch)} CTRCs: {e}")
+                batch = []
+            if item is None:
+                return
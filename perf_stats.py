@@ -0,0 +1,111 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Acumulador de tempo por etapa (rede, parse, banco...), seguro entre threads
+class StageStats:
+    def __init__(self):
+        self._totals = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._totals[stage] = self._totals.get(stage, 0.0) + seconds
+            self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    # {etapa: (tempo_total, chamadas)}
+    def snapshot(self):
+        with self._lock:
+            return {stage: (total, self._counts[stage]) for stage, total in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+            self._counts.clear()
+
+    # Snapshot e zera, de uma vez (para enviar a outro processo)
+    def drain(self):
+        with self._lock:
+            snapshot = {stage: (total, self._counts[stage]) for stage, total in self._totals.items()}
+            self._totals.clear()
+            self._counts.clear()
+        return snapshot
+
+    # Soma um snapshot vindo de outro processo
+    def merge(self, snapshot):
+        with self._lock:
+            for stage, (total, calls) in snapshot.items():
+                self._totals[stage] = self._totals.get(stage, 0.0) + total
+                self._counts[stage] = self._counts.get(stage, 0) + calls
+
+
+# Tempo, chamadas e falhas (localizador sem elemento) por campo extraído
+class FieldStats:
+    def __init__(self):
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def add(self, field, seconds, missed=0):
+        with self._lock:
+            entry = self._fields.setdefault(field, [0.0, 0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+            entry[2] += missed
+
+    # Vários (campo, segundos, falhas) de uma vez, com uma única trava
+    def add_many(self, rows):
+        with self._lock:
+            for field, seconds, missed in rows:
+                entry = self._fields.setdefault(field, [0.0, 0, 0])
+                entry[0] += seconds
+                entry[1] += 1
+                entry[2] += missed
+
+    # {campo: (tempo_total, chamadas, falhas)}
+    def snapshot(self):
+        with self._lock:
+            return {field: tuple(entry) for field, entry in self._fields.items()}
+
+    def reset(self):
+        with self._lock:
+            self._fields.clear()
+
+    def drain(self):
+        with self._lock:
+            snapshot = {field: tuple(entry) for field, entry in self._fields.items()}
+            self._fields.clear()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self._lock:
+            for field, values in snapshot.items():
+                entry = self._fields.setdefault(field, [0.0, 0, 0])
+                for i, value in enumerate(values):
+                    entry[i] += value
+
+
+stats = StageStats()
+fields = FieldStats()
+
+
+# Estatísticas acumuladas num processo de trabalho (pool de parse), para
+# devolver ao principal junto com o resultado
+def drain():
+    return stats.drain(), fields.drain()
+
+
+def merge(snapshot):
+    stage_snapshot, field_snapshot = snapshot
+    stats.merge(stage_snapshot)
+    fields.merge(field_snapshot)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(stage, time.perf_counter() - start)
@@ -0,0 +1,79 @@
+import random
+import threading
+import time
+
+import requests
+
+
+# Balde de fichas: até `capacity` requisições de rajada e reposição de
+# `rate` fichas por segundo
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Bloqueia até haver uma ficha disponível
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Limite global mais limites por endpoint (ex.: 'ssw0053:P1', 'ssw0053:O')
+class RateLimiter:
+    def __init__(self, global_rate=None, endpoint_rates=None):
+        self.global_bucket = TokenBucket(global_rate) if global_rate else None
+        self.endpoint_buckets = {endpoint: TokenBucket(rate) for endpoint, rate in (endpoint_rates or {}).items() if rate}
+
+    def acquire(self, endpoint):
+        bucket = self.endpoint_buckets.get(endpoint)
+        if bucket:
+            bucket.acquire()
+        if self.global_bucket:
+            self.global_bucket.acquire()
+
+
+# Orçamento de retentativas compartilhado por todas as requisições de um CTRC
+class RetryBudget:
+    def __init__(self, max_retries):
+        self.remaining = max_retries
+        self._lock = threading.Lock()
+
+    def consume(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+# Espera exponencial com jitter completo: uniforme entre 0 e base * 2^tentativa
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def is_retryable_status(status_code):
+    return status_code in RETRYABLE_STATUS
+
+# Falhas de rede e tempo esgotado são temporárias; erros HTTP dependem do
+# código; o resto (URL inválida, erro de programação) não adianta repetir
+def is_retryable_error(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return is_retryable_status(error.response.status_code)
+    return False
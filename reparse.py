@@ -0,0 +1,206 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import time
+from datetime import datetime
+from itertools import groupby, islice
+
+import atl
+import perf_stats
+from data_extraction import field_report
+from html_archive import HtmlArchive
+
+# Reprocessamento offline: refaz a extração, o rastreamento, a rota e a
+# situação de todos os CTRCs a partir das respostas guardadas no arquivo HTML
+# (html_archive.py), sem acessar o SSW. Usado depois de mudar as regras de
+# data_extraction.py ou do dicionarios.json.
+#
+# O parse roda num pool de processos; os registros são gravados em lotes
+# (upsert por CTRC_Identificador) junto com o ponto de retomada de cada
+# filial, então uma execução interrompida continua de onde parou.
+
+
+def ensure_checkpoint_table(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reparse_checkpoint (
+            serie TEXT PRIMARY KEY,
+            ultimo_ctrc INTEGER NOT NULL,
+            atualizado_em TEXT
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def load_checkpoints(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('SELECT serie, ultimo_ctrc FROM reparse_checkpoint').fetchall()
+    conn.close()
+    return dict(rows)
+
+
+def clear_checkpoints(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('DELETE FROM reparse_checkpoint')
+    conn.commit()
+    conn.close()
+
+
+# Respostas mais recentes do arquivo agrupadas por CTRC:
+# gera (serie, ctrc, {act: (buscado_em, html)})
+def iter_archived_ctrcs(archive, serie=None, checkpoints=None):
+    checkpoints = checkpoints or {}
+    rows = archive.iter_latest(serie=serie)
+    for (serie_value, ctrc), group in groupby(rows, key=lambda row: (row[0], row[1])):
+        pages = {act: (fetched_at, html) for _, _, act, fetched_at, html in group}
+        if ctrc <= checkpoints.get(serie_value, -1):
+            continue
+        yield serie_value, ctrc, pages
+
+
+# Executado nos processos do pool: monta o registro completo de um CTRC a
+# partir das páginas arquivadas, como na ingestão. As estatísticas por campo
+# do processo voltam junto com o registro.
+def build_record(item):
+    serie, ctrc, extracted_data = _build_record(item)
+    return serie, ctrc, extracted_data, perf_stats.drain()
+
+
+def _build_record(item):
+    serie, ctrc, pages = item
+    if 'P1' not in pages:
+        return serie, ctrc, None
+    fetched_at, p1_html = pages['P1']
+    try:
+        status, extracted_data = atl.parse_ctrc_pages({
+            'P1': p1_html,
+            'A': pages['A'][1] if 'A' in pages else None,
+            'O': pages['O'][1] if 'O' in pages else None,
+        })
+        if status != 'ok':
+            return serie, ctrc, None
+
+        for field in ('Remetente Bairro', 'Destinatário Bairro', 'Entrega Bairro'):
+            extracted_data[field] = atl.correct_bairro(extracted_data.get(field))
+        # LEADTIME e situação do prazo ficam para apply_leadtime, por janela
+        extracted_data['situacao_resumida'] = atl.derive_situacao_resumida(
+            extracted_data.get('Descrição Situação'), extracted_data.get('Status'), extracted_data.get('Destino Código'))
+        extracted_data['ultima_verificacao'] = fetched_at
+        return serie, ctrc, extracted_data
+    except Exception as e:
+        print(f"Erro ao reprocessar CTRC {serie} {ctrc}: {e}")
+        return serie, ctrc, None
+
+
+# LEADTIME e situação do prazo dos registros de uma janela, por colunas
+# (atl.calcular_leadtime_e_situacao_prazo_lote): as mesmas datas de emissão
+# e entrega se repetem entre os CTRCs e são convertidas uma vez só
+def apply_leadtime(records):
+    results = atl.calcular_leadtime_e_situacao_prazo_lote(
+        [extracted_data.get('Status') for extracted_data in records],
+        [extracted_data.get('ocorrencia_data_Data de Emissão CTRC') for extracted_data in records],
+        [extracted_data.get('ocorrencia_data_Entregue') for extracted_data in records],
+    )
+    for extracted_data, (leadtime, situacao_prazo) in zip(records, results):
+        extracted_data['LEADTIME'] = leadtime
+        extracted_data['situação_prazo'] = situacao_prazo
+
+
+# Grava os registros (upsert por CTRC_Identificador), com os eventos de
+# rastreamento, e os pontos de retomada na mesma transação. Um registro no
+# banco verificado depois da resposta arquivada não é sobrescrito, nem os
+# seus eventos.
+def upsert_records(db_path, records_by_table, checkpoints):
+    columns = [atl.column_mapping[col] for col in atl.required_columns] + ['next_due_at', 'conteudo_hash']
+    updatable = [col for col in columns if col not in ('CTRC_Identificador', 'tentativas_dados')]
+    conn = sqlite3.connect(db_path, timeout=60)
+    try:
+        for table_name, records in records_by_table.items():
+            sql = f'''
+                INSERT INTO {table_name} ({', '.join(f'"{col}"' for col in columns)})
+                VALUES ({', '.join('?' for _ in columns)})
+                ON CONFLICT("CTRC_Identificador") DO UPDATE SET
+                    {', '.join(f'"{col}" = excluded."{col}"' for col in updatable)}
+                WHERE excluded."ultima_verificacao" >= COALESCE({table_name}."ultima_verificacao", '')
+            '''
+            cursor = conn.cursor()
+            for extracted_data in records:
+                values = [extracted_data.get(col, '' if 'Tentativas de Entrega' not in col else 0 if col == 'ocorrencia_data_Tentativas de Entrega' else None) for col in atl.required_columns]
+                values.append(atl.refresh_scheduler.next_due_at(extracted_data['situacao_resumida'], extracted_data['ultima_verificacao']))
+                values.append(extracted_data['conteudo_hash'])
+                cursor.execute(sql, values)
+                if cursor.rowcount:
+                    atl.save_occurrences(cursor, table_name, extracted_data)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        conn.executemany('''
+            INSERT INTO reparse_checkpoint (serie, ultimo_ctrc, atualizado_em) VALUES (?, ?, ?)
+            ON CONFLICT(serie) DO UPDATE SET ultimo_ctrc = excluded.ultimo_ctrc, atualizado_em = excluded.atualizado_em
+        ''', [(serie, ctrc, now) for serie, ctrc in checkpoints.items()])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocessa os CTRCs a partir do arquivo de respostas HTML do SSW.')
+    parser.add_argument('--arquivo', default=atl.ingestao_config['arquivo_html'] or 'html_archive.db', help='Banco do arquivo HTML')
+    parser.add_argument('--banco', default=atl.db_path, help='Banco de destino (tabelas ctrc_data_*)')
+    parser.add_argument('--filial', default=None, help='Reprocessa só esta série (ex.: VNA)')
+    parser.add_argument('--processos', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--lote', type=int, default=500, help='CTRCs por processo a cada gravação')
+    parser.add_argument('--recomecar', action='store_true', help='Ignora o ponto de retomada e reprocessa tudo')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.arquivo):
+        parser.error(f"Arquivo HTML não encontrado: {args.arquivo}")
+
+    atl.db_path = args.banco
+    tables = {filial['serie']: filial['table'] for filial in atl.filiais}
+    for table_name in tables.values():
+        atl.create_table(table_name)
+    ensure_checkpoint_table(args.banco)
+    if args.recomecar:
+        clear_checkpoints(args.banco)
+    checkpoints = load_checkpoints(args.banco)
+    if checkpoints:
+        print(f"Retomando após: {', '.join(f'{serie} {ctrc}' for serie, ctrc in sorted(checkpoints.items()))}")
+
+    archive = HtmlArchive(args.arquivo)
+    items = iter_archived_ctrcs(archive, args.filial, checkpoints)
+    window_size = args.lote * args.processos
+    processed = 0
+    written = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processos) as pool:
+        while True:
+            # Janela limitada: o pool não puxa o arquivo inteiro para a memória
+            window = list(islice(items, window_size))
+            if not window:
+                break
+            records_by_table = {}
+            last_ctrc = {}
+            for serie, ctrc, extracted_data, worker_stats in pool.imap(build_record, window, chunksize=max(1, args.lote // 4)):
+                perf_stats.merge(worker_stats)
+                last_ctrc[serie] = ctrc
+                if extracted_data is not None and serie in tables:
+                    records_by_table.setdefault(tables[serie], []).append(extracted_data)
+            for records in records_by_table.values():
+                apply_leadtime(records)
+            upsert_records(args.banco, records_by_table, last_ctrc)
+            processed += len(window)
+            written += sum(len(records) for records in records_by_table.values())
+            elapsed = time.perf_counter() - start
+            print(f"{processed} CTRCs reprocessados, {written} gravados ({processed / elapsed:.0f} CTRCs/s)")
+
+    # Execução completa: a próxima começa do início
+    clear_checkpoints(args.banco)
+    print(f"Reprocessamento concluído: {processed} CTRCs em {time.perf_counter() - start:.1f}s.")
+    print("Campos da página P1:")
+    for line in field_report(perf_stats.fields.snapshot()):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+# Agenda das reconsultas de CTRCs já gravados. Cada registro guarda em
+# next_due_at quando deve ser consultado de novo, calculado na gravação a
+# partir da situacao_resumida e da tabela de intervalos (em minutos;
+# intervalo 0 = situação final, não é mais consultado e fica com NULL).
+#
+# A seleção usa o índice em next_due_at (só os vencidos) e ordena pelo
+# atraso ponderado pela prioridade da situação, entregando primeiro o que é
+# mais urgente.
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class RefreshScheduler:
+    def __init__(self, intervals, priorities, default_interval=30,
+                 default_priority=3, unclassified_priority=5, tz=None):
+        self.intervals = intervals
+        self.priorities = priorities
+        self.default_interval = default_interval
+        self.default_priority = default_priority
+        self.unclassified_priority = unclassified_priority
+        self.tz = tz
+
+    def now(self):
+        return datetime.now(self.tz).strftime(TIME_FORMAT)
+
+    # Próxima consulta para um registro verificado em `checked_at`.
+    # Sem situação (registro novo) o registro vence na hora.
+    def next_due_at(self, situacao, checked_at=None):
+        checked_at = checked_at or self.now()
+        if not situacao:
+            return checked_at
+        interval = self.intervals.get(situacao, self.default_interval)
+        if interval == 0:
+            return None
+        return (datetime.strptime(checked_at, TIME_FORMAT) + timedelta(minutes=interval)).strftime(TIME_FORMAT)
+
+    # Cria a coluna e o índice; na primeira vez calcula next_due_at dos
+    # registros existentes a partir de ultima_verificacao
+    def ensure_schema(self, db_path, table_name):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        columns = [info[1] for info in cursor.fetchall()]
+        if 'next_due_at' not in columns:
+            cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN next_due_at TEXT')
+            interval_case, params = self._case('"situacao_resumida"', self.intervals, self.default_interval)
+            cursor.execute(f'''
+                UPDATE {table_name}
+                SET next_due_at = CASE
+                    WHEN "situacao_resumida" IS NULL OR "situacao_resumida" = '' OR "ultima_verificacao" IS NULL THEN ?
+                    WHEN {interval_case} = 0 THEN NULL
+                    ELSE COALESCE(strftime('%Y-%m-%d %H:%M:%S', "ultima_verificacao", '+' || {interval_case} || ' minutes'), ?)
+                END
+            ''', [self.now()] + params + params + [self.now()])
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_next_due_at ON {table_name} (next_due_at)')
+        conn.commit()
+        conn.close()
+
+    def _case(self, column, mapping, default):
+        params = []
+        whens = []
+        for key, value in mapping.items():
+            whens.append('WHEN ? THEN ?')
+            params.extend([key, value])
+        return f"(CASE {column} {' '.join(whens)} ELSE {default} END)", params
+
+    # Até `limit` registros vencidos, do mais urgente para o menos urgente
+    # (minutos de atraso + 1, vezes a prioridade da situação)
+    def due_records(self, db_path, table_name, columns, limit):
+        now = self.now()
+        priority_case, params = self._case('"situacao_resumida"', self.priorities, self.default_priority)
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute(f'''
+            SELECT {', '.join(columns)} FROM {table_name}
+            WHERE next_due_at IS NOT NULL AND next_due_at <= ?
+            ORDER BY ((julianday(?) - julianday(next_due_at)) * 1440 + 1) *
+                     (CASE WHEN "situacao_resumida" IS NULL OR "situacao_resumida" = '' THEN {self.unclassified_priority} ELSE {priority_case} END) DESC
+            LIMIT ?
+        ''', [now, now] + params + [limit]).fetchall()
+        conn.close()
+        return rows
+
+    # Segundos até o próximo registro vencer (0 se já há vencidos), ou None
+    # se nenhum registro está agendado. MIN sobre o índice, sem varrer a tabela.
+    def seconds_until_due(self, db_path, table_names):
+        conn = sqlite3.connect(db_path)
+        earliest = None
+        for table_name in table_names:
+            value = conn.execute(f'SELECT MIN(next_due_at) FROM {table_name}').fetchone()[0]
+            if value is not None and (earliest is None or value < earliest):
+                earliest = value
+        conn.close()
+        if earliest is None:
+            return None
+        delta = datetime.strptime(earliest, TIME_FORMAT) - datetime.strptime(self.now(), TIME_FORMAT)
+        return max(0.0, delta.total_seconds())
+
+    # Regrava a próxima consulta de um registro (cursor de uma transação aberta)
+    def reschedule(self, cursor, table_name, ctrc_identificador, situacao, checked_at=None):
+        cursor.execute(f'UPDATE {table_name} SET next_due_at = ? WHERE "CTRC_Identificador" = ?',
+                       (self.next_due_at(situacao, checked_at), ctrc_identificador))
@@ -0,0 +1,182 @@
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Divisão das filiais entre vários processos de ingestão (na mesma máquina
+# ou em várias, com o mesmo banco). Cada filial é um shard com um lease na
+# tabela ingestao_leases; o dono renova o prazo a cada heartbeat. O lease de
+# um worker morto ou travado vence e é assumido por outro worker na rodada
+# seguinte.
+#
+# Cada rodada é uma transação BEGIN IMMEDIATE: dois workers nunca assumem o
+# mesmo shard. Cada worker fica com no máximo a sua parte (shards / workers
+# vivos, arredondada para cima) e devolve o excedente quando outro worker
+# entra, então basta iniciar mais um processo para dividir a carga.
+#
+# Os prazos são horários absolutos (time.time()): as máquinas precisam estar
+# com o relógio sincronizado.
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def ensure_lease_tables(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingestao_leases (
+            shard TEXT PRIMARY KEY,
+            worker TEXT,
+            expira_em REAL,
+            adquirido_em REAL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingestao_workers (
+            worker TEXT PRIMARY KEY,
+            heartbeat_em REAL NOT NULL,
+            iniciado_em REAL NOT NULL
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+# Shards (ex.: séries das filiais) divididos entre os workers. on_change(adquiridos,
+# perdidos) é chamado a cada mudança, antes de os shards adquiridos aparecerem
+# em owned(): é onde o worker recarrega o estado de um shard que era de outro.
+class ShardLeases:
+    def __init__(self, db_path, shards, worker_id=None, ttl=60, heartbeat_interval=15,
+                 max_shards=0, on_change=None):
+        self.db_path = db_path
+        self.shards = sorted(shards)
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.max_shards = max_shards
+        self.on_change = on_change
+        self._owned = set()
+        self._valid_until = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        ensure_lease_tables(db_path)
+
+    # Shards deste worker. Se o heartbeat não é gravado há mais de ttl
+    # segundos (banco inacessível), outro worker pode ter assumido: nenhum.
+    def owned(self):
+        with self._lock:
+            if time.time() > self._valid_until:
+                return set()
+            return set(self._owned)
+
+    def owns(self, shard):
+        return shard in self.owned()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    # Uma rodada: heartbeat, renovação dos leases, devolução do excedente e
+    # aquisição de shards livres ou vencidos. Retorna (adquiridos, perdidos).
+    def refresh(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('''
+                INSERT INTO ingestao_workers (worker, heartbeat_em, iniciado_em) VALUES (?, ?, ?)
+                ON CONFLICT(worker) DO UPDATE SET heartbeat_em = excluded.heartbeat_em
+            ''', (self.worker_id, now, now))
+            conn.execute('DELETE FROM ingestao_workers WHERE heartbeat_em < ?', (now - self.ttl,))
+            live_workers = conn.execute('SELECT COUNT(*) FROM ingestao_workers').fetchone()[0]
+            conn.executemany('INSERT OR IGNORE INTO ingestao_leases (shard) VALUES (?)', [(shard,) for shard in self.shards])
+
+            placeholders = ', '.join('?' for _ in self.shards)
+            rows = conn.execute(f'SELECT shard, worker, expira_em FROM ingestao_leases WHERE shard IN ({placeholders})', self.shards).fetchall()
+            mine = sorted(shard for shard, worker, _ in rows if worker == self.worker_id)
+            free = sorted(shard for shard, worker, expires_at in rows
+                          if worker is None or (worker != self.worker_id and (expires_at or 0) < now))
+
+            share = math.ceil(len(self.shards) / max(1, live_workers))
+            if self.max_shards:
+                share = min(share, self.max_shards)
+            keep = mine[:share]
+            release = mine[share:]
+            take = free[:max(0, share - len(keep))]
+
+            expires_at = now + self.ttl
+            conn.executemany('UPDATE ingestao_leases SET expira_em = ? WHERE shard = ? AND worker = ?',
+                             [(expires_at, shard, self.worker_id) for shard in keep])
+            conn.executemany('UPDATE ingestao_leases SET worker = ?, expira_em = ?, adquirido_em = ? WHERE shard = ?',
+                             [(self.worker_id, expires_at, now, shard) for shard in take])
+            conn.executemany('UPDATE ingestao_leases SET worker = NULL, expira_em = NULL WHERE shard = ? AND worker = ?',
+                             [(shard, self.worker_id) for shard in release])
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        owned = set(keep + take)
+        with self._lock:
+            previous = self._owned if now <= self._valid_until else set()
+            acquired = owned - previous
+            lost = previous - owned
+            self._owned = previous & owned
+        if (acquired or lost) and self.on_change is not None:
+            self.on_change(acquired, lost)
+        with self._lock:
+            self._owned = owned
+            self._valid_until = expires_at
+        return acquired, lost
+
+    # Primeira rodada já na chamada (o worker começa com seus shards), as
+    # seguintes em segundo plano a cada heartbeat_interval segundos
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            self.refresh()
+        except sqlite3.Error as e:
+            print(f"Erro ao adquirir shards: {e}")
+        self._thread = threading.Thread(target=self._run, name='shard-leases', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Erro ao renovar os leases dos shards: {e}")
+
+    # Para o heartbeat e devolve os shards, para outro worker assumir logo
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._owned = set()
+            self._valid_until = 0
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('UPDATE ingestao_leases SET worker = NULL, expira_em = NULL WHERE worker = ?', (self.worker_id,))
+                conn.execute('DELETE FROM ingestao_workers WHERE worker = ?', (self.worker_id,))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Erro ao liberar os shards: {e}")
+
+    # [(shard, worker, segundos até vencer)], para acompanhamento
+    def status(self):
+        now = time.time()
+        conn = self._connect()
+        rows = conn.execute('SELECT shard, worker, expira_em FROM ingestao_leases ORDER BY shard').fetchall()
+        conn.close()
+        return [(shard, worker, None if expires_at is None else expires_at - now) for shard, worker, expires_at in rows]
@@ -0,0 +1,156 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+
+# Conversão das datas e números no formato do SSW ('dd/mm/aa HH:MM',
+# 'dd/mm/aaaa', '1.234,56') e dos horários gravados no banco
+# ('%Y-%m-%d %H:%M:%S'). O formato usual é reconhecido por expressões
+# regulares pré-compiladas, sem strptime nem exceções; o resto cai no
+# strptime, com o mesmo resultado de antes. As mesmas datas se repetem
+# muito entre eventos e CTRCs, então as conversões ficam em cache (LRU).
+#
+# As versões *_column convertem colunas inteiras (listas ou pandas.Series)
+# para os jobs em lote, convertendo cada valor distinto uma vez só.
+
+DATE_TIME_SHORT = re.compile(r'(\d{2})/(\d{2})/(\d{2}) (\d{2}):(\d{2})')
+DATE_TIME_LONG = re.compile(r'(\d{2})/(\d{2})/(\d{4}) (\d{2}):(\d{2})')
+DATE_SHORT = re.compile(r'(\d{2})/(\d{2})/(\d{2})')
+DATE_LONG = re.compile(r'(\d{2})/(\d{2})/(\d{4})')
+TIMESTAMP = re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})')
+
+CACHE_SIZE = 16384
+
+
+# Ano de dois dígitos com a mesma regra do %y do strptime
+def _full_year(year):
+    return year + (1900 if year >= 69 else 2000)
+
+
+# datetime a partir das partes, ou None se a data não existe
+def _build(year, month, day, hour=0, minute=0, second=0):
+    try:
+        return datetime(year, month, day, hour, minute, second)
+    except ValueError:
+        return None
+
+
+# 'dd/mm/aa HH:MM' (ou 'dd/mm/aaaa HH:MM') -> '%Y-%m-%d %H:%M:%S', '' se inválida
+@lru_cache(maxsize=CACHE_SIZE)
+def format_date_time(date_time_str):
+    if not date_time_str:
+        return ''
+    parts = date_time_str.split()
+    if len(parts) < 2:
+        return ''
+    match = DATE_TIME_SHORT.fullmatch(f"{parts[0]} {parts[1]}")
+    if match:
+        day, month, year, hour, minute = map(int, match.groups())
+        dt = _build(_full_year(year), month, day, hour, minute)
+        if dt is not None:
+            return dt.strftime('%Y-%m-%d %H:%M:%S')
+    match = DATE_TIME_LONG.fullmatch(date_time_str)
+    if match:
+        day, month, year, hour, minute = map(int, match.groups())
+        dt = _build(year, month, day, hour, minute)
+        if dt is not None:
+            return dt.strftime('%Y-%m-%d %H:%M:%S')
+    return _format_date_time_strptime(date_time_str)
+
+
+def _format_date_time_strptime(date_time_str):
+    try:
+        date_str, time_str = date_time_str.split()[:2]
+        dt = datetime.strptime(f"{date_str} {time_str}", '%d/%m/%y %H:%M')
+        return dt.strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        try:
+            dt = datetime.strptime(f"{date_time_str}", '%d/%m/%Y %H:%M')
+            return dt.strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return ''
+
+
+# 'dd/mm/aa' (ou 'dd/mm/aaaa') -> '%Y-%m-%d 23:59:59', '' se inválida
+@lru_cache(maxsize=CACHE_SIZE)
+def format_date(date_str):
+    if not date_str:
+        return ''
+    match = DATE_SHORT.fullmatch(date_str)
+    if match:
+        day, month, year = map(int, match.groups())
+        dt = _build(_full_year(year), month, day)
+    else:
+        match = DATE_LONG.fullmatch(date_str)
+        dt = _build(int(match.group(3)), int(match.group(2)), int(match.group(1))) if match else None
+    if dt is not None:
+        return dt.strftime('%Y-%m-%d 23:59:59')  # Incluir a hora padrão
+    return _format_date_strptime(date_str)
+
+
+def _format_date_strptime(date_str):
+    try:
+        dt = datetime.strptime(date_str, '%d/%m/%y')
+        return dt.strftime('%Y-%m-%d 23:59:59')
+    except ValueError:
+        try:
+            dt = datetime.strptime(date_str, '%d/%m/%Y')
+            return dt.strftime('%Y-%m-%d 23:59:59')
+        except ValueError:
+            return ''
+
+
+# '1.234,56' -> 1234.56, 0.0 se vazio ou inválido
+@lru_cache(maxsize=CACHE_SIZE)
+def format_decimal(value):
+    if not value:
+        return 0.0
+    try:
+        return float(value.replace('.', '').replace(',', '.'))
+    except ValueError:
+        return 0.0
+
+
+# Horário gravado no banco ('%Y-%m-%d %H:%M:%S') -> datetime, ou None se inválido
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_timestamp(value):
+    match = TIMESTAMP.fullmatch(value)
+    if match:
+        dt = _build(*map(int, match.groups()))
+        if dt is not None:
+            return dt
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+# Aplica fn a uma coluna (lista ou pandas.Series), uma vez por valor distinto
+def map_column(fn, values):
+    converted = {}
+
+    def convert(value):
+        try:
+            return converted[value]
+        except KeyError:
+            result = converted[value] = fn(value)
+            return result
+
+    if hasattr(values, 'map'):
+        return values.map(convert)
+    return [convert(value) for value in values]
+
+
+def format_date_time_column(values):
+    return map_column(format_date_time, values)
+
+
+def format_date_column(values):
+    return map_column(format_date, values)
+
+
+def format_decimal_column(values):
+    return map_column(format_decimal, values)
+
+
+def parse_timestamp_column(values):
+    return map_column(lambda value: parse_timestamp(value) if isinstance(value, str) else None, values)
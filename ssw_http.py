@@ -0,0 +1,230 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import perf_stats
+from rate_limit import RetryBudget, backoff_delay, is_retryable_error, is_retryable_status
+
+# URL base do sistema SSW
+SSW_BASE_URL = "https://sistema.ssw.inf.br"
+
+# Tempo máximo (segundos) de espera por uma resposta do SSW
+DEFAULT_TIMEOUT = 60
+
+# Retentativas por chamada quando não há orçamento do CTRC no contexto
+DEFAULT_MAX_RETRIES = 2
+
+# Limitador de taxa (rate_limit.RateLimiter); None = sem limite
+_rate_limiter = None
+
+# Gerenciador de credenciais (token_manager.TokenManager); quando definido,
+# toda requisição usa os cookies atuais dele no lugar dos recebidos
+_credentials = None
+
+# Tempo máximo (segundos) que um worker espera pelo token novo após receber
+# sessão expirada
+AUTH_WAIT_TIMEOUT = 120
+
+_session = None
+_session_lock = threading.Lock()
+_pool_size = 10
+
+# Requisições idênticas em andamento (coalescência)
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# Contexto da thread atual (filial, CTRC) e observadores de cada requisição
+_context = threading.local()
+_observers = []
+
+class _InFlightRequest:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+def ssw_url(programa):
+    return f"{SSW_BASE_URL}/bin/{programa}"
+
+# Permite apontar a ingestão para outro servidor (ex.: ssw_standin local)
+def configure_base_url(base_url):
+    global SSW_BASE_URL
+    SSW_BASE_URL = base_url.rstrip('/')
+
+def _create_session(pool_size):
+    session = requests.Session()
+    # Os cookies de autenticação são enviados em cada chamada; a sessão não
+    # deve guardar cookies de resposta, senão uma thread contaminaria a outra
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Ajusta o tamanho do pool de conexões por host (deve acompanhar o número de
+# workers simultâneos). Recria a sessão se o tamanho mudar.
+def configure_pool(pool_size):
+    global _session, _pool_size
+    with _session_lock:
+        if pool_size == _pool_size and _session is not None:
+            return
+        _pool_size = pool_size
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def configure_rate_limiter(rate_limiter):
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+def configure_credentials(credentials):
+    global _credentials
+    _credentials = credentials
+
+# Sessão expirada: 401/403, redirecionamento para o login (ssw0422) ou aviso
+# de sessão expirada na página
+def is_auth_failure(response):
+    if response.status_code in (401, 403):
+        return True
+    if 'ssw0422' in (response.url or ''):
+        return True
+    text = response.text[:2000].lower()
+    return 'sessão expirada' in text or 'sessao expirada' in text
+
+# Endpoint para fins de limite de taxa: programa + act (ex.: 'ssw0053:P1')
+def endpoint_key(url, data):
+    return f"{url.rstrip('/').rsplit('/', 1)[-1]}:{data.get('act', '')}"
+
+# Sessão compartilhada (keep-alive) usada por todas as chamadas ao SSW
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session(_pool_size)
+    return _session
+
+# Define valores de contexto (ex.: serie, ctrc) para as requisições feitas
+# pela thread atual dentro do bloco with
+@contextmanager
+def request_context(**values):
+    previous = dict(getattr(_context, 'values', {}))
+    _context.values = {**previous, **values}
+    try:
+        yield
+    finally:
+        _context.values = previous
+
+def current_context():
+    return dict(getattr(_context, 'values', {}))
+
+# Registra uma função chamada após cada requisição real ao SSW com
+# (contexto, url, data, tempo_decorrido, response, erro)
+def add_observer(observer):
+    _observers.append(observer)
+
+def remove_observer(observer):
+    if observer in _observers:
+        _observers.remove(observer)
+
+def _send(url, kwargs):
+    start = time.perf_counter()
+    response = None
+    error = None
+    try:
+        response = get_session().post(url, **kwargs)
+        return response
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        perf_stats.stats.add('rede', elapsed)
+        context = current_context()
+        for observer in list(_observers):
+            try:
+                observer(context, url, kwargs.get('data') or {}, elapsed, response, error)
+            except Exception as e:
+                print(f"Erro no observador de requisições: {e}")
+
+# Envia respeitando o limite de taxa e repete falhas temporárias com espera
+# exponencial, consumindo o orçamento de retentativas do CTRC (contexto
+# 'retry_budget') ou um orçamento próprio da chamada
+def _send_with_retry(url, kwargs):
+    endpoint = endpoint_key(url, kwargs.get('data') or {})
+    budget = current_context().get('retry_budget') or RetryBudget(DEFAULT_MAX_RETRIES)
+    attempt = 0
+    auth_retried = False
+    while True:
+        if _rate_limiter is not None:
+            _rate_limiter.acquire(endpoint)
+        try:
+            response = _send(url, kwargs)
+        except Exception as e:
+            if not is_retryable_error(e) or not budget.consume():
+                raise
+            print(f"Falha temporária em {endpoint} ({e}); nova tentativa {attempt + 1}.")
+        else:
+            if _credentials is not None and not auth_retried and is_auth_failure(response):
+                # Espera o token novo em vez de falhar; repete uma única vez
+                auth_retried = True
+                print(f"Sessão expirada em {endpoint}; aguardando novo token...")
+                new_cookies = _credentials.wait_for_refresh(kwargs.get('cookies'), AUTH_WAIT_TIMEOUT)
+                if new_cookies is None:
+                    return response
+                kwargs['cookies'] = new_cookies
+                continue
+            if not is_retryable_status(response.status_code) or not budget.consume():
+                return response
+            print(f"SSW respondeu {response.status_code} em {endpoint}; nova tentativa {attempt + 1}.")
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+
+# Chave de coalescência: URL + formulário (sem o 'dummy', que muda a cada
+# chamada) + cookies
+def _coalesce_key(url, kwargs):
+    data = kwargs.get('data') or {}
+    cookies = kwargs.get('cookies') or {}
+    return (
+        url,
+        tuple(sorted((k, v) for k, v in data.items() if k != 'dummy')),
+        tuple(sorted(cookies.items())),
+    )
+
+# Com coalesce=True, chamadas idênticas feitas enquanto a primeira ainda está
+# em andamento esperam por ela e recebem a mesma resposta
+def post(url, coalesce=False, **kwargs):
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    if _credentials is not None:
+        kwargs['cookies'] = _credentials.cookies()
+    if not coalesce:
+        return _send_with_retry(url, kwargs)
+
+    key = _coalesce_key(url, kwargs)
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        leader = call is None
+        if leader:
+            call = _InFlightRequest()
+            _in_flight[key] = call
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.response
+
+    try:
+        call.response = _send_with_retry(url, kwargs)
+        return call.response
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        call.done.set()
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Servidor local que imita o ssw0053 a partir de respostas gravadas, para
+# testar e medir a ingestão sem acessar o sistema.ssw.inf.br.
+#
+# Corpus (diretório de fixtures):
+#   {serie}{numero}_{act}.html  -> resposta gravada para o CTRC e act (P1, A, O)
+#   seq_index.json              -> seq_ctrc -> "{serie}{numero}" (as consultas
+#                                  act=A/O só trazem o seq_ctrc)
+
+NOT_FOUND_HTML = "<html><body><script>alert('CTRC não encontrado')</script></body></html>"
+
+SEQ_INDEX_FILE = 'seq_index.json'
+
+
+def fixture_key(serie, numero):
+    return f"{serie}{int(numero)}"
+
+
+# Leitura e escrita do corpus de fixtures
+class FixtureStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.seq_index = self._load_seq_index()
+
+    def _load_seq_index(self):
+        path = os.path.join(self.directory, SEQ_INDEX_FILE)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _path(self, key, act):
+        return os.path.join(self.directory, f"{key}_{act}.html")
+
+    def get(self, key, act):
+        try:
+            with open(self._path(key, act), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, act, html, seq_ctrc=None):
+        with self._lock:
+            with open(self._path(key, act), 'w', encoding='utf-8') as f:
+                f.write(html)
+            if seq_ctrc and self.seq_index.get(seq_ctrc) != key:
+                self.seq_index[seq_ctrc] = key
+                tmp_path = os.path.join(self.directory, SEQ_INDEX_FILE + '.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.seq_index, f)
+                os.replace(tmp_path, os.path.join(self.directory, SEQ_INDEX_FILE))
+
+    # Resolve a chave do CTRC a partir do formulário enviado ao ssw0053
+    def key_for_request(self, form):
+        if form.get('act') == 'P1':
+            return fixture_key(form.get('t_ser_ctrc', ''), form.get('t_nro_ctrc', '0') or '0')
+        return self.seq_index.get(form.get('seq_ctrc', ''))
+
+
+# Gravador: observador do ssw_http que salva as respostas reais no corpus
+class FixtureRecorder:
+    def __init__(self, store):
+        self.store = store
+
+    def observe(self, context, url, data, elapsed, response, error):
+        if error is not None or response.status_code != 200 or not url.endswith('/ssw0053'):
+            return
+        act = data.get('act')
+        if act not in ('P1', 'A', 'O') or not response.text.strip():
+            return
+        if "CTRC não encontrado" in response.text:
+            return
+        serie, ctrc = context.get('serie'), context.get('ctrc')
+        if not serie or ctrc is None:
+            return
+        self.store.put(fixture_key(serie, ctrc), act, response.text, data.get('seq_ctrc') if act != 'P1' else None)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Preenchidos por make_server
+    store = None
+    latency = 0.0
+    error_rate = 0.0
+    not_found_rate = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8', errors='replace')
+        form = {k: v[0] for k, v in parse_qs(body, keep_blank_values=True).items()}
+
+        if not self.path.rstrip('/').endswith('/ssw0053'):
+            self._reply(404, 'Programa não disponível no servidor local')
+            return
+
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self._reply(503, 'Erro simulado')
+            return
+
+        html = None
+        if not (self.not_found_rate and random.random() < self.not_found_rate):
+            key = self.store.key_for_request(form)
+            if key:
+                html = self.store.get(key, form.get('act', ''))
+        self._reply(200, html if html is not None else NOT_FOUND_HTML)
+
+    def _reply(self, status, text):
+        payload = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # A fila padrão (5) recusa conexões quando a ingestão roda com alta concorrência
+    request_queue_size = 256
+
+
+def make_server(store, host='127.0.0.1', port=8053, latency=0.0, error_rate=0.0, not_found_rate=0.0):
+    handler = type('ConfiguredStandInHandler', (StandInHandler,), {
+        'store': store,
+        'latency': latency,
+        'error_rate': error_rate,
+        'not_found_rate': not_found_rate,
+    })
+    return StandInServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor local que reproduz respostas gravadas do SSW (ssw0053).')
+    parser.add_argument('--fixtures', default='fixtures/ssw', help='Diretório do corpus de respostas gravadas')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8053)
+    parser.add_argument('--latencia', type=float, default=0.0, help='Latência média injetada, em segundos')
+    parser.add_argument('--taxa-erro', type=float, default=0.0, help='Fração de respostas 503')
+    parser.add_argument('--taxa-nao-encontrado', type=float, default=0.0, help='Fração de respostas "CTRC não encontrado"')
+    args = parser.parse_args()
+
+    server = make_server(FixtureStore(args.fixtures), args.host, args.porta, args.latencia, args.taxa_erro, args.taxa_nao_encontrado)
+    print(f"Servidor SSW local em http://{args.host}:{args.porta} (fixtures: {args.fixtures})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
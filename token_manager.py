@@ -0,0 +1,108 @@
+import threading
+import time
+
+
+# Credenciais fixas (sem renovação), para benchmark e ferramentas offline
+class StaticCredentials:
+    def __init__(self, cookies):
+        self._cookies = dict(cookies)
+
+    def cookies(self):
+        return self._cookies
+
+    def wait_for_refresh(self, stale_cookies, timeout=None):
+        return None
+
+
+# Gerencia o ciclo de vida do token do SSW: verifica a expiração em segundo
+# plano, renova com antecedência sem parar a ingestão e troca atomicamente
+# os cookies usados pelos workers. Workers que recebem sessão expirada
+# chamam wait_for_refresh e esperam pelo token novo.
+class TokenManager:
+    def __init__(self, refresh_fn, load_cookies_fn, is_expiring_fn,
+                 refresh_ahead=600, check_interval=60, min_refresh_interval=60):
+        self.refresh_fn = refresh_fn
+        self.load_cookies_fn = load_cookies_fn
+        self.is_expiring_fn = is_expiring_fn
+        self.refresh_ahead = refresh_ahead
+        self.check_interval = check_interval
+        self.min_refresh_interval = min_refresh_interval
+        self._cookies = dict(load_cookies_fn())
+        self._condition = threading.Condition()
+        self._refreshing = False
+        self._last_attempt = 0
+        self._finished_refreshes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def cookies(self):
+        with self._condition:
+            return self._cookies
+
+    def token_expiring(self):
+        token = self.cookies().get('token')
+        return not token or self.is_expiring_fn(token, self.refresh_ahead)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='token-manager', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.token_expiring():
+                self.refresh()
+            self._stop.wait(self.check_interval)
+
+    # Renova o token (uma renovação por vez) e troca os cookies em memória.
+    # Chamadas concorrentes esperam pela renovação em andamento.
+    def refresh(self):
+        with self._condition:
+            if self._refreshing:
+                self._condition.wait_for(lambda: not self._refreshing)
+                return True
+            if time.time() - self._last_attempt < self.min_refresh_interval:
+                return False
+            self._refreshing = True
+            self._last_attempt = time.time()
+        success = False
+        try:
+            success = self.refresh_fn()
+            if success:
+                new_cookies = dict(self.load_cookies_fn())
+                with self._condition:
+                    self._cookies = new_cookies
+                print("Cookies do SSW atualizados em memória.")
+        except Exception as e:
+            print(f"Erro ao renovar token: {e}")
+        finally:
+            with self._condition:
+                self._refreshing = False
+                self._finished_refreshes += 1
+                self._condition.notify_all()
+        return success
+
+    # Chamado por um worker cuja requisição voltou com sessão expirada.
+    # Se os cookies já foram trocados, devolve os novos na hora; senão dispara
+    # a renovação em segundo plano e espera até `timeout` segundos, ou até a
+    # renovação terminar sem cookies novos. Se uma renovação acabou de ser
+    # tentada (intervalo mínimo) e os cookies não mudaram, não espera.
+    # Retorna os cookies novos ou None.
+    def wait_for_refresh(self, stale_cookies, timeout=120):
+        with self._condition:
+            if self._cookies != stale_cookies:
+                return self._cookies
+            if not self._refreshing:
+                if time.time() - self._last_attempt < self.min_refresh_interval:
+                    return None
+                threading.Thread(target=self.refresh, name='token-refresh', daemon=True).start()
+            finished = self._finished_refreshes
+            self._condition.wait_for(lambda: self._cookies != stale_cookies or self._finished_refreshes != finished,
+                                     timeout=timeout)
+            return self._cookies if self._cookies != stale_cookies else None